@@ -1,29 +1,54 @@
 import asyncio
 import time
 import os
-from typing import List
+import threading
+import json
+import uuid
+import weakref
+from typing import List, Optional
 from collections import defaultdict
 
-from llama_index.readers.web import BeautifulSoupWebReader
-from llama_index.embeddings.openai import OpenAIEmbedding
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
 from llama_index.core import VectorStoreIndex
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.core.schema import NodeRelationship, NodeWithScore, QueryBundle
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, Settings
+from llama_index.core.schema import NodeRelationship, NodeWithScore, QueryBundle, TextNode
+from llama_index.core import VectorStoreIndex, Settings
 from llama_index.core import StorageContext, load_index_from_storage
 from llama_index.llms.ollama import Ollama
 from llama_index.core.workflow import Context
-from llama_index.postprocessor.colbert_rerank import ColbertRerank
 from llama_index.core.postprocessor import SimilarityPostprocessor
 from llama_index.core.llms import ChatMessage, MessageRole
 from llama_index.core import Document
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
 
 from llama_index.core.workflow import Event, StartEvent, StopEvent, Workflow, step
 
-from utils import read_and_concat_pdf, convert_message_list_to_str
+from llama_index.core.retrievers import VectorIndexRetriever
+from llama_index.core.vector_stores import MetadataFilter, MetadataFilters
+
+from utils import convert_message_list_to_str, is_self_contained
+from pdf_pages import PageExtractor, merge_page_nodes, unique_pages
+from persistence import SegmentLog
+from index_builder import BuildState, iter_parsed_batches, list_input_files, parse_file
+from manifest import MANIFEST_VERSION, DocumentManifest
+from history import estimate_tokens, window_history
+from vector_store import NumpyVectorStore
+from sparse_index import BM25Index, reciprocal_rank_fusion
+from cache import LRUCache, SemanticAnswerCache, normalize_query
+from context_packing import pack_context
+from embedding_backends import EMBED_BACKENDS, load_embed_model
+from model_workers import BatchWorker, colbert_rerank_batch
+from llm_scheduler import LLMScheduler
+from metrics import STEP_LATENCY, TIME_TO_FIRST_TOKEN, TOKENS_PER_SECOND, CHAT_TURNS, PROMPT_TOKENS
 
 class CondenseQueryEvent(Event):
     condensed_query_str: str
+    # set when speculative retrieval already produced the nodes during condensation
+    nodes: Optional[List[NodeWithScore]] = None
 
 class RetrievalEvent(Event):
     nodes: List[NodeWithScore]
@@ -46,43 +71,529 @@ class RAGAgent(Workflow):
         "{query_str}\n"
     ) 
 
-    def __init__(self, index_persisted_dir, data_dir, tmp_dir, timeout: int = 60, verbose: bool = False):
+    def __init__(self, index_persisted_dir, data_dir, tmp_dir, timeout: int = 60, verbose: bool = False,
+                 embed_batch_size: int = 64, compact_every: int = 20, vector_store: str = "simple",
+                 vector_dtype: str = "float32", cache_size: int = 1024, cache_ttl: float = 3600,
+                 model_threads: int = 1, max_rerank_batch_pairs: int = 64, model_queue_size: int = 64,
+                 skip_condensation: bool = True, speculative_retrieval: bool = True, speculative_similarity: float = 0.9,
+                 trace_log_path: Optional[str] = None, llm=None, embed_model=None, reranker=None,
+                 max_open_pdfs: int = 16, max_cached_pages: int = 2048,
+                 build_workers: Optional[int] = None, build_batch_size: int = 256,
+                 history_tokens: int = 1024, history_summary_tokens: int = 256,
+                 read_only: bool = False, reload_interval: float = 2.0,
+                 retrieval_mode: str = "hybrid", hybrid_candidates: int = 20, rerank_candidates: int = 5,
+                 rrf_k: int = 60, ann: Optional[str] = None, ann_probes: int = 16, lazy_load: bool = False,
+                 max_llm_in_flight: int = 2, max_llm_queue: int = 32, max_llm_queued_per_user: int = 2,
+                 max_llm_wait: float = 30.0, llm_call_reserve: float = 15.0, answer_cache_size: int = 1024,
+                 answer_similarity: float = 0.95, context_tokens: Optional[int] = 1536, passage_tokens: int = 128,
+                 chunk_size: Optional[int] = 256, chunk_overlap: int = 32, embed_backend: str = "torch",
+                 embed_threads: Optional[int] = None, retrievals=None):
         super().__init__(timeout=timeout, verbose=verbose)
+        if read_only and vector_store != "numpy":
+            raise ValueError("read_only requires vector_store='numpy', the only backend shared between processes")
+        if ann is not None and vector_store != "numpy":
+            raise ValueError("ann requires vector_store='numpy'")
+        if retrieval_mode not in ("hybrid", "dense"):
+            raise ValueError(f"Unknown retrieval_mode {retrieval_mode!r}, expected 'hybrid' or 'dense'")
+        if embed_backend not in EMBED_BACKENDS:
+            raise ValueError(f"Unknown embed_backend {embed_backend!r}, expected one of {', '.join(EMBED_BACKENDS)}")
         self.index_persisted_dir = index_persisted_dir
         self.data_dir = data_dir
         self.tmp_dir = tmp_dir
         self.k = 5
+        # serializes writers (ingestion workers) of the index and its persisted files
+        self._index_lock = threading.Lock()
+        # uploads are persisted as append-only segments, folded into the full storage every `compact_every` segments
+        self.segment_log = SegmentLog(os.path.join(self.index_persisted_dir, "segments"))
+        self.compact_every = compact_every
+        # the initial build parses files on `build_workers` processes and commits shards of `build_batch_size` pages
+        self.build_workers = build_workers
+        self.build_batch_size = build_batch_size
+        self.build_state = BuildState(os.path.join(self.index_persisted_dir, "build_state.json"))
+        # file and page content hashes of what is indexed, unchanged pages are never embedded twice
+        self.manifest = DocumentManifest(os.path.join(self.index_persisted_dir, "manifest.json"))
+        # "simple" keeps llama_index's in-memory SimpleVectorStore, "numpy" uses the memory-mapped NumpyVectorStore
+        self.vector_store_backend = vector_store
+        self.vector_dtype = vector_dtype
+        self.vector_store = None
+        # "ivf" makes large NumPy stores score only the `ann_probes` IVF lists closest to the query
+        self.ann = ann
+        self.ann_probes = ann_probes
+        # a read-only agent maps the index another process writes, and reloads it every `reload_interval` seconds
+        self.read_only = read_only
+        self.reload_interval = reload_interval
+        # "hybrid" fuses the dense ranking with BM25 over an inverted index, "dense" uses the embeddings only.
+        # Each ranking contributes `hybrid_candidates` nodes, only the best `rerank_candidates` after
+        # reciprocal-rank fusion are reranked, so ColBERT's cost does not grow with the candidate pool
+        self.retrieval_mode = retrieval_mode
+        self.hybrid_candidates = hybrid_candidates
+        self.rerank_candidates = rerank_candidates
+        self.rrf_k = rrf_k
+        # follow-up questions: skip the rewrite for self-contained questions, retrieve with the raw question meanwhile
+        self.skip_condensation = skip_condensation
+        self.speculative_retrieval = speculative_retrieval
+        self.speculative_similarity = speculative_similarity
+        # only the most recent turns within this budget are sent verbatim, older questions are summarized
+        self.history_tokens = history_tokens
+        self.history_summary_tokens = history_summary_tokens
+        # pages are split into chunks of about chunk_size tokens, every chunk keeps the file_path/page_index of its page
+        self.node_parser = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap) if chunk_size else None
+        # the retrieved pages are trimmed to their most relevant passages to fit this budget
+        self.context_tokens = context_tokens
+        self.passage_tokens = passage_tokens
+        # one JSON line with the step timings of every chat turn is appended here when set
+        self.trace_log_path = trace_log_path
+        # bumped whenever the indexed content changes, it is part of the retrieval cache key
+        self.index_version = 0
+        self.query_embedding_cache = LRUCache(max_size=cache_size, ttl=cache_ttl)
+        self.retrieval_cache = LRUCache(max_size=cache_size, ttl=cache_ttl)
+        # answers to questions that stand on their own, replayed when a similar question retrieves the same nodes
+        self.answer_cache = SemanticAnswerCache(max_size=answer_cache_size, ttl=cache_ttl,
+                                                similarity_threshold=answer_similarity) if answer_cache_size > 0 else None
+        # retrieved pages are served one by one from this cache, they are extracted off the critical path
+        self.page_extractor = PageExtractor(max_open_documents=max_open_pdfs, max_cached_pages=max_cached_pages)
+        # retrieval id -> (file_path, page_index, score) of the pages retrieved in that turn
+        # in this process only, unless a store shared by the workers (SQLiteCache) is passed
+        self.retrievals = retrievals if retrievals is not None else LRUCache(max_size=cache_size, ttl=cache_ttl)
+
+        self.dense_top_k = hybrid_candidates if retrieval_mode == "hybrid" else self.k
+        # every LLM call (condensation and answer) takes one of `max_llm_in_flight` slots, waiting users are served in turn
+        self.llm_scheduler = LLMScheduler(max_in_flight=max_llm_in_flight, max_queue_size=max_llm_queue,
+                                          max_queued_per_user=max_llm_queued_per_user, max_wait=max_llm_wait)
+        # seconds of the workflow timeout kept for each LLM call still to come in a turn, a step only
+        # queues for the LLM as long as the turn can still finish in time
+        self.llm_call_reserve = llm_call_reserve
+
+        # the models can be injected, e.g. the benchmarks use local stubs; anything else is created by `load`
+        self.embed_batch_size = embed_batch_size
+        self.embed_backend = embed_backend
+        self.embed_threads = embed_threads
+        self.embed_model, self.reranker, self.llm = embed_model, reranker, llm
+        self.search_index, self.retriever, self.sparse_index = None, None, None
+        self._batch_colbert = False
+        # component -> seconds it took to load, filled in by `load`
+        self.loaded_components = {}
+        self.load_error = None
+        self._load_lock = threading.Lock()
+        self.node_processor = SimilarityPostprocessor(similarity_cutoff=0.6)
+        # query embedding and ColBERT reranking run on their own threads, concurrent requests are batched together
+        self.embed_worker = BatchWorker(
+            lambda queries: [self.embed_model.get_query_embedding(query) for query in queries],
+            num_threads=model_threads, max_queue_size=model_queue_size, name="embed-worker",
+        )
+        self.rerank_worker = BatchWorker(
+            self._rerank_batch,
+            num_threads=model_threads, max_queue_size=model_queue_size, max_batch_weight=max_rerank_batch_pairs,
+            weight_fn=lambda request: len(request[1]), name="rerank-worker",
+        )
+        if not lazy_load:
+            self.load()
+
+    COMPONENTS = ("embed_model", "index", "reranker", "llm")
+
+    @property
+    def ready(self):
+        return all(name in self.loaded_components for name in self.COMPONENTS)
+
+    def readiness(self):
+        return {
+            "ready": self.ready,
+            "components": {name: name in self.loaded_components for name in self.COMPONENTS},
+            "load_seconds": dict(self.loaded_components),
+            "error": self.load_error,
+        }
+
+    def load(self, warm_up: bool = True):
+        """
+        Loads the models and the index, once; later calls return when the first one finished.
+
+        Runs in the constructor unless `lazy_load` is set, in which case the caller runs it, e.g. on
+        a background thread while the server already answers. ColBERT loads on its own thread while
+        the embedding model and the index are loaded.
+
+        Args:
+            warm_up (bool): Run one query through the embedding model and the reranker, so the first
+                user does not pay for their first forward pass.
+        """
+        with self._load_lock:
+            if self.ready:
+                return
+            try:
+                with ThreadPoolExecutor(max_workers=1, thread_name_prefix="reranker-loader") as executor:
+                    reranker_loaded = executor.submit(self._load_component, "reranker", self._load_reranker)
+                    self._load_component("embed_model", self._load_embed_model)
+                    self._load_component("index", self._load_index)
+                    self._load_component("llm", self._load_llm)
+                    reranker_loaded.result()
+            except Exception as e:
+                self.load_error = f"{type(e).__name__}: {e}"
+                raise
+        if self.read_only:
+            self._reloader = threading.Thread(target=self._reload_loop, name="index-reloader", daemon=True)
+            self._reloader.start()
+        if warm_up:
+            self._warm_up()
 
-        self.embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-base-en-v1.5")
+    def _load_component(self, name, load_fn):
+        if name in self.loaded_components:
+            return
+        start = time.perf_counter()
+        load_fn()
+        self.loaded_components[name] = time.perf_counter() - start
+        print(f"Loaded {name} in {self.loaded_components[name]:.2f}s")
+
+    def _load_embed_model(self):
+        if self.embed_model is None:
+            self.embed_model = load_embed_model(self.embed_backend, embed_batch_size=self.embed_batch_size,
+                                                num_threads=self.embed_threads, cache_dir=os.path.join(self.tmp_dir, "models"))
         Settings.embed_model = self.embed_model
+
+    def _load_index(self):
+        # maintained in both retrieval modes, so switching to hybrid never finds it stale
+        self.sparse_index = BM25Index(os.path.join(self.index_persisted_dir, "bm25.jsonl"), read_only=self.read_only)
         self.search_index = self._load_or_create_index()
-        self.retriever = self.search_index.as_retriever(similarity_top_k=self.k)
-        self.reranker = ColbertRerank(top_n=5)
-        self.node_processor = SimilarityPostprocessor(similarity_cutoff=0.6)
-        self.llm = Ollama(model="llama3.2:1b", request_timeout=60.0)
+        if not self.read_only and self.manifest.version < MANIFEST_VERSION:
+            self._upgrade_index()
+        # as_retriever() would pin the node ids present at startup, hiding documents appended later
+        self.retriever = VectorIndexRetriever(self.search_index, similarity_top_k=self.dense_top_k)
+
+    def _upgrade_index(self):
+        """
+        Migrates an index written by an earlier version, without embedding anything again: nodes get
+        the category of their file, which scoped searches filter on, and copies of files, which used to
+        share the nodes of the file they copy, get nodes of their own.
+        """
+        if self.vector_store is not None:
+            node_ids = self.vector_store.node_ids()
+        else:
+            node_ids = list(self.search_index.docstore.docs)
+        num_tagged = 0
+        for start in range(0, len(node_ids), self.build_batch_size):
+            untagged = [node.node_id for node in self._get_nodes(node_ids[start:start + self.build_batch_size])
+                        if 'category' not in node.metadata]
+            if not untagged:
+                continue
+            nodes = self._get_embedded_nodes(untagged)
+            for node in nodes:
+                node.metadata['category'] = self.category_of(node.metadata['file_path'])
+                self._hide_category(node)
+            with self._index_lock:
+                # same ids, the rows are replaced
+                self.search_index.delete_nodes(untagged, delete_from_docstore=True)
+                self.sparse_index.delete(untagged)
+                self.search_index.insert_nodes(nodes)
+                self.sparse_index.add(nodes, self._sparse_text)
+            num_tagged += len(nodes)
+        if num_tagged:
+            print(f"Tagged {num_tagged} nodes with the category of their file.")
+            if self.vector_store is None:
+                self._compact_index()
+
+        # the manifest no longer takes these for indexed, see DocumentManifest.find_indexed_copy
+        legacy_copies = [file_path for file_path, entry in self.manifest.files.items()
+                         if entry["duplicate_of"] is not None and not entry["pages"]]
+        for file_path in legacy_copies:
+            if os.path.exists(file_path):
+                print(f"Indexing {file_path}, a copy that had no nodes of its own...")
+                self._append(parse_file(file_path))
+        self.manifest.upgrade(forget=[file_path for file_path in legacy_copies if not os.path.exists(file_path)])
+
+    def _load_reranker(self):
+        from llama_index.postprocessor.colbert_rerank import ColbertRerank
+        if self.reranker is None:
+            self.reranker = ColbertRerank(top_n=5)
+        self._batch_colbert = isinstance(self.reranker, ColbertRerank)
+
+    def _load_llm(self):
+        if self.llm is None:
+            self.llm = Ollama(model="llama3.2:1b", request_timeout=60.0)
         Settings.llm = self.llm
-        
+
+    def _warm_up(self):
+        start = time.perf_counter()
+        try:
+            self.embed_model.get_query_embedding("warm up")
+            self._rerank_batch([("warm up", [NodeWithScore(node=TextNode(text="warm up"), score=1.0)])])
+        except Exception as e:
+            print(f"Model warm-up failed: {e}")
+            return
+        print(f"Warmed up the models in {time.perf_counter() - start:.2f}s")
+
+    def _rerank_batch(self, requests):
+        if self._batch_colbert:
+            return colbert_rerank_batch(self.reranker, requests)
+        return [self.reranker.postprocess_nodes(nodes, query_str=query_str) for query_str, nodes in requests]
+
+    def category_of(self, file_path):
+        """The category folder of a file under data_dir, None for files directly in data_dir."""
+        parts = os.path.normpath(os.path.relpath(file_path, self.data_dir)).split(os.sep)
+        return parts[0] if len(parts) > 1 and parts[0] != os.pardir else None
+
+    def _annotate_documents(self, documents: List[Document]):
+        # create a page index for each document (cannot rely on 'page_label' as it is not unique)
+        page_num_tracker = defaultdict(int)
+        for doc in documents:
+            key = doc.metadata['file_path']
+            # pages extracted one by one already know their index
+            if 'page_index' not in doc.metadata:
+                doc.metadata['page_index'] = page_num_tracker[key]
+                page_num_tracker[key] += 1
+            doc.metadata['category'] = self.category_of(key)
+            self._hide_category(doc)
+
+    @staticmethod
+    def _hide_category(node):
+        # the category partitions the index, it is not part of the text the models see
+        for excluded_keys in (node.excluded_embed_metadata_keys, node.excluded_llm_metadata_keys):
+            if 'category' not in excluded_keys:
+                excluded_keys.append('category')
+
+    def _diff_documents(self, documents: List[Document]):
+        """
+        Checks the documents' files against the manifest.
+
+        Returns:
+            tuple: Pages that are new or changed, ids of the nodes they supersede, the manifest entries to
+            record, and the pages of files that copy another indexed file (see `_copy_nodes`).
+        """
+        self._annotate_documents(documents)
+        documents_by_file = defaultdict(list)
+        for doc in documents:
+            documents_by_file[doc.metadata['file_path']].append(doc)
+        changed, stale_node_ids, entries, copies = [], [], {}, []
+        for file_path, file_documents in documents_by_file.items():
+            file_changed, file_stale, entry = self.manifest.diff(file_path, file_documents, pending=entries)
+            if entry is None:
+                print(f"Skipping {file_path}, already indexed.")
+                continue
+            if entry["duplicate_of"] is not None:
+                print(f"Copying the nodes of {entry['duplicate_of']} for {file_path}, same content.")
+                copies.extend(file_documents)
+            changed.extend(file_changed)
+            stale_node_ids.extend(file_stale)
+            entries[file_path] = entry
+        return changed, stale_node_ids, entries, copies
+
+    def _get_embedded_nodes(self, node_ids, search_index=None):
+        """Copies of stored nodes with their embeddings, which can be modified and inserted."""
+        search_index = search_index or self.search_index
+        if self.vector_store is not None:
+            nodes = self.vector_store.get_nodes(node_ids)
+            embeddings = self.vector_store.get_embeddings([node.node_id for node in nodes])
+        else:
+            nodes = [node for node in search_index.docstore.get_nodes(node_ids, raise_error=False) if node is not None]
+            embeddings = [search_index.vector_store.get(node.node_id) for node in nodes]
+        copies = []
+        for node, embedding in zip(nodes, embeddings):
+            node = node.model_copy(deep=True)
+            node.embedding = [float(value) for value in embedding]
+            copies.append(node)
+        return copies
+
+    def _copy_nodes(self, copies, entries, nodes, search_index=None):
+        """
+        Nodes of the pages of copied files, made from the nodes of the same pages of the file they copy.
+
+        The embeddings are reused, the metadata (path, name, category) is the copy's, so a copy is found
+        in its own category and stays indexed when the file it copies changes or is removed.
+
+        Args:
+            copies (list): Pages of the files whose entry has `duplicate_of`, as returned by `_diff_documents`.
+            entries (dict): The manifest entries of the batch.
+            nodes (list): Nodes embedded in the batch, the copied file may be one of its files.
+        """
+        new_nodes = defaultdict(list)
+        for node in nodes:
+            new_nodes[(node.metadata['file_path'], node.metadata['page_index'])].append(node)
+        copied = []
+        for doc in copies:
+            entry = entries[doc.metadata['file_path']]
+            original, page_index = entry['duplicate_of'], doc.metadata['page_index']
+            indexed = self.manifest.files.get(original)
+            if indexed is not None and indexed['sha256'] == entry['sha256']:
+                # the nodes of this content are in the index, even if the batch is about to replace them
+                source_pages, source = indexed['pages'], []
+            else:
+                # the copied file is indexed in this batch, its unchanged pages keep their nodes
+                source_pages, source = entries[original]['pages'], new_nodes.get((original, page_index), [])
+            if not source and page_index < len(source_pages):
+                source = self._get_embedded_nodes(source_pages[page_index]['node_ids'], search_index)
+            for node in source:
+                node = node.model_copy(deep=True)
+                node.id_ = str(uuid.uuid4())
+                node.metadata.update(doc.metadata)
+                node.relationships = {NodeRelationship.SOURCE: doc.as_related_node_info()}
+                self._hide_category(node)
+                copied.append(node)
+        return copied
+
+    def _embed_documents(self, documents: List[Document], embedded_nodes: Optional[List[TextNode]] = None):
+        """Splits page documents into chunk nodes and embeds them in batches, reusing `embedded_nodes` of the same pages."""
+        embedded = defaultdict(list)
+        for node in embedded_nodes or []:
+            embedded[node.ref_doc_id].append(node)
+        nodes = [node for doc in documents for node in embedded.get(doc.doc_id, [])]
+        documents = [doc for doc in documents if doc.doc_id not in embedded]
+        if not documents:
+            return nodes
+        # Split all pages first so they are embedded in batches instead of one page at a time
+        transformations = [self.node_parser] if self.node_parser is not None else Settings.transformations
+        new_nodes = run_transformations(documents, transformations)
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in new_nodes]
+        embeddings = self.embed_model.get_text_embedding_batch(texts, show_progress=True)
+        for node, embedding in zip(new_nodes, embeddings):
+            node.embedding = embedding
+        return nodes + new_nodes
+
+    def embed_pages(self, documents: List[Document]):
+        """
+        Embeds pages ahead of `append_index`, e.g. while the rest of their file is still being parsed.
+
+        Pages whose text is already indexed for the same file and page are skipped.
+
+        Returns:
+            list: The embedded nodes, to pass to `append_index` along with all the pages of their files.
+        """
+        if self.read_only:
+            raise RuntimeError("This agent maps the index read-only, uploads are applied by the writer process")
+        self.load()
+        self._annotate_documents(documents)
+        with self._index_lock:
+            documents = [doc for doc in documents if not self.manifest.is_indexed_page(
+                doc.metadata['file_path'], doc.metadata['page_index'], doc.text)]
+        return self._embed_documents(documents)
+
+    @staticmethod
+    def _sparse_text(node):
+        # the same text the embedding model sees, file names included
+        return node.get_content(metadata_mode=MetadataMode.EMBED)
+
+    def _backfill_sparse_index(self, search_index):
+        """Builds the inverted index of an index created before it existed."""
+        if self.read_only or len(self.sparse_index) > 0:
+            return
+        if self.vector_store is not None:
+            nodes = self.vector_store.get_nodes()
+        else:
+            nodes = list(search_index.docstore.docs.values())
+        if nodes:
+            print(f"Building the BM25 index of {len(nodes)} nodes...")
+            self.sparse_index.add(nodes, self._sparse_text)
+
+    def _build_index(self, search_index):
+        """Indexes the data directory shard by shard, skipping the files of shards completed by an earlier run."""
+        if not self.build_state.in_progress:
+            self.build_state.start()
+            # terms of a previous index would point at nodes that no longer exist
+            self.sparse_index.clear()
+            # nothing to migrate in an index built from scratch
+            self.manifest.upgrade()
+        else:
+            # drop the terms of a shard that was being written when the previous build stopped
+            self.sparse_index.retain_ref_docs(self.build_state.committed_doc_ids())
+        file_paths = [path for path in list_input_files(self.data_dir) if path not in self.build_state.completed]
+        print(f"Indexing {len(file_paths)} files ({len(self.build_state.completed)} already indexed)...")
+        # the manifest must not claim files of a shard that never completed
+        self.manifest.retain(self.build_state.completed)
+        for documents_by_file in iter_parsed_batches(file_paths, self.build_workers, self.build_batch_size):
+            # copies of files indexed earlier in the build are not embedded again
+            documents, _, entries, copies = self._diff_documents(
+                [doc for docs in documents_by_file.values() for doc in docs])
+            # parser processes keep working on the next files while this shard is embedded
+            nodes = self._embed_documents(documents)
+            nodes += self._copy_nodes(copies, entries, nodes, search_index)
+            search_index.insert_nodes(nodes)
+            self.sparse_index.add(nodes, self._sparse_text)
+            if self.vector_store is None:
+                for doc in documents + copies:
+                    search_index.docstore.set_document_hash(doc.get_doc_id(), doc.hash)
+                self.segment_log.append(nodes)
+            self.manifest.update(entries, nodes)
+            # a shard counts as done only once its nodes are on disk
+            self.build_state.mark_completed(documents_by_file)
+        failed = [path for path in file_paths if path not in self.build_state.completed]
+        if failed:
+            # left out of the build state, so an interrupted build tries them again
+            print(f"{len(failed)} files could not be parsed and are not indexed, upload them again once fixed: "
+                  f"{', '.join(failed)}")
+
+    def _migrate_simple_index(self, search_index):
+        """Copies the nodes of an index built with the "simple" backend into the NumPy store, embeddings included."""
+        storage_context = StorageContext.from_defaults(persist_dir=self.index_persisted_dir)
+        embeddings = storage_context.vector_store.data.embedding_dict
+        nodes = {}
+        for node in storage_context.docstore.docs.values():
+            # the docstore also holds document hashes, only nodes have an embedding
+            if node.node_id in embeddings:
+                node.embedding = embeddings[node.node_id]
+                nodes[node.node_id] = node
+        # nodes appended after the last compaction of the simple index
+        nodes.update((node.node_id, node) for node in self.segment_log.iter_nodes())
+        print(f"Migrating {len(nodes)} nodes of the simple index in {self.index_persisted_dir} to the NumPy store...")
+        nodes = list(nodes.values())
+        for start in range(0, len(nodes), self.build_batch_size):
+            search_index.insert_nodes(nodes[start:start + self.build_batch_size])
+        # the simple index files are left in place, vector_store="simple" still loads them
+        print("Migration done, the simple index files are no longer used.")
+
+    def _load_or_create_numpy_index(self):
+        self.vector_store = NumpyVectorStore(os.path.join(self.index_persisted_dir, "numpy_store"), dtype=self.vector_dtype,
+                                             read_only=self.read_only, ann=self.ann, ivf_probes=self.ann_probes)
+        search_index = VectorStoreIndex.from_vector_store(self.vector_store, embed_model=self.embed_model)
+        if self.read_only:
+            # the writer builds the index, its rows show up with the next reload
+            print(f"Mapping index read-only ({self.vector_store.num_rows} nodes)...")
+            return search_index
+        if self.vector_store.num_rows > 0 and not self.build_state.in_progress:
+            print("Loading index from storage...")
+            self._backfill_sparse_index(search_index)
+            return search_index
+        if os.path.exists(os.path.join(self.index_persisted_dir, 'index_store.json')) and not self.build_state.in_progress:
+            self._migrate_simple_index(search_index)
+            self._backfill_sparse_index(search_index)
+            return search_index
+        if self.build_state.in_progress:
+            # drop rows of a shard that was being written when the previous build stopped
+            committed = self.build_state.committed_doc_ids()
+            self.vector_store.delete_ref_docs(self.vector_store.ref_doc_ids() - committed)
+            print(f"Resuming index build after {len(self.build_state.completed)} files...")
+        # the store writes its own files as nodes are added, no persist() needed
+        self._build_index(search_index)
+        self.build_state.finish()
+        return search_index
 
     def _load_or_create_index(self):
+        if self.vector_store_backend == "numpy":
+            return self._load_or_create_numpy_index()
         # indexing if needed
-        if os.path.exists(os.path.join(self.index_persisted_dir,  'index_store.json')):
+        if os.path.exists(os.path.join(self.index_persisted_dir,  'index_store.json')) and not self.build_state.in_progress:
             print("Loading index from storage...")
             storage_context = StorageContext.from_defaults(persist_dir=self.index_persisted_dir)
             # load index
             search_index = load_index_from_storage(storage_context)
+            # replay nodes appended since the last compaction, their embeddings are stored so nothing is re-embedded
+            segment_nodes = list(self.segment_log.iter_nodes())
+            if segment_nodes:
+                print(f"Replaying {len(segment_nodes)} nodes from {len(self.segment_log)} index segments...")
+                search_index.insert_nodes(segment_nodes)
+            self._backfill_sparse_index(search_index)
         else:
             # Create
-            print("Indexing documents...")
-            documents = SimpleDirectoryReader(self.data_dir, recursive=True).load_data(show_progress=True, num_workers=1)
-            # create a page index for each document (cannot rely on 'page_label' as it is not unique)
-            page_num_tracker = defaultdict(int)
-            for doc in documents:
-                key = doc.metadata['file_path']
-                doc.metadata['page_index'] = page_num_tracker[key]
-                page_num_tracker[key] += 1  
-            search_index = VectorStoreIndex.from_documents(documents, embed_model=self.embed_model)
+            search_index = VectorStoreIndex(nodes=[], embed_model=self.embed_model)
+            if self.build_state.in_progress:
+                # the segments hold the shards of the interrupted build, minus a shard written after the last commit
+                committed = self.build_state.committed_doc_ids()
+                segment_nodes = [node for node in self.segment_log.iter_nodes() if node.ref_doc_id in committed]
+                print(f"Resuming index build, replaying {len(segment_nodes)} nodes of {len(self.build_state.completed)} files...")
+                search_index.insert_nodes(segment_nodes)
+            else:
+                # segments left over from a previous index would duplicate its nodes
+                self.segment_log.clear()
+            self._build_index(search_index)
             # store it for later
             search_index.storage_context.persist(persist_dir=self.index_persisted_dir)
+            self.build_state.finish()
+            self.segment_log.clear()
 
         return search_index
 
@@ -92,49 +603,180 @@ class RAGAgent(Workflow):
         chat_history = ev.chat_history
         user_id = ev.user_id
         await ctx.set("query_str", query_str)
+        # the prompt size must not grow with the length of the conversation
+        chat_history = window_history(chat_history, self.history_tokens, self.history_summary_tokens)
         await ctx.set("chat_history", chat_history)
         await ctx.set("user_id", user_id)
+        await ctx.set("retrieval_id", ev.get("retrieval_id") or uuid.uuid4().hex)
+        # optional category folder the search is restricted to
+        category = ev.get("category") or None
+        await ctx.set("category", category)
+        timings = {}
+        await ctx.set("timings", timings)
+        start = time.perf_counter()
+        await ctx.set("start_time", start)
         formated_query = ""
-        if len(chat_history) > 0:
+        if len(chat_history) == 0:
+            condensed_query = query_str
+        elif self.skip_condensation and is_self_contained(query_str):
+            # the question does not refer back to the conversation, no need to rewrite it
+            timings["condensation_skipped"] = True
+            condensed_query = query_str
+        else:
             chat_history_str = convert_message_list_to_str(chat_history)
             formated_query = self.SUMMARY_TEMPLATE.format(chat_history_str=chat_history_str, query_str=query_str)
             # print('Formated Query:', formated_query)
-            history_summary = await self.llm.acomplete(formated_query)
+            if self.speculative_retrieval:
+                # retrieve with the raw question while the LLM rewrites it
+                speculative_task = asyncio.create_task(self._retrieve_nodes(query_str, category=category))
+            try:
+                async with self.llm_scheduler.slot(user_id, self._llm_wait_budget(start, calls_left=2)):
+                    history_summary = await self.llm.acomplete(formated_query)
+            except BaseException:
+                # rejected or failed, nobody will await the speculative retrieval
+                if self.speculative_retrieval:
+                    speculative_task.cancel()
+                raise
             condensed_query = "Context:\n" + history_summary.text + "\nQuestion: " + query_str
-        else:
-            condensed_query = query_str
+            self._record(timings, "condense", time.perf_counter() - start)
+            if self.speculative_retrieval:
+                nodes = await self._pick_speculative_nodes(query_str, condensed_query, speculative_task, timings, category)
+                return CondenseQueryEvent(condensed_query_str=condensed_query, nodes=nodes)
+        self._record(timings, "condense", time.perf_counter() - start)
         # print("Condense query:", condensed_query)
         return CondenseQueryEvent(condensed_query_str=condensed_query)
-    
+
+    async def _pick_speculative_nodes(self, query_str, condensed_query, speculative_task, timings, category=None):
+        """Returns the nodes retrieved for the raw question if condensation did not change its meaning,
+        otherwise retrieves for the condensed query and keeps whichever result scored higher."""
+        start = time.perf_counter()
+        raw_embedding, condensed_embedding = await asyncio.gather(
+            self._embed_query(query_str), self._embed_query(condensed_query)
+        )
+        raw_embedding, condensed_embedding = np.asarray(raw_embedding), np.asarray(condensed_embedding)
+        similarity = float(raw_embedding @ condensed_embedding / (
+            np.linalg.norm(raw_embedding) * np.linalg.norm(condensed_embedding) + 1e-12))
+        raw_nodes = await speculative_task
+        if similarity >= self.speculative_similarity:
+            timings["speculative_used"] = True
+        else:
+            condensed_nodes = await self._retrieve_nodes(condensed_query, timings, category)
+            best_raw = max((node.score or 0.0 for node in raw_nodes), default=float("-inf"))
+            best_condensed = max((node.score or 0.0 for node in condensed_nodes), default=float("-inf"))
+            timings["speculative_used"] = best_raw > best_condensed
+            raw_nodes = raw_nodes if best_raw > best_condensed else condensed_nodes
+        self._record(timings, "retrieve", time.perf_counter() - start)
+        return raw_nodes
+
+    def _llm_wait_budget(self, turn_start, calls_left):
+        """Seconds a step may wait for an LLM slot so the turn, with `calls_left` LLM calls, ends within the timeout."""
+        if self._timeout is None:
+            return None
+        return self._timeout - (time.perf_counter() - turn_start) - calls_left * self.llm_call_reserve
+
+    @staticmethod
+    def _record(timings, name, seconds):
+        if timings is not None:
+            timings[name] = seconds
+        STEP_LATENCY.observe(seconds, step=name)
+
+    async def _embed_query(self, query_str):
+        normalized_query = normalize_query(query_str)
+        # the query embedding does not depend on the index, so it survives index updates
+        query_embedding = self.query_embedding_cache.get(normalized_query)
+        if query_embedding is None:
+            query_embedding = await self.embed_worker.submit(query_str)
+            self.query_embedding_cache.put(normalized_query, query_embedding)
+        return query_embedding
+
+    def _retriever_for(self, category):
+        if category is None:
+            return self.retriever
+        # the NumPy store only scans the rows of this category
+        filters = MetadataFilters(filters=[MetadataFilter(key="category", value=category)])
+        return VectorIndexRetriever(self.search_index, similarity_top_k=self.dense_top_k, filters=filters)
+
+    def _get_nodes(self, node_ids):
+        if self.vector_store is not None:
+            return self.vector_store.get_nodes(node_ids)
+        nodes = self.search_index.docstore.get_nodes(node_ids, raise_error=False)
+        return [node for node in nodes if node is not None]
+
+    def _fuse(self, dense_nodes, sparse_hits):
+        """Reciprocal-rank fusion of the dense and BM25 rankings, merged by page and cut to the rerank budget."""
+        by_id = {node.node.node_id: node.node for node in dense_nodes}
+        fused = reciprocal_rank_fusion(
+            [[node.node.node_id for node in dense_nodes], [node_id for node_id, _ in sparse_hits]], k=self.rrf_k
+        )
+        # nodes found by BM25 only; ids deleted since the search are simply dropped
+        missing = [node_id for node_id, _ in fused if node_id not in by_id]
+        if missing:
+            by_id.update((node.node_id, node) for node in self._get_nodes(missing))
+        nodes = [NodeWithScore(node=by_id[node_id], score=score) for node_id, score in fused if node_id in by_id]
+        # the budget counts pages, several chunks of one page are reranked as one passage
+        return merge_page_nodes(nodes)[:self.rerank_candidates]
+
+    async def _retrieve_nodes(self, query_str, timings=None, category=None):
+        cache_key = (self.index_version, category, normalize_query(query_str))
+        nodes = self.retrieval_cache.get(cache_key)
+        if nodes is None:
+            start = time.perf_counter()
+            query_embedding = await self._embed_query(query_str)
+            self._record(timings, "embed", time.perf_counter() - start)
+            start = time.perf_counter()
+            dense_search = self._retriever_for(category).aretrieve(QueryBundle(query_str=query_str, embedding=query_embedding))
+            if self.retrieval_mode == "hybrid":
+                nodes, sparse_hits = await asyncio.gather(
+                    dense_search,
+                    asyncio.to_thread(self.sparse_index.search, query_str, self.hybrid_candidates, category),
+                )
+                self._record(timings, "vector_search", time.perf_counter() - start)
+                start = time.perf_counter()
+                nodes = self._fuse(nodes, sparse_hits)
+                self._record(timings, "fusion", time.perf_counter() - start)
+            else:
+                nodes = merge_page_nodes(await dense_search)
+                self._record(timings, "vector_search", time.perf_counter() - start)
+            # rerank the nodes
+            start = time.perf_counter()
+            nodes = await self.rerank_worker.submit((query_str, nodes))
+            self._record(timings, "rerank", time.perf_counter() - start)
+            # for node in nodes:
+            #     print(node)
+            nodes = self.node_processor.postprocess_nodes(nodes)
+            self.retrieval_cache.put(cache_key, nodes)
+        return nodes
+
     @step
     async def retrieve(self, ctx: Context, ev: CondenseQueryEvent) -> RetrievalEvent:
         # retrieve from context
         # query_str = await ctx.get("query_str")
-        condensed_query_str = ev.condensed_query_str
-        nodes = await self.retriever.aretrieve(condensed_query_str)
-        # rerank the nodes
-        nodes = self.reranker.postprocess_nodes(nodes=nodes, query_str=condensed_query_str)
-        # for node in nodes:
-        #     print(node)
-        nodes = self.node_processor.postprocess_nodes(nodes)
+        timings = await ctx.get("timings")
+        nodes = ev.nodes
+        if nodes is None:
+            start = time.perf_counter()
+            nodes = await self._retrieve_nodes(ev.condensed_query_str, timings, await ctx.get("category"))
+            self._record(timings, "retrieve", time.perf_counter() - start)
         user_id = await ctx.get("user_id")
         print("user_id:", user_id)
-        self.save_retrieved_pdf_data(nodes, user_id)
+        self.record_retrieval(await ctx.get("retrieval_id"), nodes)
         return RetrievalEvent(nodes=nodes)
     
     def _prepare_query_with_context(
         self,
         query_str: str,
         nodes: List[NodeWithScore],
+        timings: Optional[dict] = None,
     ) -> str:
-        node_context = ""
-
         if len(nodes) == 0:
             return query_str
-        
-        for idx, node in enumerate(nodes):
-            node_text = node.get_content(metadata_mode="llm")
-            node_context += f"\n{node_text}\n\n"
+
+        pages = [(node.node.get_metadata_str(mode=MetadataMode.LLM), node.node.get_content(metadata_mode=MetadataMode.NONE))
+                 for node in nodes]
+        node_context, stats = pack_context(query_str, pages, max_tokens=self.context_tokens,
+                                           passage_tokens=self.passage_tokens)
+        if timings is not None:
+            timings.update(stats)
 
         formatted_query = self.CONTEXT_PROMPT_TEMPLATE.format(
             node_context=node_context, query_str=query_str
@@ -146,57 +788,208 @@ class RAGAgent(Workflow):
     async def llm_response(self,  ctx: Context, retrieval_ev: RetrievalEvent) -> StopEvent:
         nodes = retrieval_ev.nodes
         query_str = await ctx.get("query_str")
-        query_with_ctx = self._prepare_query_with_context(query_str, nodes)
+        timings = await ctx.get("timings")
+        request_start = await ctx.get("start_time")
+        user_id = await ctx.get("user_id")
         chat_history = await ctx.get("chat_history")
-        response = await self.llm.astream_chat(chat_history + [ChatMessage(role=MessageRole.USER, content=query_with_ctx)])
-        
-        async def response_gen():
-            async for chunk in response:
-                yield chunk.delta
-                
-        chat_history.append(ChatMessage(role=MessageRole.USER, content=query_str))
-        
-        return StopEvent(result=response_gen())
+        answer_key = None
+        if self.answer_cache is not None and (not chat_history or timings.get("condensation_skipped")):
+            # the question stands on its own, so the answer only depends on it and on the retrieved nodes
+            answer_key = (await self._embed_query(query_str), [node.node.node_id for node in nodes])
+            answer = self.answer_cache.get(*answer_key)
+            if answer is not None:
+                timings["answer_cached"] = True
+
+                async def replay():
+                    for delta in answer:
+                        yield delta
+
+                return StopEvent(result=self._stream_response(replay(), user_id, timings, request_start))
+
+        start = time.perf_counter()
+        await self.llm_scheduler.acquire(user_id, self._llm_wait_budget(request_start, calls_left=1))
+        self._record(timings, "llm_queue", time.perf_counter() - start)
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.llm_scheduler.release()
+
+        start = time.perf_counter()
+        try:
+            query_with_ctx = self._prepare_query_with_context(query_str, nodes, timings)
+            messages = chat_history + [ChatMessage(role=MessageRole.USER, content=query_with_ctx)]
+            timings["prompt_tokens"] = sum(estimate_tokens(message.content or "") for message in messages)
+            PROMPT_TOKENS.observe(timings["prompt_tokens"])
+            response = await self.llm.astream_chat(messages)
+        except BaseException:
+            release()
+            raise
+        self._record(timings, "llm_request", time.perf_counter() - start)
+
+        async def generate():
+            try:
+                async for chunk in response:
+                    yield chunk.delta
+            finally:
+                # the slot is held until the stream ends or the client goes away
+                release()
+
+        generator = self._stream_response(generate(), user_id, timings, request_start, answer_key)
+        # a stream that is dropped before anyone iterates it never runs its finally block
+        finalizer = weakref.finalize(generator, asyncio.get_running_loop().call_soon_threadsafe, release)
+        finalizer.atexit = False
+        return StopEvent(result=generator)
+
+    async def _stream_response(self, deltas, user_id, timings, request_start, answer_key=None):
+        """Streams generated or cached deltas to the client, records the timings, caches a complete answer."""
+        first_token_time = None
+        answer = []
+        # replayed answers would skew the latency and throughput of the LLM, they are only traced
+        generated = not timings.get("answer_cached")
+        try:
+            async for delta in deltas:
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+                    timings["time_to_first_token"] = first_token_time - request_start
+                    if generated:
+                        TIME_TO_FIRST_TOKEN.observe(timings["time_to_first_token"])
+                answer.append(delta)
+                yield delta
+        finally:
+            await deltas.aclose()
+        if answer_key is not None and answer:
+            self.answer_cache.put(*answer_key, answer)
+        if first_token_time is not None:
+            generation_time = time.perf_counter() - first_token_time
+            self._record(timings, "generation", generation_time)
+            if generation_time > 0:
+                timings["tokens_per_second"] = len(answer) / generation_time
+                if generated:
+                    TOKENS_PER_SECOND.observe(timings["tokens_per_second"])
+        timings["total"] = time.perf_counter() - request_start
+        CHAT_TURNS.inc()
+        self._write_trace(user_id, timings)
     
-    def save_retrieved_pdf_data(self, retrieved_nodes, user_id):
-        if len(retrieved_nodes) == 0:
+    def _write_trace(self, user_id, timings):
+        timings = {name: round(value, 4) if isinstance(value, float) else value for name, value in timings.items()}
+        if self._verbose:
+            print("Step timings:", timings)
+        if self.trace_log_path is None:
+            return
+        with open(self.trace_log_path, "a") as f:
+            f.write(json.dumps({"time": time.time(), "user_id": user_id, "timings": timings}) + "\n")
+
+    def record_retrieval(self, retrieval_id, retrieved_nodes):
+        """Keeps the pages retrieved in one turn under `retrieval_id` and extracts them in the background."""
+        pages = unique_pages(retrieved_nodes)
+        if len(pages) == 0:
             print("No relevant documents found.")
+        self.retrievals.put(retrieval_id, pages)
+        self.page_extractor.submit_prefetch([(file_path, page_index) for file_path, page_index, _ in pages])
+        return pages
+
+    def _reload_loop(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                self.reload_index()
+            except Exception as e:
+                print(f"Failed to reload the index: {e}")
+
+    def reload_index(self):
+        """Picks up the nodes the writer process added or deleted since the last reload."""
+        changed = self.vector_store.refresh()
+        # after the vectors, so BM25 hits refer to rows already mapped
+        if self.sparse_index.refresh() or changed:
+            self.index_version += 1
+            print(f"Reloaded index ({self.vector_store.num_rows} nodes, {self.vector_store.generation})")
+
+    def append_index(self, documents: List[Document], embedded_nodes: Optional[List[TextNode]] = None):
+        """
+        Indexes the pages of new or modified files, replacing what was indexed for them.
+
+        Args:
+            documents (list): All the pages of the files.
+            embedded_nodes (list): Nodes of some of the pages already returned by `embed_pages`.
+        """
+        if self.read_only:
+            raise RuntimeError("This agent maps the index read-only, uploads are applied by the writer process")
+        # uploads that arrive during a lazy startup wait for the index
+        self.load()
+        self._append(documents, embedded_nodes)
+
+    def _append(self, documents, embedded_nodes=None):
+        documents, stale_node_ids, entries, copies = self._diff_documents(documents)
+        if not documents and not stale_node_ids and not copies:
+            # nothing to index, e.g. copies of empty files
+            if entries:
+                with self._index_lock:
+                    self.manifest.update(entries, [])
             return
-        retrieved_pdf_data = defaultdict(list)
-        for node in retrieved_nodes:
-            # print(node)
-            pdf_file_path = node.metadata['file_path'] 
-            page_num = int(node.metadata['page_index'])
-            retrieved_pdf_data[pdf_file_path].append(page_num)
+        nodes = self._embed_documents(documents, embedded_nodes)
 
-        # Save the new PDF to the specified path
-        new_document = read_and_concat_pdf(retrieved_pdf_data)
+        with self._index_lock:
+            # before the stale nodes are deleted, a copy may be made of them
+            nodes += self._copy_nodes(copies, entries, nodes)
+            if stale_node_ids:
+                # pages of a modified or replaced file
+                self.search_index.delete_nodes(stale_node_ids, delete_from_docstore=True)
+                self.sparse_index.delete(stale_node_ids)
+                if self.answer_cache is not None:
+                    self.answer_cache.invalidate_nodes(stale_node_ids)
+            self.search_index.insert_nodes(nodes)
+            self.sparse_index.add(nodes, self._sparse_text)
+            if self.sparse_index.should_compact():
+                self.sparse_index.compact()
+            self.index_version += 1
+            if self.vector_store is not None:
+                # the NumPy store already appended the new rows and tombstones to its files
+                if self.vector_store.should_compact(self.compact_every):
+                    self._compact_index()
+            else:
+                for doc in documents + copies:
+                    self.search_index.docstore.set_document_hash(doc.get_doc_id(), doc.hash)
+                if stale_node_ids:
+                    # segments cannot record deletions, the full storage has to be rewritten
+                    self._compact_index()
+                else:
+                    # only the new nodes are written, the full storage is rewritten once enough segments piled up
+                    self.segment_log.append(nodes)
+                    if len(self.segment_log) >= self.compact_every:
+                        self._compact_index()
+            # recorded last, so a crash above leaves the pages to be indexed again
+            self.manifest.update(entries, nodes)
 
-        new_document.save(f"{self.tmp_dir}/{user_id}_tmp_result.pdf")
+    def find_indexed_copy(self, file_path):
+        """Path of an indexed file with the same content as `file_path` (possibly itself), None if there is none."""
+        with self._index_lock:
+            return self.manifest.find_indexed_copy(file_path)
 
-        new_document.close()
+    def cache_stats(self):
+        return {
+            "index_version": self.index_version,
+            "query_embedding": self.query_embedding_cache.stats(),
+            "retrieval": self.retrieval_cache.stats(),
+            "retrievals": self.retrievals.stats(),
+            "answer": self.answer_cache.stats() if self.answer_cache is not None else None,
+            "llm_scheduler": self.llm_scheduler.stats(),
+        }
 
-    def append_index(self, documents: List[Document]):
-        page_num_tracker = defaultdict(int)
-        for doc in documents:
-            # Add new doc to the index
-            key = doc.metadata['file_path']
-            doc.metadata['page_index'] = page_num_tracker[key]
-            self.search_index.insert(doc) # Add the new document to the index
-            page_num_tracker[key] += 1  
-    
-        # Store the updated index ascynchronously
-        self.search_index.storage_context.persist(persist_dir=self.index_persisted_dir)
+    def compact_index(self):
+        self.load()
+        with self._index_lock:
+            self._compact_index()
 
+    def _compact_index(self):
+        if self.vector_store is not None:
+            print("Compacting vector store...")
+            self.vector_store.compact()
+            return
+        print(f"Compacting {len(self.segment_log)} index segments...")
+        self.search_index.storage_context.persist(persist_dir=self.index_persisted_dir)
+        # segments are dropped only after the full storage is on disk, replaying them again is harmless
+        self.segment_log.clear()
 
-class ChatHistories:
-    def __init__(self):
-        self.histories = {}
-    
-    def get_history(self, user_id):
-        if user_id not in self.histories:
-            self.histories[user_id] = []
-        return self.histories[user_id]
-    
-    def add_message(self, user_id, message, role):
-        self.histories[user_id].append(ChatMessage(role=role, content=message))
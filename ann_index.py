@@ -0,0 +1,105 @@
+import numpy as np
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class IVFIndex:
+    """
+    Inverted-file index for approximate search over L2-normalized embeddings.
+
+    Rows are clustered around `num_lists` centroids (spherical k-means on a sample). A query only
+    scores the rows of the lists whose centroids are closest to it, so its cost grows with
+    `num_probes / num_lists` of the corpus instead of all of it. New rows are assigned to the
+    nearest existing centroid; inserts never retrain.
+
+    Lists are replaced rather than modified, so queries can run while rows are added.
+
+    Args:
+        centroids (np.ndarray): (num_lists, dim) normalized centroids.
+        assignments (np.ndarray): Optional list of every row, rows are numbered from 0.
+        trained_rows (int): Number of rows the centroids were trained for.
+    """
+    def __init__(self, centroids, assignments=None, trained_rows=0):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.trained_rows = trained_rows
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(len(self.centroids))]
+        self.assignments = np.empty(0, dtype=np.int32)
+        if assignments is not None:
+            self.extend(assignments, 0)
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    @property
+    def num_rows(self):
+        return len(self.assignments)
+
+    @classmethod
+    def train(cls, sample, num_lists, iterations=10, seed=0, block_size=65536):
+        """
+        Clusters a sample of normalized embeddings with spherical k-means.
+
+        Args:
+            sample (np.ndarray): (n, dim) float32 embeddings, a few dozen per list is enough.
+            num_lists (int): Number of clusters, capped at the sample size.
+            iterations (int): k-means iterations.
+
+        Returns:
+            IVFIndex: An index without rows.
+        """
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(sample, dtype=np.float32)
+        num_lists = max(1, min(num_lists, len(sample)))
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)].copy()
+        for _ in range(iterations):
+            labels = cls._nearest(centroids, sample, block_size)
+            order = np.argsort(labels, kind="stable")
+            counts = np.bincount(labels, minlength=num_lists)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            non_empty = counts > 0
+            sums = np.add.reduceat(sample[order], starts[non_empty], axis=0)
+            centroids[non_empty] = _normalize(sums)
+            # empty clusters restart from random points
+            num_empty = int((~non_empty).sum())
+            if num_empty:
+                centroids[~non_empty] = sample[rng.choice(len(sample), num_empty, replace=False)]
+        return cls(centroids, trained_rows=len(sample))
+
+    @staticmethod
+    def _nearest(centroids, vectors, block_size=65536):
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), block_size):
+            labels[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+        return labels
+
+    def assign(self, vectors, block_size=65536):
+        """Returns the list of each normalized float32 embedding."""
+        return self._nearest(self.centroids, np.asarray(vectors, dtype=np.float32), block_size)
+
+    def extend(self, assignments, start):
+        """Adds rows `start:start + len(assignments)` to their lists."""
+        if start != self.num_rows:
+            raise ValueError(f"IVFIndex holds {self.num_rows} rows, cannot append at row {start}")
+        assignments = np.asarray(assignments, dtype=np.int32)
+        if len(assignments) == 0:
+            return
+        order = np.argsort(assignments, kind="stable")
+        lists, first = np.unique(assignments[order], return_index=True)
+        for list_id, rows in zip(lists, np.split(order.astype(np.int64) + start, first[1:])):
+            self.lists[list_id] = np.concatenate([self.lists[list_id], rows])
+        self.assignments = np.concatenate([self.assignments, assignments])
+
+    def candidates(self, query, num_probes):
+        """
+        Returns:
+            np.ndarray: Sorted rows of the `num_probes` lists closest to the normalized `query`.
+        """
+        num_probes = min(num_probes, self.num_lists)
+        probes = np.argpartition(-(self.centroids @ query), num_probes - 1)[:num_probes]
+        rows = np.concatenate([self.lists[list_id] for list_id in probes])
+        rows.sort()
+        return rows
@@ -0,0 +1,174 @@
+"""
+Recall/latency benchmark of the IVF index of NumpyVectorStore against its exact search.
+
+For every corpus size a store is filled with embeddings, the IVF index is trained by opening it
+with ann="ivf", and the same queries are run through `NumpyVectorStore.query` exactly and with a
+range of `ivf_probes`. Recall@k is the overlap of the approximate top k with the exact top k.
+
+The embeddings are real ones from --embeddings (a .npy of shape (pages, dim), e.g. saved from the
+NumPy store; its last --queries rows are the queries), or synthetic. Synthetic pages are unit
+vectors that vary along a few dozen directions with decaying variance, as text embeddings do, plus
+isotropic noise and a direction shared by all pages. They form no separable clusters, so the
+neighbours of a query straddle IVF lists as they do with real data. The cosine similarities of
+random pairs and of the exact top 1 and top k are reported to compare against real embeddings
+(bge-base: about 0.3-0.4 for unrelated pages, 0.7-0.9 for the best match).
+
+    python benchmarks/bench_ann.py --sizes 10000,100000,1000000 --output bench_ann.json
+    python benchmarks/bench_ann.py --embeddings pages.npy --sizes 100000 --output bench_ann.json
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from common import environment, summarize, write_results
+
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+from vector_store import NumpyVectorStore
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated numbers of pages.")
+    parser.add_argument("--dim", type=int, default=768, help="Embedding dimension (bge-base: 768).")
+    parser.add_argument("--embeddings", default=None, help=".npy of real embeddings, synthetic ones by default.")
+    parser.add_argument("--intrinsic-dim", type=int, default=64, help="Directions the synthetic pages vary along.")
+    parser.add_argument("--noise", type=float, default=0.3, help="Share of isotropic noise in a synthetic page.")
+    parser.add_argument("--mean-cosine", type=float, default=0.35,
+                        help="Cosine similarity the synthetic pages share through their common direction.")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--probes", default="1,4,8,16,32,64", help="Comma-separated ivf_probes values.")
+    parser.add_argument("--ivf-lists", type=int, default=None, help="IVF lists, sqrt(size) by default.")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "int8"])
+    parser.add_argument("--batch-size", type=int, default=5000, help="Nodes per store.add call.")
+    parser.add_argument("--workdir", default=None, help="Directory for the stores (temporary by default).")
+    parser.add_argument("--output", default="bench_ann.json")
+    return parser.parse_args()
+
+
+class SyntheticEmbeddings:
+    """Unit vectors sqrt(m) * mean + sqrt(1 - m) * normalized(latent part + noise), see the module docstring."""
+    def __init__(self, args, seed=42):
+        rng = np.random.default_rng(seed)
+        basis = np.linalg.qr(rng.standard_normal((args.dim, args.intrinsic_dim + 1)))[0]
+        self.mean, self.basis = basis[:, 0], basis[:, 1:]
+        # the variance along the i-th direction decays as 1 / i
+        scales = np.arange(1, args.intrinsic_dim + 1) ** -0.5
+        self.scales = scales / np.linalg.norm(scales)
+        self.args = args
+
+    def sample(self, rng, num):
+        args = self.args
+        latent = (rng.standard_normal((num, len(self.scales))) * self.scales) @ self.basis.T
+        noise = rng.standard_normal((num, args.dim)) / np.sqrt(args.dim)
+        embeddings = np.sqrt(1 - args.noise) * latent + np.sqrt(args.noise) * noise
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = np.sqrt(args.mean_cosine) * self.mean + np.sqrt(1 - args.mean_cosine) * embeddings
+        return embeddings.astype(np.float32)
+
+
+def corpus_batches(source, size, batch_size):
+    """Embeddings of the first `size` pages in batches, `source` being a SyntheticEmbeddings or an array."""
+    rng = np.random.default_rng(0)
+    for start in range(0, size, batch_size):
+        end = min(start + batch_size, size)
+        if isinstance(source, SyntheticEmbeddings):
+            yield start, source.sample(rng, end - start)
+        else:
+            yield start, np.array(source[start:end], dtype=np.float32)
+
+
+def fill_store(store_dir, size, source, args):
+    store = NumpyVectorStore(store_dir, dtype=args.dtype)
+    for start, embeddings in corpus_batches(source, size, args.batch_size):
+        store.add([
+            TextNode(id_=f"page-{start + i}", text=f"page {start + i}", embedding=embedding.tolist())
+            for i, embedding in enumerate(embeddings)
+        ])
+
+
+def run_queries(store, queries, k):
+    ids, similarities, latencies = [], [], []
+    for query in queries:
+        start = time.perf_counter()
+        result = store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=k))
+        latencies.append(time.perf_counter() - start)
+        ids.append(result.ids)
+        similarities.append(result.similarities)
+    return ids, similarities, latencies
+
+
+def bench_size(size, source, queries, args, workdir):
+    store_dir = os.path.join(workdir, f"store_{size}")
+    shutil.rmtree(store_dir, ignore_errors=True)
+    start = time.perf_counter()
+    fill_store(store_dir, size, source, args)
+    fill_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    # opening the store with ann trains the index over the rows already stored
+    ann_store = NumpyVectorStore(store_dir, dtype=args.dtype, ann="ivf", ivf_lists=args.ivf_lists, ann_min_rows=0)
+    train_seconds = time.perf_counter() - start
+    exact_store = NumpyVectorStore(store_dir, dtype=args.dtype, read_only=True)
+
+    exact_ids, exact_similarities, exact_latencies = run_queries(exact_store, queries, args.k)
+    _, sample = next(corpus_batches(source, size, 1000))
+    queries_normalized = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    sample /= np.linalg.norm(sample, axis=1, keepdims=True)
+    result = {"lists": ann_store._ivf.num_lists, "fill_seconds": fill_seconds, "train_seconds": train_seconds,
+              "cosine": {"random": float(np.mean(queries_normalized @ sample.T)),
+                         "top1": float(np.mean([s[0] for s in exact_similarities if len(s)])),
+                         f"top{args.k}": float(np.mean([s[-1] for s in exact_similarities if len(s)]))},
+              "exact": summarize(exact_latencies), "ivf": {}}
+    print(f"{size} pages, cosine of random pairs {result['cosine']['random']:.3f}, "
+          f"top 1 {result['cosine']['top1']:.3f}, top {args.k} {result['cosine'][f'top{args.k}']:.3f}")
+    for probes in (int(p) for p in args.probes.split(",")):
+        ann_store.ivf_probes = probes
+        ids, _, latencies = run_queries(ann_store, queries, args.k)
+        recall = [len(set(a) & set(e)) / max(len(e), 1) for a, e in zip(ids, exact_ids)]
+        scanned = [len(ann_store._ivf.candidates(ann_store._normalize(q), probes)) / size for q in queries]
+        result["ivf"][probes] = {
+            f"recall@{args.k}": float(np.mean(recall)),
+            "scanned_fraction": float(np.mean(scanned)),
+            "latency": summarize(latencies),
+            "speedup_p50": result["exact"]["p50"] / summarize(latencies)["p50"],
+        }
+        print(f"{size} pages, {probes} probes: recall@{args.k}={np.mean(recall):.3f}, "
+              f"p50 {result['ivf'][probes]['latency']['p50'] * 1000:.2f} ms "
+              f"(exact {result['exact']['p50'] * 1000:.2f} ms)")
+    shutil.rmtree(store_dir, ignore_errors=True)
+    return result
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="bench_ann_"))
+    os.makedirs(workdir, exist_ok=True)
+    results = {"environment": environment(), "config": vars(args), "sizes": {}}
+
+    if args.embeddings is not None:
+        embeddings = np.load(args.embeddings, mmap_mode="r")
+        args.dim = embeddings.shape[1]
+        # held-out rows, so no query finds itself
+        source, queries = embeddings[:-args.queries], np.asarray(embeddings[-args.queries:], dtype=np.float32)
+    else:
+        source = SyntheticEmbeddings(args)
+        queries = source.sample(np.random.default_rng(1), args.queries)
+    for size in (int(s) for s in args.sizes.split(",")):
+        if not isinstance(source, SyntheticEmbeddings) and size > len(source):
+            print(f"Skipping {size} pages, {args.embeddings} only has {len(source)} besides the queries")
+            continue
+        results["sizes"][size] = bench_size(size, source, queries, args, workdir)
+        # partial results survive a run that is stopped at the larger sizes
+        write_results(output, results)
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
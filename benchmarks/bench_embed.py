@@ -0,0 +1,134 @@
+"""
+Throughput/quality benchmark of the embedding backends (see embedding_backends.py).
+
+Every backend embeds the same pages and queries. Throughput is measured on the pages (batched, as
+at ingestion) and latency on single queries (as at chat time). Quality is measured two ways:
+known-item retrieval, where the query is a passage taken from a page and the page must be found
+(recall@k, MRR), and agreement with the first backend, the reference (cosine similarity of the
+page embeddings, overlap of the top k pages per query).
+
+The pages come from the PDFs under --data-dir, or from the synthetic corpus of bench_rag.py.
+The models must be in the local HuggingFace cache, or downloadable.
+
+    python benchmarks/bench_embed.py --data-dir data --backends torch,torch-int8,onnx,onnx-int8 --output bench_embed.json
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from common import environment, make_corpus, summarize, write_results
+
+from embedding_backends import DEFAULT_EMBED_MODEL, EMBED_BACKENDS, load_embed_model
+from index_builder import list_input_files, parse_file
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default=",".join(EMBED_BACKENDS),
+                        help="Comma-separated backends, the first one is the reference.")
+    parser.add_argument("--model", default=DEFAULT_EMBED_MODEL)
+    parser.add_argument("--data-dir", default=None, help="Directory of PDFs, a synthetic corpus by default.")
+    parser.add_argument("--pages", type=int, default=500, help="Maximum number of pages embedded.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-words", type=int, default=12, help="Words of the page passage used as a query.")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=64, help="Pages per forward pass.")
+    parser.add_argument("--threads", type=int, default=None, help="Inference threads, backend default if unset.")
+    parser.add_argument("--output", default="bench_embed.json")
+    return parser.parse_args()
+
+
+def load_pages(args, workdir):
+    data_dir = args.data_dir
+    if data_dir is None:
+        data_dir = os.path.join(workdir, "data")
+        make_corpus(data_dir, args.pages)
+    pages = []
+    for file_path in list_input_files(data_dir):
+        pages.extend(doc.text for doc in parse_file(file_path) if len(doc.text.split()) >= 2 * args.query_words)
+        if len(pages) >= args.pages:
+            break
+    return pages[:args.pages]
+
+
+def make_queries(pages, num_queries, num_words, seed=0):
+    """(query, index of the page it comes from) pairs, the query being a run of words of the page."""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(num_queries):
+        page_idx = rng.randrange(len(pages))
+        words = pages[page_idx].split()
+        start = rng.randrange(len(words) - num_words + 1)
+        queries.append((" ".join(words[start:start + num_words]), page_idx))
+    return queries
+
+
+def bench_backend(backend, pages, queries, args):
+    start = time.perf_counter()
+    embed_model = load_embed_model(backend, model_name=args.model, embed_batch_size=args.batch_size,
+                                   num_threads=args.threads)
+    load_seconds = time.perf_counter() - start
+    # the first forward passes allocate buffers and pick kernels
+    embed_model.get_text_embedding_batch(pages[:args.batch_size])
+
+    start = time.perf_counter()
+    page_embeddings = np.asarray(embed_model.get_text_embedding_batch(pages), dtype=np.float32)
+    embed_seconds = time.perf_counter() - start
+    query_embeddings, latencies = [], []
+    for query, _ in queries:
+        start = time.perf_counter()
+        query_embeddings.append(embed_model.get_query_embedding(query))
+        latencies.append(time.perf_counter() - start)
+    query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+
+    scores = query_embeddings @ page_embeddings.T
+    relevant = np.array([page_idx for _, page_idx in queries])
+    # pages scoring as high as the relevant one count as ranked before it
+    ranks = (scores >= scores[np.arange(len(queries)), relevant][:, None]).sum(axis=1) - 1
+    result = {
+        "load_seconds": load_seconds,
+        "pages_per_second": len(pages) / embed_seconds,
+        "query_latency": summarize(latencies),
+        f"recall@{args.k}": float(np.mean(ranks < args.k)),
+        "mrr": float(np.mean(1.0 / (ranks + 1))),
+    }
+    top_k = np.argsort(-scores, axis=1)[:, :args.k]
+    del embed_model
+    return result, page_embeddings, top_k
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    workdir = tempfile.mkdtemp(prefix="bench_embed_")
+    pages = load_pages(args, workdir)
+    queries = make_queries(pages, args.queries, args.query_words)
+    print(f"{len(pages)} pages, {len(queries)} queries")
+    results = {"environment": environment(), "config": vars(args), "backends": {}}
+
+    reference = None
+    for backend in args.backends.split(","):
+        result, page_embeddings, top_k = bench_backend(backend, pages, queries, args)
+        if reference is None:
+            reference = (backend, page_embeddings, top_k)
+        else:
+            result["reference"] = reference[0]
+            result["cosine_to_reference"] = summarize(list(np.sum(page_embeddings * reference[1], axis=1)))
+            result[f"top{args.k}_overlap_with_reference"] = float(np.mean(
+                [len(set(a) & set(b)) / args.k for a, b in zip(top_k, reference[2])]))
+        results["backends"][backend] = result
+        print(f"{backend}: {result['pages_per_second']:.1f} pages/s, "
+              f"query p50 {result['query_latency']['p50'] * 1000:.1f} ms, "
+              f"recall@{args.k}={result[f'recall@{args.k}']:.3f}, MRR={result['mrr']:.3f}")
+        # partial results survive a backend that fails to load
+        write_results(output, results)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+End-to-end latency benchmark for RAGAgent and the FastAPI endpoints.
+
+Builds an index over a synthetic PDF corpus, then drives `RAGAgent.run`, `/chat_reply` and
+`/upload` with concurrent simulated users. The Ollama LLM is always replaced by a local stub;
+embedding and reranking use hashed/stub models unless --real-models is given (the bge and ColBERT
+weights must then be in the local HuggingFace cache). Runs offline on a CPU-only machine.
+
+    python benchmarks/bench_rag.py --pages 2000 --users 16 --output bench_rag.json
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from common import (
+    REPO_DIR,
+    StageRecorder,
+    environment,
+    load_models,
+    make_corpus,
+    make_queries,
+    summarize,
+    write_results,
+)
+
+from agent import RAGAgent
+from llama_index.core.llms import ChatMessage, MessageRole
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=500, help="Number of pages in the synthetic corpus.")
+    parser.add_argument("--pages-per-file", type=int, default=20)
+    parser.add_argument("--users", type=int, default=8, help="Concurrent simulated users.")
+    parser.add_argument("--turns", type=int, default=4, help="Chat turns per user.")
+    parser.add_argument("--upload-files", type=int, default=4, help="Files sent to /upload.")
+    parser.add_argument("--vector-store", default="numpy", choices=["numpy", "simple"])
+    parser.add_argument("--retrieval-mode", default="hybrid", choices=["hybrid", "dense"])
+    parser.add_argument("--real-models", action="store_true", help="Use bge/ColBERT from the local HF cache.")
+    parser.add_argument("--llm-prefill", type=float, default=0.05, help="Stub LLM seconds before the first token.")
+    parser.add_argument("--llm-token", type=float, default=0.005, help="Stub LLM seconds per token.")
+    parser.add_argument("--llm-tokens", type=int, default=64, help="Stub LLM tokens per answer.")
+    parser.add_argument("--skip-http", action="store_true", help="Only benchmark RAGAgent.run.")
+    parser.add_argument("--workdir", default=None, help="Directory for the corpus and index (temporary by default).")
+    parser.add_argument("--output", default="bench_rag.json")
+    return parser.parse_args()
+
+
+async def chat_turn(agent, user_id, query, chat_history):
+    start = time.perf_counter()
+    generator = await agent.run(query_str=query, user_id=user_id, chat_history=chat_history)
+    first_token = None
+    answer = ""
+    async for delta in generator:
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        answer += delta
+    chat_history.append(ChatMessage(role=MessageRole.USER, content=query))
+    chat_history.append(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+    return time.perf_counter() - start, first_token
+
+
+async def run_agent_users(agent, queries, users, turns):
+    latencies, first_tokens = [], []
+
+    async def user(user_idx):
+        user_id = f"bench-{user_idx}"
+        chat_history = []
+        for turn in range(turns):
+            latency, first_token = await chat_turn(agent, user_id, queries[(user_idx * turns + turn) % len(queries)], chat_history)
+            latencies.append(latency)
+            if first_token is not None:
+                first_tokens.append(first_token)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[user(i) for i in range(users)])
+    wall = time.perf_counter() - start
+    return {"turn": summarize(latencies, wall), "time_to_first_token": summarize(first_tokens)}
+
+
+def import_app(agent, workdir):
+    """Imports main.py inside `workdir` so its data/, tmp/ and index directories land there, reusing `agent`."""
+    for name in ("static", "index.html"):
+        if not os.path.exists(os.path.join(workdir, name)):
+            os.symlink(os.path.join(REPO_DIR, name), os.path.join(workdir, name))
+    os.chdir(workdir)
+    sys.modules.pop("main", None)
+    main = importlib.import_module("main")
+    # the app creates its services on startup, which the ASGI transport does not run
+    main.RAGAgent = lambda *args, **kwargs: agent
+    main.init_services()
+    return main
+
+
+async def run_http(main, queries, users, turns, upload_paths):
+    import httpx
+
+    transport = httpx.ASGITransport(app=main.app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        latencies = []
+
+        async def user(user_idx):
+            user_id = f"http-{user_idx}-{uuid.uuid4().hex[:6]}"
+            for turn in range(turns):
+                start = time.perf_counter()
+                response = await client.post("/chat_reply", json={"message": queries[(user_idx + turn) % len(queries)], "user_id": user_id})
+                answer = response.text
+                latencies.append(time.perf_counter() - start)
+                await client.post("/update_chat_history", json={"message": answer, "user_id": user_id})
+
+        start = time.perf_counter()
+        await asyncio.gather(*[user(i) for i in range(users)])
+        results["chat_reply"] = summarize(latencies, time.perf_counter() - start)
+
+        upload_latencies, indexed_latencies = [], []
+        start = time.perf_counter()
+        for path in upload_paths:
+            request_start = time.perf_counter()
+            with open(path, "rb") as f:
+                response = await client.post("/upload", data={"category": "bench_upload"},
+                                             files={"files": (f"upload_{os.path.basename(path)}", f, "application/pdf")})
+            upload_latencies.append(time.perf_counter() - request_start)
+            job_id = response.json()["job_id"]
+            while True:
+                status = (await client.get(f"/ingest_status/{job_id}")).json()
+                if status["status"] in ("done", "failed", "partial"):
+                    break
+                await asyncio.sleep(0.05)
+            indexed_latencies.append(time.perf_counter() - request_start)
+        wall = time.perf_counter() - start
+        results["upload_request"] = summarize(upload_latencies)
+        results["upload_to_indexed"] = summarize(indexed_latencies, wall)
+    return results
+
+
+def summarize_traces(trace_path):
+    steps = {}
+    if not os.path.exists(trace_path):
+        return steps
+    with open(trace_path, "r") as f:
+        for line in f:
+            for name, value in json.loads(line)["timings"].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    steps.setdefault(name, []).append(value)
+    return {name: summarize(values) for name, values in steps.items()}
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="bench_rag_"))
+    data_dir, persist_dir, tmp_dir = (os.path.join(workdir, name) for name in ("data", "search_index_storage", "tmp"))
+    for directory in (data_dir, tmp_dir):
+        os.makedirs(directory, exist_ok=True)
+    trace_path = os.path.join(workdir, "trace.jsonl")
+    recorder = StageRecorder()
+    results = {"environment": environment(), "config": vars(args), "stages": recorder.stages}
+
+    with recorder.stage("corpus") as info:
+        paths = make_corpus(data_dir, args.pages, pages_per_file=args.pages_per_file)
+        info["files"] = len(paths)
+    upload_dir = os.path.join(workdir, "uploads")
+    upload_paths = make_corpus(upload_dir, args.upload_files * args.pages_per_file, pages_per_file=args.pages_per_file, num_topics=50)
+
+    llm, embed_model, reranker = load_models(args.real_models, {
+        "prefill_seconds": args.llm_prefill, "token_seconds": args.llm_token, "num_tokens": args.llm_tokens,
+    })
+    with recorder.stage("index_build"):
+        agent = RAGAgent(persist_dir, data_dir, tmp_dir, vector_store=args.vector_store, trace_log_path=trace_path,
+                         retrieval_mode=args.retrieval_mode, llm=llm, embed_model=embed_model, reranker=reranker)
+
+    queries = make_queries(max(args.users * args.turns, 1))
+    with recorder.stage("agent_run") as info:
+        info.update(asyncio.run(run_agent_users(agent, queries, args.users, args.turns)))
+    results["agent_steps"] = summarize_traces(trace_path)
+
+    if not args.skip_http:
+        main_module = import_app(agent, workdir)
+        with recorder.stage("http") as info:
+            info.update(asyncio.run(run_http(main_module, queries, args.users, args.turns, upload_paths)))
+
+    write_results(output, results)
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+from contextlib import contextmanager
+from typing import Any, List, Optional
+
+import numpy as np
+import fitz
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    CompletionResponse,
+    LLMMetadata,
+    MessageRole,
+)
+from llama_index.core.llms import CustomLLM
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+FILLER_WORDS = (
+    "model data function value method result example system problem analysis process theory "
+    "variable parameter sample estimate distribution error matrix vector space linear point "
+    "set case order rule form term step input output level state change effect approach"
+).split()
+
+
+class StubLLM(CustomLLM):
+    """
+    Stand-in for the Ollama LLM: waits `prefill_seconds`, then streams `num_tokens` tokens
+    spaced `token_seconds` apart, without blocking the event loop.
+    """
+    prefill_seconds: float = 0.05
+    token_seconds: float = 0.005
+    num_tokens: int = 64
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="stub", is_chat_model=True)
+
+    def _tokens(self):
+        return [f"token{i} " for i in range(self.num_tokens)]
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        time.sleep(self.prefill_seconds + self.token_seconds * self.num_tokens)
+        return CompletionResponse(text="".join(self._tokens()))
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        time.sleep(self.prefill_seconds)
+        text = ""
+        for token in self._tokens():
+            time.sleep(self.token_seconds)
+            text += token
+            yield CompletionResponse(text=text, delta=token)
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        await asyncio.sleep(self.prefill_seconds + self.token_seconds * self.num_tokens)
+        return CompletionResponse(text="".join(self._tokens()))
+
+    async def astream_chat(self, messages, **kwargs: Any):
+        async def gen():
+            await asyncio.sleep(self.prefill_seconds)
+            text = ""
+            for token in self._tokens():
+                await asyncio.sleep(self.token_seconds)
+                text += token
+                yield ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=text), delta=token)
+
+        return gen()
+
+
+class HashEmbedding(BaseEmbedding):
+    """Deterministic bag-of-words embedding (hashed unigrams), so retrieval is meaningful without a model."""
+    embed_dim: int = 768
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.embed_dim, dtype=np.float32)
+        for word in text.lower().split():
+            vector[zlib.crc32(word.encode("utf-8")) % self.embed_dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class StubReranker(BaseNodePostprocessor):
+    """Keeps the retrieval order and assigns decreasing scores above the similarity cutoff."""
+    top_n: int = 5
+
+    def _postprocess_nodes(self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        nodes = sorted(nodes, key=lambda node: -(node.score or 0.0))[:self.top_n]
+        for rank, node in enumerate(nodes):
+            node.score = 1.0 - 0.01 * rank
+        return nodes
+
+
+def load_models(real_models, llm_kwargs):
+    """Returns (llm, embed_model, reranker); the real bge/ColBERT models must already be in the local HF cache."""
+    llm = StubLLM(**llm_kwargs)
+    if not real_models:
+        return llm, HashEmbedding(), StubReranker()
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    from llama_index.postprocessor.colbert_rerank import ColbertRerank
+    return llm, HuggingFaceEmbedding(model_name="BAAI/bge-base-en-v1.5"), ColbertRerank(top_n=5)
+
+
+def topic_terms(num_topics):
+    return [f"topic{t}" for t in range(num_topics)], [[f"term{t}x{i}" for i in range(8)] for t in range(num_topics)]
+
+
+def make_corpus(data_dir, num_pages, pages_per_file=20, words_per_page=250, num_topics=50, seed=0):
+    """
+    Writes a synthetic lecture corpus of `num_pages` pages as PDFs under `data_dir/synthetic`.
+
+    Every page is about one topic: it mentions the topic name and a few of its terms between filler words,
+    so queries built by `make_queries` have a well-defined relevant page set.
+
+    Returns:
+        list: Paths of the written PDFs.
+    """
+    rng = random.Random(seed)
+    topics, terms = topic_terms(num_topics)
+    folder = os.path.join(data_dir, "synthetic")
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for file_idx in range((num_pages + pages_per_file - 1) // pages_per_file):
+        document = fitz.open()
+        for _ in range(min(pages_per_file, num_pages - file_idx * pages_per_file)):
+            topic = rng.randrange(num_topics)
+            words = [rng.choice(FILLER_WORDS) for _ in range(words_per_page)]
+            for i in range(0, words_per_page, 12):
+                words[i] = rng.choice(terms[topic]) if i % 24 else topics[topic]
+            page = document.new_page()
+            page.insert_textbox(page.rect + (36, 36, -36, -36), " ".join(words), fontsize=8)
+        path = os.path.join(folder, f"lecture_{file_idx:05d}.pdf")
+        document.save(path)
+        document.close()
+        paths.append(path)
+    return paths
+
+
+def make_queries(num_queries, num_topics=50, seed=1):
+    rng = random.Random(seed)
+    topics, terms = topic_terms(num_topics)
+    queries = []
+    for _ in range(num_queries):
+        topic = rng.randrange(num_topics)
+        queries.append(f"What is the relation between {rng.choice(terms[topic])} and {rng.choice(terms[topic])} in {topics[topic]}?")
+    return queries
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else None
+
+
+def summarize(latencies, wall_seconds=None):
+    result = {
+        "count": len(latencies),
+        "mean": float(np.mean(latencies)) if latencies else None,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": float(np.max(latencies)) if latencies else None,
+    }
+    if wall_seconds:
+        result["wall_seconds"] = wall_seconds
+        result["throughput_per_second"] = len(latencies) / wall_seconds
+    return result
+
+
+class StageRecorder:
+    """Records wall time and peak traced Python/NumPy memory of named benchmark stages."""
+    def __init__(self):
+        self.stages = {}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        info = {}
+        try:
+            yield info
+        finally:
+            info["seconds"] = time.perf_counter() - start
+            info["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            info["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            self.stages[name] = info
+
+
+def environment():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = None
+    return {
+        "git_revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": time.time(),
+    }
+
+
+def write_results(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"Results written to {path}")
@@ -0,0 +1,245 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(query_str):
+    """Lower-cases and collapses whitespace so trivially different spellings share a cache entry."""
+    return re.sub(r"\s+", " ", query_str).strip().lower()
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+
+    Args:
+        max_size (int): Maximum number of entries, the least recently used one is evicted first.
+        ttl (float): Lifetime of an entry in seconds, None to keep entries until evicted.
+    """
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[0] < self.ttl):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+
+class SQLiteCache:
+    """
+    LRUCache of JSON-serializable values in a SQLite table, shared by all processes using the file.
+
+    Same `get`/`put` interface and eviction rules as `LRUCache`; expired and excess entries are
+    dropped every `evict_every` writes. Values come back as decoded JSON, tuples as lists. Hits and
+    misses are counted per process.
+
+    Args:
+        db_path (str): Path of the database file.
+        table (str): Table of this cache, several caches can share a file.
+    """
+    def __init__(self, db_path, table, max_size=1024, ttl=None, evict_every=100):
+        self.table = table
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_access ON {table} (last_access)")
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(f"SELECT value, last_access FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] >= self.ttl):
+                self.misses += 1
+                return default
+            self._connection.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, last_access) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now),
+            )
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._connection.execute(
+                    f"DELETE FROM {self.table} WHERE last_access < ? OR key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                    (now - self.ttl if self.ttl is not None else float("-inf"), self.max_size),
+                )
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute(f"DELETE FROM {self.table}")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+
+
+class SemanticAnswerCache:
+    """
+    Generated answers, reused for questions that mean the same over the same retrieved nodes.
+
+    An entry is keyed by the ids of the nodes its answer was generated from and the embedding of
+    the question. A lookup only considers entries with exactly the same node ids and returns the
+    answer of the most similar question, if the cosine similarity reaches `similarity_threshold`.
+    Entries are evicted LRU, expire after `ttl` seconds, and are dropped by `invalidate_nodes`
+    when one of their nodes leaves the index.
+
+    Args:
+        max_size (int): Maximum number of answers.
+        ttl (float): Lifetime of an answer in seconds, None to keep it until evicted.
+        similarity_threshold (float): Minimum cosine similarity between the two questions.
+    """
+    def __init__(self, max_size=1024, ttl=None, similarity_threshold=0.95):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.misses = 0
+        # entry id -> (created, node ids, normalized question embedding, answer)
+        self._entries = OrderedDict()
+        # node ids -> ids of the entries answered from exactly these nodes
+        self._by_nodes = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def _remove(self, entry_id):
+        _, node_ids, _, _ = self._entries.pop(entry_id)
+        entry_ids = self._by_nodes[node_ids]
+        entry_ids.discard(entry_id)
+        if not entry_ids:
+            del self._by_nodes[node_ids]
+
+    def get(self, embedding, node_ids):
+        """
+        Returns:
+            The answer stored for the most similar question over the same `node_ids`, or None.
+        """
+        node_ids = frozenset(node_ids)
+        embedding = self._normalize(embedding)
+        with self._lock:
+            best, best_similarity = None, self.similarity_threshold
+            for entry_id in list(self._by_nodes.get(node_ids, ())):
+                created, _, entry_embedding, _ = self._entries[entry_id]
+                if self.ttl is not None and time.monotonic() - created >= self.ttl:
+                    self._remove(entry_id)
+                    continue
+                similarity = float(entry_embedding @ embedding)
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_id, similarity
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            return self._entries[best][3]
+
+    def put(self, embedding, node_ids, answer):
+        node_ids = frozenset(node_ids)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (time.monotonic(), node_ids, self._normalize(embedding), answer)
+            self._by_nodes.setdefault(node_ids, set()).add(entry_id)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_nodes(self, node_ids):
+        """Drops the answers generated from any of `node_ids`."""
+        node_ids = set(node_ids)
+        with self._lock:
+            stale = [entry_id for key, entry_ids in self._by_nodes.items() if not key.isdisjoint(node_ids)
+                     for entry_id in entry_ids]
+            for entry_id in stale:
+                self._remove(entry_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_nodes.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
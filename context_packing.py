@@ -0,0 +1,125 @@
+import math
+import re
+from collections import Counter
+
+from history import estimate_tokens
+from sparse_index import tokenize
+
+PARAGRAPH_RE = re.compile(r"\n\s*\n")
+SENTENCE_END_RE = re.compile(r"(?<=[.!?;:])\s+")
+
+
+def split_passages(text, max_tokens=128):
+    """
+    Splits a page into passages of at most about `max_tokens`.
+
+    Paragraphs are kept whole when they fit, longer ones are cut at sentence ends, and sentences
+    that are still too long (tables, lists without punctuation) at word boundaries.
+    """
+    passages = []
+    max_chars = max_tokens * 4
+    for paragraph in PARAGRAPH_RE.split(text):
+        paragraph = " ".join(paragraph.split())
+        current = ""
+        for sentence in SENTENCE_END_RE.split(paragraph):
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(" ", 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                if current:
+                    passages.append(current)
+                    current = ""
+                passages.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            if current and estimate_tokens(current) + estimate_tokens(sentence) > max_tokens:
+                passages.append(current)
+                current = ""
+            current = f"{current} {sentence}" if current else sentence
+        if current:
+            passages.append(current)
+    return passages
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return len(a & b) / len(a | b)
+
+
+def pack_context(query_str, pages, max_tokens=1536, passage_tokens=128, dedup_threshold=0.8):
+    """
+    Builds the retrieved context of a prompt within a token budget.
+
+    Pages are split into passages and passages repeating an earlier one (running headers and footers,
+    the same paragraph on overlapping pages) are dropped. If the rest does not fit in `max_tokens`,
+    passages are picked by their overlap with the question, taking turns across pages in rank
+    order so the best page does not crowd out the others, and passages without any query term
+    come last. Every page keeps its picked passages in reading order, gaps are marked with "...".
+
+    Args:
+        query_str (str): The question, its terms rank the passages.
+        pages (list): (header, text) tuples, most relevant first. The header (file name, page)
+            is emitted once before the passages of its page.
+        max_tokens (int): Budget of the whole context, None for no limit.
+        passage_tokens (int): Target size of a passage.
+        dedup_threshold (float): Jaccard similarity of the term sets above which a passage is a duplicate.
+
+    Returns:
+        tuple: The context string and a dict of statistics (tokens, passages kept, dropped duplicates,
+            passages left out for the budget).
+    """
+    passages = []  # (page index, position in page, text, term counts)
+    kept_terms = []
+    duplicates = 0
+    for page_idx, (_, text) in enumerate(pages):
+        for position, passage in enumerate(split_passages(text, passage_tokens)):
+            terms = Counter(tokenize(passage))
+            term_set = set(terms)
+            if any(_jaccard(term_set, other) >= dedup_threshold for other in kept_terms):
+                duplicates += 1
+                continue
+            kept_terms.append(term_set)
+            passages.append((page_idx, position, passage, terms))
+
+    query_terms = set(tokenize(query_str))
+    doc_freq = Counter(term for _, _, _, terms in passages for term in query_terms & terms.keys())
+    scores = [
+        sum(math.log(1 + len(passages) / doc_freq[term]) * terms[term] / (terms[term] + 1.0)
+            for term in query_terms & terms.keys())
+        for _, _, _, terms in passages
+    ]
+
+    # the n-th best passage of every page comes before the n+1-th best of any page
+    rank_in_page, counts = {}, Counter()
+    for idx in sorted(range(len(passages)), key=lambda idx: -scores[idx]):
+        rank_in_page[idx] = counts[passages[idx][0]]
+        counts[passages[idx][0]] += 1
+    order = sorted(range(len(passages)), key=lambda idx: (scores[idx] <= 0, rank_in_page[idx], passages[idx][0]))
+
+    selected, used_pages, used = set(), set(), 0
+    for idx in order:
+        page_idx = passages[idx][0]
+        tokens = estimate_tokens(passages[idx][2])
+        if page_idx not in used_pages:
+            tokens += estimate_tokens(pages[page_idx][0])
+        if max_tokens is not None and used + tokens > max_tokens:
+            continue
+        selected.add(idx)
+        used_pages.add(page_idx)
+        used += tokens
+
+    blocks, previous = {}, {}
+    for idx in sorted(selected, key=lambda idx: passages[idx][:2]):
+        page_idx, position, passage, _ = passages[idx]
+        block = blocks.setdefault(page_idx, [pages[page_idx][0]] if pages[page_idx][0] else [])
+        if page_idx in previous and position != previous[page_idx] + 1:
+            block.append("...")
+        block.append(passage)
+        previous[page_idx] = position
+    context = "\n\n".join("\n".join(blocks[page_idx]) for page_idx in sorted(blocks))
+    stats = {
+        "context_tokens": estimate_tokens(context),
+        "context_passages": len(selected),
+        "context_duplicates": duplicates,
+        "context_truncated": len(passages) - len(selected),
+    }
+    return context, stats
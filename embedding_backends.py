@@ -0,0 +1,168 @@
+import os
+from typing import List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import Field, PrivateAttr
+
+DEFAULT_EMBED_MODEL = "BAAI/bge-base-en-v1.5"
+EMBED_BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+# query prefixes HuggingFaceEmbedding applies to the bge models (llama_index.embeddings.huggingface.utils),
+# copied because importing that package imports sentence_transformers and torch
+BGE_QUERY_INSTRUCTION_EN = "Represent this question for searching relevant passages: "
+BGE_QUERY_INSTRUCTION_ZH = "为这个句子生成表示以用于检索相关文章："
+BGE_MODELS = (
+    "BAAI/bge-small-en", "BAAI/bge-small-en-v1.5", "BAAI/bge-base-en", "BAAI/bge-base-en-v1.5",
+    "BAAI/bge-large-en", "BAAI/bge-large-en-v1.5", "BAAI/bge-small-zh", "BAAI/bge-small-zh-v1.5",
+    "BAAI/bge-base-zh", "BAAI/bge-base-zh-v1.5", "BAAI/bge-large-zh", "BAAI/bge-large-zh-v1.5",
+)
+
+
+def query_instruction_for_model(model_name):
+    if model_name not in BGE_MODELS:
+        return ""
+    return BGE_QUERY_INSTRUCTION_ZH if "zh" in model_name else BGE_QUERY_INSTRUCTION_EN
+
+
+class OnnxEmbedding(BaseEmbedding):
+    """
+    Sentence embedding model run on the CPU with ONNX Runtime, optionally int8-quantized.
+
+    Computes what HuggingFaceEmbedding computes for the bge models (same query instruction,
+    CLS pooling, L2-normalized) without PyTorch. The ONNX export is read from the model repository;
+    the int8 variant is derived from it once with dynamic quantization and cached in `cache_dir`.
+
+    Args:
+        model_name (str): HuggingFace repository, or local directory, with tokenizer.json and the export.
+        quantize (bool): Run the int8 dynamically quantized model.
+        num_threads (int): Intra-op threads of the session, None for one per core.
+        max_length (int): Tokens per text, longer texts are truncated.
+        onnx_file (str): Path of the export within the repository.
+        cache_dir (str): Directory of the quantized model, next to the export by default.
+        query_instruction (str): Prefix of queries, the one HuggingFaceEmbedding uses for the model by default.
+        text_instruction (str): Prefix of texts, none by default.
+    """
+    quantize: bool = Field(default=False)
+    num_threads: Optional[int] = Field(default=None)
+    max_length: int = Field(default=512)
+    onnx_file: str = Field(default="onnx/model.onnx")
+    cache_dir: Optional[str] = Field(default=None)
+    query_instruction: Optional[str] = Field(default=None)
+    text_instruction: Optional[str] = Field(default=None)
+    _session = PrivateAttr()
+    _tokenizer = PrivateAttr()
+    _input_names = PrivateAttr()
+
+    def __init__(self, model_name: str = DEFAULT_EMBED_MODEL, **kwargs):
+        super().__init__(model_name=model_name, **kwargs)
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        if self.query_instruction is None:
+            self.query_instruction = query_instruction_for_model(model_name)
+        if self.text_instruction is None:
+            # the bge models embed passages as they are
+            self.text_instruction = ""
+
+        self._tokenizer = Tokenizer.from_file(self._model_file("tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length=self.max_length)
+        self._tokenizer.enable_padding()
+        model_path = self._model_file(self.onnx_file)
+        if self.quantize:
+            model_path = self._quantized(model_path)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.num_threads or 0
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {model_input.name for model_input in self._session.get_inputs()}
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "OnnxEmbedding"
+
+    def _model_file(self, file_name):
+        if os.path.isdir(self.model_name):
+            return os.path.join(self.model_name, file_name)
+        from huggingface_hub import hf_hub_download
+        return hf_hub_download(self.model_name, file_name)
+
+    def _quantized(self, model_path):
+        cache_dir = self.cache_dir or os.path.dirname(model_path)
+        quantized_path = os.path.join(cache_dir, f"{self.model_name.strip('/').replace('/', '--')}-int8.onnx")
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            print(f"Quantizing {model_path} to int8...")
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{quantized_path}.{os.getpid()}.tmp"
+            # weights are stored as int8, activations are quantized on the fly
+            quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, quantized_path)
+        return quantized_path
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        encodings = self._tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        last_hidden_state = self._session.run(None, {name: inputs[name] for name in self._input_names})[0]
+        # CLS pooling, as the bge sentence-transformers configuration
+        embeddings = last_hidden_state[:, 0]
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings.tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed([self.query_instruction + query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed([self.text_instruction + text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._embed([self.text_instruction + text for text in texts])
+
+
+def load_embed_model(backend="torch", model_name=DEFAULT_EMBED_MODEL, embed_batch_size=64, num_threads=None,
+                     cache_dir=None):
+    """
+    Creates the embedding model on one of the CPU inference backends.
+
+    "torch" is HuggingFaceEmbedding in full precision and "torch-int8" the same model with its linear
+    layers dynamically quantized to int8. "onnx" and "onnx-int8" run the ONNX export with ONNX Runtime
+    (onnxruntime and tokenizers, no PyTorch). All compute embeddings of the same model, so an index
+    built with one backend can be searched with another, at a small loss of precision for int8.
+
+    Args:
+        backend (str): One of EMBED_BACKENDS.
+        model_name (str): HuggingFace model.
+        embed_batch_size (int): Texts per forward pass.
+        num_threads (int): Inference threads, None for the library default. PyTorch's setting is
+            process-wide, it also applies to the ColBERT reranker.
+        cache_dir (str): Where the ONNX backend keeps its quantized model.
+    """
+    if backend not in EMBED_BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend!r}, expected one of {', '.join(EMBED_BACKENDS)}")
+    if backend.startswith("onnx"):
+        return OnnxEmbedding(model_name=model_name, embed_batch_size=embed_batch_size, quantize=backend == "onnx-int8",
+                             num_threads=num_threads, cache_dir=cache_dir)
+
+    # imports torch and transformers, which alone takes seconds
+    import torch
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if backend == "torch":
+        return HuggingFaceEmbedding(model_name=model_name, embed_batch_size=embed_batch_size)
+    # dynamic quantization only runs on the CPU
+    embed_model = HuggingFaceEmbedding(model_name=model_name, embed_batch_size=embed_batch_size, device="cpu")
+    transformer = embed_model._model[0]
+    transformer.auto_model = torch.ao.quantization.quantize_dynamic(
+        transformer.auto_model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return embed_model
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from llama_index.core.llms import ChatMessage, MessageRole
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token), good enough for budgeting prompts without a tokenizer."""
+    return len(text) // 4 + 1
+
+
+def window_history(messages, max_tokens=1024, summary_tokens=256):
+    """
+    Fits a conversation into a token budget for the LLM.
+
+    The most recent messages are kept verbatim as long as they fit in `max_tokens`. Older turns are
+    collapsed into a single system message listing the earlier user questions, cut to `summary_tokens`,
+    so the prompt stops growing with the length of the conversation.
+
+    Args:
+        messages (list): The full `ChatMessage` history, oldest first.
+        max_tokens (int): Budget of the verbatim recent messages.
+        summary_tokens (int): Budget of the summary of older turns, 0 to drop them.
+
+    Returns:
+        list: The messages to send.
+    """
+    recent, used = [], 0
+    for message in reversed(messages):
+        tokens = estimate_tokens(message.content or "")
+        if used + tokens > max_tokens and recent:
+            break
+        recent.append(message)
+        used += tokens
+    recent.reverse()
+    # do not start the window with an assistant answer whose question was cut off
+    while len(recent) > 1 and recent[0].role == MessageRole.ASSISTANT:
+        recent.pop(0)
+    older = messages[:len(messages) - len(recent)]
+    if not older or summary_tokens <= 0:
+        return recent
+
+    questions, used = [], estimate_tokens("Earlier in the conversation the user asked:")
+    for message in reversed(older):
+        if message.role != MessageRole.USER:
+            continue
+        tokens = estimate_tokens(message.content)
+        if used + tokens > summary_tokens:
+            break
+        questions.append(message.content)
+        used += tokens
+    if not questions:
+        return recent
+    summary = "Earlier in the conversation the user asked:\n" + "\n".join(f"- {q}" for q in reversed(questions))
+    return [ChatMessage(role=MessageRole.SYSTEM, content=summary)] + recent
+
+
+class ChatHistories:
+    """
+    In-process chat histories with LRU eviction.
+
+    Sessions idle for longer than `idle_ttl` seconds, or the least recently used ones beyond
+    `max_sessions`, are dropped; each session keeps its last `max_messages` messages.
+
+    Args:
+        max_sessions (int): Maximum number of sessions kept.
+        idle_ttl (float): Seconds after which an idle session is dropped, None to keep it until evicted.
+        max_messages (int): Messages kept per session.
+    """
+    def __init__(self, max_sessions=10000, idle_ttl=24 * 3600, max_messages=200):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_messages = max_messages
+        self.histories = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while len(self.histories) > self.max_sessions:
+            self.histories.popitem(last=False)
+        while self.histories and self.idle_ttl is not None:
+            user_id, (last_access, _) = next(iter(self.histories.items()))
+            if now - last_access < self.idle_ttl:
+                break
+            del self.histories[user_id]
+
+    def get_history(self, user_id):
+        """Returns a copy of the session's messages, oldest first."""
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            entry = self.histories.get(user_id)
+            if entry is None:
+                return []
+            self.histories[user_id] = (now, entry[1])
+            self.histories.move_to_end(user_id)
+            return list(entry[1])
+
+    def add_message(self, user_id, message, role):
+        with self._lock:
+            now = time.time()
+            _, messages = self.histories.pop(user_id, (now, []))
+            messages.append(ChatMessage(role=role, content=message))
+            del messages[:-self.max_messages]
+            self.histories[user_id] = (now, messages)
+            self._evict(now)
+
+    def __len__(self):
+        return len(self.histories)
+
+
+class SQLiteChatHistories(ChatHistories):
+    """
+    Chat histories in a SQLite database, so they survive restarts and are shared by all uvicorn workers.
+
+    Same eviction rules as `ChatHistories`; they are applied every `evict_every` writes.
+
+    Args:
+        db_path (str): Path of the database file.
+    """
+    def __init__(self, db_path, max_sessions=10000, idle_ttl=24 * 3600, max_messages=200, evict_every=100):
+        super().__init__(max_sessions=max_sessions, idle_ttl=idle_ttl, max_messages=max_messages)
+        self.db_path = db_path
+        self.evict_every = evict_every
+        self._writes = 0
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            # WAL lets readers in other workers proceed while one worker writes
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, last_access REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, "
+                "role TEXT NOT NULL, content TEXT NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, id)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS sessions_access ON sessions (last_access)")
+
+    def get_history(self, user_id):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE sessions SET last_access = ? WHERE user_id = ?", (time.time(), user_id))
+            rows = self._connection.execute(
+                "SELECT role, content FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, self.max_messages),
+            ).fetchall()
+        return [ChatMessage(role=MessageRole(role), content=content) for role, content in reversed(rows)]
+
+    def add_message(self, user_id, message, role):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO sessions (user_id, last_access) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET last_access = excluded.last_access",
+                (user_id, time.time()),
+            )
+            self._connection.execute(
+                "INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)",
+                (user_id, MessageRole(role).value, message),
+            )
+            self._connection.execute(
+                "DELETE FROM messages WHERE user_id = ? AND id NOT IN "
+                "(SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                (user_id, user_id, self.max_messages),
+            )
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._evict(time.time())
+
+    def _evict(self, now):
+        # caller holds the lock and a transaction
+        expired = "last_access < ?" if self.idle_ttl is not None else "0"
+        self._connection.execute(
+            f"DELETE FROM sessions WHERE {expired} OR user_id IN "
+            "(SELECT user_id FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            ((now - self.idle_ttl,) if self.idle_ttl is not None else ()) + (self.max_sessions,),
+        )
+        self._connection.execute("DELETE FROM messages WHERE user_id NOT IN (SELECT user_id FROM sessions)")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
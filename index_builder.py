@@ -0,0 +1,120 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from llama_index.core import SimpleDirectoryReader
+
+from pdf_pages import iter_pdf_pages
+
+
+def parse_file(file_path):
+    """Parses one file into page documents. Runs in a worker process, so it only needs the reader."""
+    if file_path.lower().endswith(".pdf"):
+        # same extraction as uploads, so re-uploading an unchanged page finds it indexed
+        return list(iter_pdf_pages(file_path))
+    return SimpleDirectoryReader(input_files=[file_path]).load_data()
+
+
+def list_input_files(data_dir):
+    """Files under `data_dir` that SimpleDirectoryReader would load, in a stable order."""
+    try:
+        return sorted(str(path) for path in SimpleDirectoryReader(data_dir, recursive=True).input_files)
+    except ValueError:
+        # raised for an empty directory
+        return []
+
+
+def iter_parsed_batches(file_paths, num_workers=None, batch_size=256):
+    """
+    Parses files on a process pool and yields them in batches as soon as enough pages are parsed.
+
+    Files are never split across batches, so a batch can be committed file by file. A file that fails
+    to parse is left out of the batches, so it is not marked completed. A crashed worker breaks the
+    pool and raises `BrokenProcessPool`, the files not parsed yet are left to the next start.
+
+    Args:
+        file_paths (list): Files to parse.
+        num_workers (int): Number of parser processes, all cores by default.
+        batch_size (int): Minimum number of pages per yielded batch (the last one may be smaller).
+
+    Yields:
+        dict: Maps each file path of the batch to its page documents.
+    """
+    if not file_paths:
+        return
+    num_workers = min(num_workers or os.cpu_count() or 1, len(file_paths))
+    # never fork: the reranker and the embedding model may be loading torch on another thread. The fork
+    # server starts from a clean interpreter with this module imported, so workers only pay for the parser
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+    else:
+        context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as pool:
+        futures = {pool.submit(parse_file, file_path): file_path for file_path in file_paths}
+        batch, num_pages = {}, 0
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                documents = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as e:
+                print(f"Failed to parse {file_path}: {e}")
+                continue
+            batch[file_path] = documents
+            num_pages += len(documents)
+            if num_pages >= batch_size:
+                yield batch
+                batch, num_pages = {}, 0
+        if batch:
+            yield batch
+
+
+class BuildState:
+    """
+    Progress of an initial index build, so a crashed build resumes after its last completed shard.
+
+    The state file lists the completed files and the ids of the documents they produced. It only
+    exists while a build is in progress and is rewritten atomically after every shard.
+
+    Args:
+        path (str): Path of the JSON state file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.completed = json.load(f)["completed"]
+
+    @property
+    def in_progress(self):
+        return os.path.exists(self.path)
+
+    def committed_doc_ids(self):
+        return {doc_id for doc_ids in self.completed.values() for doc_id in doc_ids}
+
+    def start(self):
+        self.completed = {}
+        self._write()
+
+    def mark_completed(self, documents_by_file):
+        for file_path, documents in documents_by_file.items():
+            self.completed[file_path] = [doc.doc_id for doc in documents]
+        self._write()
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"completed": self.completed}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,372 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from llama_index.core import SimpleDirectoryReader
+
+from metrics import INGEST_LATENCY, INGESTED_PAGES
+from pdf_pages import iter_pdf_pages
+
+FINISHED_STATUSES = ("done", "failed", "partial")
+
+
+class IngestionJob:
+    """
+    Tracks the progress of one /upload request.
+
+    Args:
+        job_id (str): Identifier returned to the client.
+        file_paths (list): Paths of the uploaded files that belong to this job.
+        status (str): Initial status of the files, "uploading" while they are still being written.
+    """
+    def __init__(self, job_id, file_paths, status="queued"):
+        self.job_id = job_id
+        self.status = status
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.files = {
+            file_path: {"status": status, "pages": 0, "pages_parsed": 0, "pages_embedded": 0, "parse_seconds": 0.0,
+                        "embed_seconds": 0.0, "error": None, "duplicate_of": None}
+            for file_path in file_paths
+        }
+        self._remaining = len(file_paths)
+
+    def to_dict(self):
+        files = {}
+        for file_path, info in self.files.items():
+            info = dict(info)
+            elapsed = info["parse_seconds"] + info["embed_seconds"]
+            info["pages_per_second"] = round(info["pages"] / elapsed, 2) if elapsed > 0 else None
+            files[file_path] = info
+        done = sum(1 for info in self.files.values() if info["status"] in ("done", "failed"))
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "error": self.error,
+            "files_done": done,
+            "files_total": len(self.files),
+            "pages_parsed": sum(info["pages_parsed"] for info in self.files.values()),
+            "pages_embedded": sum(info["pages_embedded"] for info in self.files.values()),
+            "pages_indexed": sum(info["pages"] for info in self.files.values() if info["status"] == "done"),
+            "elapsed_seconds": round(end - self.created_at, 3),
+            "files": files,
+        }
+
+
+class IngestionQueue:
+    """
+    Parses uploaded files on a worker pool and feeds their pages to a single writer thread,
+    which embeds them in large batches and indexes them through `RAGAgent.append_index`.
+
+    Files are pipelined page by page: a parser hands over every `page_batch_size` extracted pages,
+    and the writer embeds them while the rest of the file is still being extracted. A file is
+    indexed once all its pages are embedded. The queue between parsers and writer is bounded, so
+    parsers wait for the writer instead of holding every extracted page in memory.
+
+    Args:
+        agent (RAGAgent): The agent whose index receives the new documents.
+        num_workers (int): Number of threads parsing files concurrently.
+        embed_batch_size (int): Maximum number of pages gathered (across files) per embedding pass.
+        page_batch_size (int): Pages a parser extracts before handing them to the writer.
+        max_pending_batches (int): Page batches waiting for the writer before parsers block.
+    """
+    def __init__(self, agent, num_workers=4, embed_batch_size=256, max_jobs=1000, spool=None, poll_interval=0.5,
+                 page_batch_size=16, max_pending_batches=32):
+        self.agent = agent
+        self.spool = spool
+        self.poll_interval = poll_interval
+        self.max_jobs = max_jobs
+        self.embed_batch_size = embed_batch_size
+        self.page_batch_size = page_batch_size
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._parse_pool = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="ingest-parse")
+        # (job, file_path, documents, last, error) page batches
+        self._parsed = queue.Queue(maxsize=max_pending_batches)
+        self._writer = threading.Thread(target=self._write_loop, name="ingest-writer", daemon=True)
+        self._writer.start()
+        if spool is not None:
+            self._spool_thread = threading.Thread(target=self._spool_loop, name="ingest-spool", daemon=True)
+            self._spool_thread.start()
+
+    def create_job(self, file_paths, job_id=None):
+        """Registers a job whose files are still being written, each one is started with `submit_file`."""
+        job = IngestionJob(job_id or uuid.uuid4().hex, file_paths, status="uploading")
+        with self._lock:
+            self.jobs[job.job_id] = job
+            self._prune_jobs()
+        if not file_paths:
+            self._finish(job)
+        return job
+
+    def submit_file(self, job, file_path):
+        """Starts parsing a file of `job` that is completely written."""
+        job.files[file_path]["status"] = "queued"
+        self._parse_pool.submit(self._parse_file, job, file_path)
+
+    def submit(self, file_paths, job_id=None):
+        job = self.create_job(file_paths, job_id)
+        for file_path in file_paths:
+            self.submit_file(job, file_path)
+        return job
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def get_status(self, job_id):
+        job = self.get_job(job_id)
+        return job.to_dict() if job is not None else None
+
+    def _spool_loop(self):
+        # jobs handed over by other workers, their status is published until they finish
+        published = {}
+        last_prune = time.time()
+        while True:
+            for job_id, file_paths in self.spool.take_pending():
+                published[job_id] = self.submit(file_paths, job_id=job_id)
+            for job_id, job in list(published.items()):
+                self.spool.write_status(job.to_dict())
+                if job.finished_at is not None:
+                    del published[job_id]
+            if time.time() - last_prune > 3600:
+                self.spool.prune()
+                last_prune = time.time()
+            time.sleep(self.poll_interval)
+
+    def _prune_jobs(self):
+        # Forget the oldest finished jobs so the status table stays bounded
+        finished = [job for job in self.jobs.values() if job.finished_at is not None]
+        for job in sorted(finished, key=lambda job: job.finished_at)[:max(len(self.jobs) - self.max_jobs, 0)]:
+            del self.jobs[job.job_id]
+
+    def _parse_file(self, job, file_path):
+        info = job.files[file_path]
+        job.status = "running"
+        try:
+            copy_of = self.agent.find_indexed_copy(file_path)
+        except OSError:
+            copy_of = None
+        # an unchanged file needs no parsing at all
+        if copy_of == file_path:
+            print(f"Skipping {file_path}, already indexed.")
+            info["status"] = "done"
+            self._file_finished(job)
+            return
+        # a copy of an indexed file is parsed for its page metadata, append_index reuses the other file's embeddings
+        info["duplicate_of"] = copy_of
+        info["status"] = "parsing"
+        start = time.perf_counter()
+        batch = []
+        try:
+            if file_path.lower().endswith(".pdf"):
+                pages = iter_pdf_pages(file_path)
+            else:
+                pages = iter(SimpleDirectoryReader(input_files=[file_path]).load_data())
+            while True:
+                page_start = time.perf_counter()
+                doc = next(pages, None)
+                info["parse_seconds"] += time.perf_counter() - page_start
+                if doc is None:
+                    break
+                doc.metadata.setdefault("page_index", info["pages_parsed"])
+                batch.append(doc)
+                info["pages_parsed"] += 1
+                if len(batch) >= self.page_batch_size:
+                    # blocks while the writer is behind
+                    self._parsed.put((job, file_path, batch, False, None))
+                    batch = []
+        except Exception as e:
+            # pages already handed over are dropped by the writer
+            self._parsed.put((job, file_path, [], True, e))
+            return
+        INGEST_LATENCY.observe(time.perf_counter() - start, stage="parse")
+        self._parsed.put((job, file_path, batch, True, None))
+
+    def _write_loop(self):
+        # (job id, file_path) -> pages and embedded nodes of the files whose last pages are yet to come
+        pending = defaultdict(lambda: {"documents": [], "nodes": []})
+        # files that failed before their last pages came, the rest of their pages is dropped
+        dropped = set()
+        while True:
+            batch = [self._parsed.get()]
+            num_pages = len(batch[0][2])
+            # Gather whatever else is already parsed so pages from several files share one embedding pass
+            while num_pages < self.embed_batch_size:
+                try:
+                    item = self._parsed.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                num_pages += len(item[2])
+
+            # a parse error is always the last item of its file, earlier page batches of that file may be in
+            # this pass too and must not be embedded
+            failed = {(job.job_id, file_path) for job, file_path, _, _, error in batch if error is not None}
+            items = []
+            for job, file_path, docs, last, error in batch:
+                key = (job.job_id, file_path)
+                if key in dropped:
+                    if last:
+                        dropped.discard(key)
+                elif error is not None:
+                    pending.pop(key, None)
+                    self.fail_file(job, file_path, error)
+                elif key not in failed:
+                    items.append((job, file_path, docs, last))
+
+            documents = [doc for job, file_path, docs, _ in items if job.files[file_path]["duplicate_of"] is None
+                         for doc in docs]
+            start = time.perf_counter()
+            try:
+                nodes = self.agent.embed_pages(documents) if documents else []
+            except Exception as e:
+                failed = {}
+                for job, file_path, _, last in items:
+                    key = (job.job_id, file_path)
+                    # a file may have several of its page batches in this pass
+                    failed[key] = (job, file_path, last or (key in failed and failed[key][2]))
+                for key, (job, file_path, last) in failed.items():
+                    pending.pop(key, None)
+                    if not last:
+                        dropped.add(key)
+                    self.fail_file(job, file_path, e)
+                continue
+            elapsed = time.perf_counter() - start
+            INGEST_LATENCY.observe(elapsed, stage="embed")
+            nodes_by_doc = defaultdict(list)
+            for node in nodes:
+                nodes_by_doc[node.ref_doc_id].append(node)
+            for job, file_path, docs, _ in items:
+                info = job.files[file_path]
+                info["status"] = "embedding"
+                # Attribute the shared batch time to each file in proportion to its page count
+                info["embed_seconds"] += elapsed * len(docs) / max(len(documents), 1)
+                info["pages_embedded"] += len(docs)
+                entry = pending[(job.job_id, file_path)]
+                entry["documents"].extend(docs)
+                entry["nodes"].extend(node for doc in docs for node in nodes_by_doc[doc.doc_id])
+
+            completed = [(job, file_path) for job, file_path, _, last in items if last]
+            if not completed:
+                continue
+            files = [(job, file_path, pending.pop((job.job_id, file_path))) for job, file_path in completed]
+            start = time.perf_counter()
+            try:
+                self.agent.append_index([doc for _, _, entry in files for doc in entry["documents"]],
+                                        embedded_nodes=[node for _, _, entry in files for node in entry["nodes"]])
+            except Exception as e:
+                for job, file_path, _ in files:
+                    self.fail_file(job, file_path, e)
+                continue
+            elapsed = time.perf_counter() - start
+            INGEST_LATENCY.observe(elapsed, stage="index")
+            num_indexed = sum(len(entry["documents"]) for _, _, entry in files)
+            INGESTED_PAGES.inc(num_indexed)
+
+            for job, file_path, entry in files:
+                info = job.files[file_path]
+                info["embed_seconds"] += elapsed * len(entry["documents"]) / max(num_indexed, 1)
+                info["pages"] = len(entry["documents"])
+                info["status"] = "done"
+                self._file_finished(job)
+
+    def fail_file(self, job, file_path, error):
+        print(f"Failed to ingest {file_path}: {error}")
+        job.files[file_path]["status"] = "failed"
+        job.files[file_path]["error"] = str(error)
+        self._file_finished(job)
+
+    def _file_finished(self, job):
+        with self._lock:
+            job._remaining -= 1
+            if job._remaining == 0:
+                self._finish(job)
+
+    def _finish(self, job):
+        failed = [info for info in job.files.values() if info["status"] == "failed"]
+        if failed:
+            job.status = "failed" if len(failed) == len(job.files) else "partial"
+            job.error = failed[0]["error"]
+        else:
+            job.status = "done"
+        job.finished_at = time.time()
+
+
+class IngestionSpool:
+    """
+    Hands uploads over to the single writer process when several workers serve the app.
+
+    Any worker drops a job file into `pending/`; the writer's `IngestionQueue` picks it up and
+    publishes the job status to `status/`, where every worker can read it.
+
+    Args:
+        spool_dir (str): Directory shared by all workers.
+        max_status_age (float): Seconds after which the status of a finished job is deleted.
+    """
+    JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+    def __init__(self, spool_dir, max_status_age=24 * 3600):
+        self.pending_dir = os.path.join(spool_dir, "pending")
+        self.status_dir = os.path.join(spool_dir, "status")
+        self.max_status_age = max_status_age
+        os.makedirs(self.pending_dir, exist_ok=True)
+        os.makedirs(self.status_dir, exist_ok=True)
+
+    @staticmethod
+    def _write_json(path, content):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(content, f)
+        os.replace(tmp_path, path)
+
+    def submit(self, file_paths):
+        """Queues the files for the writer, returns the job id."""
+        job = IngestionJob(uuid.uuid4().hex, file_paths)
+        self.write_status(job.to_dict())
+        self._write_json(os.path.join(self.pending_dir, f"{job.job_id}.json"), {"job_id": job.job_id, "file_paths": file_paths})
+        return job.job_id
+
+    def take_pending(self):
+        """Removes and returns the queued (job_id, file_paths), oldest first."""
+        paths = [os.path.join(self.pending_dir, name) for name in os.listdir(self.pending_dir) if name.endswith(".json")]
+        jobs = []
+        for path in sorted(paths, key=os.path.getmtime):
+            try:
+                with open(path, "r") as f:
+                    job = json.load(f)
+                os.remove(path)
+            except (OSError, ValueError) as e:
+                print(f"Skipping spooled job {path}: {e}")
+                continue
+            jobs.append((job["job_id"], job["file_paths"]))
+        return jobs
+
+    def write_status(self, status):
+        self._write_json(os.path.join(self.status_dir, f"{status['job_id']}.json"), status)
+
+    def get_status(self, job_id):
+        if not self.JOB_ID.fullmatch(job_id):
+            return None
+        try:
+            with open(os.path.join(self.status_dir, f"{job_id}.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def prune(self):
+        now = time.time()
+        for name in os.listdir(self.status_dir):
+            path = os.path.join(self.status_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.max_status_age:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,136 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from metrics import LLM_IN_FLIGHT, LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT, LLM_REJECTED
+
+
+class LLMBusyError(Exception):
+    """Raised when a request is not admitted to the LLM, `retry_after` is a hint in seconds."""
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMScheduler:
+    """
+    Admission control in front of the LLM.
+
+    At most `max_in_flight` requests run at a time. Waiting requests are queued per user and
+    served round-robin across users, so a user sending a burst does not hold up everyone else.
+    A request is turned away with `LLMBusyError` right away when the queue is full or its user
+    already has `max_queued_per_user` requests waiting, and after waiting `max_wait` seconds, or
+    less when the caller has less time left.
+
+    Slots are handed over from `release` to the next waiter directly. Meant to be used from the
+    event loop thread only.
+
+    Args:
+        max_in_flight (int): Concurrent LLM requests, about what Ollama runs in parallel.
+        max_queue_size (int): Requests waiting across all users.
+        max_queued_per_user (int): Requests waiting per user.
+        max_wait (float): Seconds a request may wait for a slot.
+        retry_after (int): Seconds clients are told to wait after a rejection.
+    """
+    def __init__(self, max_in_flight=2, max_queue_size=32, max_queued_per_user=2, max_wait=30.0, retry_after=5):
+        self.max_in_flight = max_in_flight
+        self.max_queue_size = max_queue_size
+        self.max_queued_per_user = max_queued_per_user
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.num_waiting = 0
+        # user id -> waiting futures, users in round-robin order
+        self._queues = OrderedDict()
+
+    def _update_gauges(self):
+        LLM_IN_FLIGHT.set(self.in_flight)
+        LLM_QUEUE_DEPTH.set(self.num_waiting)
+
+    def _reject(self, reason, message):
+        LLM_REJECTED.inc(reason=reason)
+        raise LLMBusyError(message, retry_after=self.retry_after)
+
+    def admits(self, user_id):
+        """Whether a request of `user_id` would be run or queued right now, rather than rejected."""
+        if self.in_flight < self.max_in_flight and self.num_waiting == 0:
+            return True
+        return (self.num_waiting < self.max_queue_size
+                and len(self._queues.get(user_id, ())) < self.max_queued_per_user)
+
+    async def acquire(self, user_id, max_wait=None):
+        """Waits for a slot, which must be given back with `release`. `max_wait` shortens the scheduler's wait."""
+        start = time.perf_counter()
+        if self.in_flight < self.max_in_flight and self.num_waiting == 0:
+            self.in_flight += 1
+            self._update_gauges()
+            LLM_QUEUE_WAIT.observe(0.0)
+            return
+        if self.num_waiting >= self.max_queue_size:
+            self._reject("queue_full", f"{self.num_waiting} requests are already waiting for the LLM")
+        if len(self._queues.get(user_id, ())) >= self.max_queued_per_user:
+            self._reject("user_limit", f"{self.max_queued_per_user} of your requests are already waiting for the LLM")
+        wait = self.max_wait if max_wait is None else min(self.max_wait, max_wait)
+        if wait <= 0:
+            self._reject("timeout", "No LLM slot is free and the request has no time left to wait")
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(future)
+        self.num_waiting += 1
+        self._update_gauges()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), wait)
+        except asyncio.TimeoutError:
+            if not future.done():
+                self._remove(user_id, future)
+                self._reject("timeout", f"No LLM slot became free within {wait:g}s")
+        except asyncio.CancelledError:
+            if future.done():
+                # the slot was handed over as the request went away
+                self.release()
+            else:
+                self._remove(user_id, future)
+            raise
+        LLM_QUEUE_WAIT.observe(time.perf_counter() - start)
+
+    def _remove(self, user_id, future):
+        queue = self._queues.get(user_id)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self.num_waiting -= 1
+            if not queue:
+                del self._queues[user_id]
+        self._update_gauges()
+
+    def release(self):
+        """Hands the slot to the oldest request of the next user in turn, or frees it."""
+        while self._queues:
+            user_id, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self.num_waiting -= 1
+            # the user moves to the back of the round-robin order
+            del self._queues[user_id]
+            if queue:
+                self._queues[user_id] = queue
+            if not future.done():
+                future.set_result(None)
+                self._update_gauges()
+                return
+        self.in_flight -= 1
+        self._update_gauges()
+
+    @asynccontextmanager
+    async def slot(self, user_id, max_wait=None):
+        await self.acquire(user_id, max_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.num_waiting,
+            "waiting_users": len(self._queues),
+        }
@@ -1,21 +1,33 @@
+import asyncio
+import hashlib
+import json
 import shutil
 import os
+import threading
 import time
-from typing import List
+import uuid
+from typing import List, Optional
 
-from llama_index.core import SimpleDirectoryReader
 from pydantic import BaseModel
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, StreamingResponse
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, Response
 
 from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.workflow import WorkflowTimeoutError
 
 from fastapi.middleware.cors import CORSMiddleware
 
-from agent import RAGAgent, ChatHistories
+from agent import RAGAgent
+from cache import SQLiteCache
+from history import ChatHistories, SQLiteChatHistories
+from ingestion import FINISHED_STATUSES, IngestionQueue, IngestionSpool
+from llm_scheduler import LLMBusyError
+from metrics import REGISTRY, INGEST_LATENCY
+from persistence import WriterLock
+from utils import parse_byte_range
 
 app = FastAPI()
 
@@ -28,6 +40,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all HTTP methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Retrieval-Id"],
 )
 
 # Directory to save uploaded files
@@ -36,44 +49,200 @@ os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
 
 PERSIST_DIR = "./search_index_storage"
 
-TMP_DIR = "tmp" # Directory to save temporary files (retrieved PDFs)
+TMP_DIR = "tmp" # Directory for temporary files
 os.makedirs(TMP_DIR, exist_ok=True)
 
-agent = RAGAgent(PERSIST_DIR, UPLOAD_DIRECTORY, TMP_DIR)
+INGEST_WORKERS = 4 # Number of threads parsing uploaded files
+EMBED_BATCH_SIZE = 64 # Pages per forward pass of the embedding model
+EMBED_BACKEND = "torch" # "torch", "torch-int8", "onnx" or "onnx-int8" (ONNX Runtime, no PyTorch), see benchmarks/bench_embed.py
+EMBED_THREADS = None # Inference threads of the embedding model, None for the backend default
+INGEST_BATCH_SIZE = 256 # Pages gathered across uploaded files before they are embedded
+INGEST_PAGE_BATCH = 16 # Pages extracted from a file before they are handed over to be embedded
+INGEST_PROGRESS_INTERVAL = 0.25 # Seconds between checks of /ingest_progress for new progress
+VECTOR_STORE = "numpy" # "numpy" (memory-mapped NumpyVectorStore) or "simple" (llama_index SimpleVectorStore); an existing simple index is migrated to numpy on first start
+VECTOR_DTYPE = "float32" # Storage type of the NumPy store: "float32", "float16" or "int8"
+ANN_INDEX = None # None for exact search, "ivf" for an approximate IVF index in the NumPy store (large corpora)
+ANN_PROBES = 16 # IVF lists scanned per query, higher is slower and closer to exact search
+TRACE_LOG = None # Path of a JSON-lines file receiving the step timings of every chat turn, None to disable
+BUILD_WORKERS = None # Processes parsing PDFs when the index is built from scratch, None for all cores
+BUILD_BATCH_SIZE = 256 # Pages per shard of the initial build, a crashed build resumes after the last shard
+CHAT_HISTORY_DB = "chat_histories.sqlite3" # SQLite file shared by all workers (histories, retrieved pages), None to keep them in memory
+MAX_CHAT_SESSIONS = 10000 # Least recently used sessions beyond this are dropped
+CHAT_SESSION_TTL = 24 * 3600 # Seconds after which an idle session is dropped
+MAX_RETRIEVALS = 10000 # Turns whose retrieved pages stay listed at /retrieval/{retrieval_id}
+WORKERS = int(os.environ.get("RAG_WORKERS", "1")) # uvicorn worker processes, they share one memory-mapped index
+INDEX_RELOAD_INTERVAL = 2.0 # Seconds between checks of read-only workers for index updates
+MAX_LLM_IN_FLIGHT = 2 # LLM requests sent to Ollama at once (per worker), match OLLAMA_NUM_PARALLEL
+MAX_LLM_QUEUE = 32 # Requests waiting for the LLM before new ones get 429
+MAX_LLM_QUEUED_PER_USER = 2 # Requests one user may have waiting
+MAX_LLM_WAIT = 30.0 # Seconds a request waits for the LLM before it gets 429
+LLM_CALL_RESERVE = 15.0 # Seconds of the 60s turn timeout kept per LLM call, requests stop waiting earlier to leave them
+LAZY_STARTUP = True # Serve requests right away and load the models and the index in the background
+RETRIEVAL_MODE = "hybrid" # "hybrid" (dense + BM25 with reciprocal-rank fusion) or "dense"
+HYBRID_CANDIDATES = 20 # Nodes each of the dense and BM25 rankings contributes to the fusion
+RERANK_CANDIDATES = 5 # Fused nodes passed to ColBERT, bounds the reranking cost
+CHUNK_SIZE = 256 # Tokens per indexed chunk of a page, None to index whole pages (applies to pages indexed from now on)
+CHUNK_OVERLAP = 32 # Tokens shared by neighbouring chunks of a page
+CONTEXT_TOKENS = 1536 # Token budget of the retrieved passages in a prompt, None to send whole pages
+PASSAGE_TOKENS = 128 # Size of the passages pages are trimmed to when they do not fit the budget
+ANSWER_CACHE_SIZE = 1024 # Answers kept for repeated questions over unchanged pages, 0 to disable
+ANSWER_SIMILARITY = 0.95 # Cosine similarity from which two questions share a cached answer
 
-chat_histories = ChatHistories()
+# Created on startup, not at import: the process supervising several workers must not load the models
+agent = None
+ingestion_queue = None
+# With several workers one of them (the holder of the writer lock) builds the index and applies all uploads,
+# the others map the index read-only and hand their uploads over through the spool
+ingestion_spool = IngestionSpool(os.path.join(PERSIST_DIR, "ingest_spool")) if WORKERS > 1 else None
+writer_lock = WriterLock(os.path.join(PERSIST_DIR, "writer.lock"))
+# any worker may be asked for the pages of a turn another worker answered
+retrievals = SQLiteCache(CHAT_HISTORY_DB, "retrievals", max_size=MAX_RETRIEVALS, ttl=CHAT_SESSION_TTL) if CHAT_HISTORY_DB else None
+
+def init_services():
+    global agent, ingestion_queue
+    is_writer = writer_lock.acquire()
+    if not is_writer and ingestion_spool is None:
+        raise RuntimeError(f"Another process writes the index in {PERSIST_DIR}, set RAG_WORKERS to share it")
+    agent = RAGAgent(PERSIST_DIR, UPLOAD_DIRECTORY, TMP_DIR, embed_batch_size=EMBED_BATCH_SIZE,
+                     vector_store=VECTOR_STORE, vector_dtype=VECTOR_DTYPE, trace_log_path=TRACE_LOG,
+                     build_workers=BUILD_WORKERS, build_batch_size=BUILD_BATCH_SIZE,
+                     read_only=not is_writer, reload_interval=INDEX_RELOAD_INTERVAL,
+                     retrieval_mode=RETRIEVAL_MODE, hybrid_candidates=HYBRID_CANDIDATES,
+                     rerank_candidates=RERANK_CANDIDATES, ann=ANN_INDEX, ann_probes=ANN_PROBES,
+                     lazy_load=LAZY_STARTUP, max_llm_in_flight=MAX_LLM_IN_FLIGHT, max_llm_queue=MAX_LLM_QUEUE,
+                     max_llm_queued_per_user=MAX_LLM_QUEUED_PER_USER, max_llm_wait=MAX_LLM_WAIT,
+                     llm_call_reserve=LLM_CALL_RESERVE,
+                     answer_cache_size=ANSWER_CACHE_SIZE, answer_similarity=ANSWER_SIMILARITY,
+                     context_tokens=CONTEXT_TOKENS, passage_tokens=PASSAGE_TOKENS,
+                     chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                     embed_backend=EMBED_BACKEND, embed_threads=EMBED_THREADS, retrievals=retrievals)
+    if is_writer:
+        ingestion_queue = IngestionQueue(agent, num_workers=INGEST_WORKERS, embed_batch_size=INGEST_BATCH_SIZE,
+                                         spool=ingestion_spool, page_batch_size=INGEST_PAGE_BATCH)
+
+def load_agent():
+    try:
+        agent.load()
+    except Exception as e:
+        print(f"Failed to load the models or the index: {e}")
+
+@app.on_event("startup")
+async def startup():
+    if agent is None:
+        init_services()
+    if not agent.ready:
+        # /ready reports the progress, /chat_reply answers 503 until everything is loaded
+        threading.Thread(target=load_agent, name="agent-loader", daemon=True).start()
+
+if CHAT_HISTORY_DB:
+    chat_histories = SQLiteChatHistories(CHAT_HISTORY_DB, max_sessions=MAX_CHAT_SESSIONS, idle_ttl=CHAT_SESSION_TTL)
+else:
+    chat_histories = ChatHistories(max_sessions=MAX_CHAT_SESSIONS, idle_ttl=CHAT_SESSION_TTL)
 
 @app.post("/upload")
 async def upload_files(files: List[UploadFile] = File(...), category: str = Form(...)):
+    start = time.perf_counter()
     print("File category:", category)
     folder_location = f"{UPLOAD_DIRECTORY}/{category}"
     if not os.path.exists(folder_location):
         os.makedirs(folder_location)
     
-    for file in files:
+    file_locations = [f"{folder_location}/{file.filename}" for file in files]
+
+    def save(file, file_location):
         print("Uploading: ", file.filename)
-        file_location = f"{folder_location}/{file.filename}"
         with open(file_location, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
 
-        new_documents = SimpleDirectoryReader(input_files=[file_location]).load_data(show_progress=True)
-        
-        agent.append_index(new_documents)
+    # Parsing and embedding happen in the background, the client follows /ingest_progress/{job_id}
+    if ingestion_spool is not None:
+        await asyncio.gather(*(asyncio.to_thread(save, file, location) for file, location in zip(files, file_locations)))
+        job_id = ingestion_spool.submit(file_locations)
+    else:
+        job = ingestion_queue.create_job(file_locations)
+
+        async def save_and_submit(file, file_location):
+            try:
+                await asyncio.to_thread(save, file, file_location)
+            except OSError as e:
+                ingestion_queue.fail_file(job, file_location, e)
+                return
+            # parsed right away, while the other files of the request are still being written
+            ingestion_queue.submit_file(job, file_location)
+
+        await asyncio.gather(*(save_and_submit(file, location) for file, location in zip(files, file_locations)))
+        job_id = job.job_id
+    INGEST_LATENCY.observe(time.perf_counter() - start, stage="upload_request")
+
+    return JSONResponse(content={"message": "Files uploaded successfully", "job_id": job_id}, status_code=202)
+
+def _ingest_status(job_id):
+    if ingestion_spool is not None:
+        return ingestion_spool.get_status(job_id)
+    return ingestion_queue.get_status(job_id)
+
+@app.get("/ingest_status/{job_id}")
+async def ingest_status(job_id: str):
+    status = _ingest_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return status
 
-    return JSONResponse(content={"message": "Files uploaded successfully"}, status_code=200)
+@app.get("/ingest_progress/{job_id}")
+async def ingest_progress(job_id: str):
+    """Streams the status of an ingestion job as JSON lines, one per change (pages parsed, embedded, indexed)."""
+    if _ingest_status(job_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+
+    async def progress():
+        last = None
+        while True:
+            status = _ingest_status(job_id)
+            if status is None:
+                return
+            # elapsed_seconds changes on every check, it does not count as progress
+            current = {name: value for name, value in status.items() if name != "elapsed_seconds"}
+            if current != last:
+                last = current
+                yield json.dumps(status) + "\n"
+            if status["status"] in FINISHED_STATUSES:
+                return
+            await asyncio.sleep(INGEST_PROGRESS_INTERVAL)
+
+    return StreamingResponse(progress(), media_type="application/x-ndjson")
 
 class ChatMessage(BaseModel):
     message: str
     user_id: str
+    # restricts retrieval to one category folder of UPLOAD_DIRECTORY
+    category: Optional[str] = None
 
 @app.post("/chat_reply")
 async def chat_reply(chat_message: ChatMessage):
     user_message = chat_message.message
     user_id = chat_message.user_id
+    if not agent.ready:
+        raise HTTPException(status_code=503, detail="The models and the index are still loading",
+                            headers={"Retry-After": "5"})
+    # turned away before any retrieval work when the LLM queue is already full
+    if not agent.llm_scheduler.admits(user_id):
+        raise HTTPException(status_code=429, detail="Too many questions are waiting for an answer, please retry",
+                            headers={"Retry-After": str(agent.llm_scheduler.retry_after)})
     chat_history = chat_histories.get_history(user_id)
     print(f"User message: {user_message}")
-    generator = await agent.run(query_str=user_message, user_id=user_id, chat_history=chat_history)
-    return StreamingResponse(generator, media_type="text/plain")
+    # the pages retrieved for this turn are listed at /retrieval/{retrieval_id}
+    retrieval_id = uuid.uuid4().hex
+    try:
+        generator = await agent.run(query_str=user_message, user_id=user_id, chat_history=chat_history,
+                                    retrieval_id=retrieval_id, category=chat_message.category)
+    except LLMBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except WorkflowTimeoutError:
+        # the LLM or the retrieval was too slow for the turn, most likely under load
+        raise HTTPException(status_code=503, detail="The request timed out, please retry",
+                            headers={"Retry-After": str(agent.llm_scheduler.retry_after)})
+    chat_histories.add_message(user_id, user_message, MessageRole.USER)
+    return StreamingResponse(generator, media_type="text/plain", headers={"X-Retrieval-Id": retrieval_id})
 
 @app.post("/update_chat_history")
 async def update_chat_history(chat_message: ChatMessage):
@@ -83,6 +252,19 @@ async def update_chat_history(chat_message: ChatMessage):
     print("Chat history:", chat_histories.get_history(user_id))
     return {"message": "Chat history updated successfully"}
 
+@app.get("/ready")
+async def ready():
+    readiness = agent.readiness()
+    return JSONResponse(content=readiness, status_code=200 if readiness["ready"] else 503)
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache_stats")
+async def cache_stats():
+    return agent.cache_stats()
+
 @app.get("/categories")
 async def get_categories():
     try:
@@ -103,10 +285,65 @@ async def get_pdf(folder: str, pdf_filename: str):
     file_path = os.path.join(UPLOAD_DIRECTORY, folder, pdf_filename)
     return FileResponse(file_path, media_type="application/pdf")
 
-@app.get("/pdf_tmp/{pdf_filename}")
-async def get_pdf(pdf_filename: str):
-    file_path = os.path.join(TMP_DIR, pdf_filename)
-    return FileResponse(file_path, media_type="application/pdf")
+def _page_version(file_path, page_index):
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}:{page_index}:{stat.st_mtime_ns}:{stat.st_size}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def _resolve_upload_path(relative_path):
+    root = os.path.realpath(UPLOAD_DIRECTORY)
+    file_path = os.path.realpath(os.path.join(root, relative_path))
+    if not file_path.startswith(root + os.sep) or not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="Unknown file")
+    return file_path
+
+@app.get("/retrieval/{retrieval_id}")
+async def get_retrieval(retrieval_id: str):
+    pages = agent.retrievals.get(retrieval_id)
+    if pages is None:
+        raise HTTPException(status_code=404, detail="Unknown retrieval id")
+    manifest = []
+    for file_path, page_index, score in pages:
+        if not os.path.exists(file_path):
+            continue
+        relative_path = os.path.relpath(file_path, UPLOAD_DIRECTORY).replace(os.sep, "/")
+        manifest.append({
+            "file": relative_path,
+            "page_index": page_index,
+            "score": score,
+            # the version changes with the file, so the URL of a page can be cached forever
+            "url": f"/pages/{page_index}/{relative_path}?v={_page_version(file_path, page_index)}",
+        })
+    return {"retrieval_id": retrieval_id, "pages": manifest}
+
+@app.get("/pages/{page_index}/{file_path:path}")
+async def get_page(request: Request, page_index: int, file_path: str, v: Optional[str] = None):
+    if page_index < 0:
+        raise HTTPException(status_code=404, detail="Unknown page")
+    file_path = _resolve_upload_path(file_path)
+    version = _page_version(file_path, page_index)
+    etag = f'"{version}"'
+    # versioned URLs from a manifest never change content, others must be revalidated
+    cache_control = "private, max-age=31536000, immutable" if v == version else "no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    page_bytes = await asyncio.to_thread(agent.page_extractor.get_page, file_path, page_index)
+    if page_bytes is None:
+        raise HTTPException(status_code=404, detail="Unknown page")
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) != etag:
+        range_header = None
+    try:
+        byte_range = parse_byte_range(range_header, len(page_bytes))
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(page_bytes)}"})
+    if byte_range is None:
+        return Response(content=page_bytes, media_type="application/pdf", headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(page_bytes)}"
+    return Response(content=page_bytes[start:end + 1], status_code=206, media_type="application/pdf", headers=headers)
 
 # Mount the static files directory
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -118,5 +355,8 @@ async def read_index():
 
 if __name__ == "__main__":
     import uvicorn
-    agent = RAGAgent(PERSIST_DIR, UPLOAD_DIRECTORY, TMP_DIR)
-    uvicorn.run(app, host="localhost", port=8000) 
\ No newline at end of file
+    if WORKERS > 1:
+        # workers import this module on their own, the index is built by whichever becomes the writer
+        uvicorn.run("main:app", host="localhost", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="localhost", port=8000)
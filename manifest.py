@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+
+# 2: copies have nodes of their own, every node carries its category
+MANIFEST_VERSION = 2
+
+
+def file_sha256(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def text_sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class DocumentManifest:
+    """
+    Content-addressed record of what is in the index.
+
+    For every indexed file it keeps the SHA-256 of the file and, per page, the hash of the page
+    text and the ids of the nodes the page produced. A file whose content is already indexed
+    is not embedded again: an unchanged file is skipped, a copy of another file (renamed, or in
+    another category) gets nodes of its own made from the embedded nodes of the other file. For a
+    modified file only the pages whose text changed are re-embedded and the nodes of the replaced
+    or removed pages are reported for deletion.
+
+    Args:
+        path (str): Path of the JSON manifest file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        # manifests written before versions were recorded are version 1, so is a missing one: the index
+        # may predate the manifest
+        self.version = 1
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            self.files = data["files"]
+            self.version = data.get("version", 1)
+        self._index_hashes()
+
+    def _index_hashes(self):
+        # content hash -> path of an indexed file with that content, preferably not a copy
+        self._by_hash = {}
+        for file_path, entry in sorted(self.files.items(), key=lambda item: item[1]["duplicate_of"] is None):
+            # nothing can be copied from a file without pages, nor from a copy recorded by version 1
+            if entry["pages"]:
+                self._by_hash[entry["sha256"]] = file_path
+
+    def find_indexed_copy(self, file_path, sha256=None):
+        """
+        Returns:
+            str: `file_path` itself if its current content is indexed, the path of an indexed file
+            with the same content, or None.
+        """
+        sha256 = sha256 or file_sha256(file_path)
+        entry = self.files.get(file_path)
+        # version 1 recorded copies without nodes of their own, they are not really indexed
+        if entry is not None and entry["sha256"] == sha256 and (entry["pages"] or entry["duplicate_of"] is None):
+            return file_path
+        return self._by_hash.get(sha256)
+
+    def is_indexed_page(self, file_path, page_index, text):
+        """Whether `text` is what is indexed as page `page_index` of `file_path`."""
+        entry = self.files.get(file_path)
+        pages = entry["pages"] if entry is not None else []
+        return page_index < len(pages) and pages[page_index]["text_hash"] == text_sha256(text)
+
+    def diff(self, file_path, documents, pending=None):
+        """
+        Compares the parsed pages of a file with what is indexed for it.
+
+        Args:
+            file_path (str): The file, as stored in the documents' `file_path` metadata.
+            documents (list): Its page documents, with `page_index` metadata.
+            pending (dict): Entries of other files indexed in the same batch, so copies within a batch are caught.
+
+        Returns:
+            tuple: Pages to embed, ids of the nodes to delete, and the new manifest entry to pass to
+            `update` (None if the file is unchanged). The entry of a copy names the file it copies in
+            `duplicate_of`; no page is to be embedded, the caller copies the nodes of that file.
+        """
+        sha256 = file_sha256(file_path)
+        old_pages = self.files[file_path]["pages"] if file_path in self.files else []
+        copy_of = self.find_indexed_copy(file_path, sha256)
+        if copy_of is None:
+            copy_of = next((other_path for other_path, other in (pending or {}).items()
+                            if other["sha256"] == sha256 and other["duplicate_of"] is None), None)
+        if copy_of == file_path:
+            return [], [], None
+        if copy_of is not None:
+            stale_node_ids = [node_id for page in old_pages for node_id in page["node_ids"]]
+            pages = [{"text_hash": text_sha256(doc.text), "node_ids": []}
+                     for doc in sorted(documents, key=lambda doc: doc.metadata["page_index"])]
+            return [], stale_node_ids, {"sha256": sha256, "duplicate_of": copy_of, "pages": pages}
+
+        changed, stale_node_ids, pages = [], [], []
+        for doc in sorted(documents, key=lambda doc: doc.metadata["page_index"]):
+            page_index = doc.metadata["page_index"]
+            text_hash = text_sha256(doc.text)
+            if page_index < len(old_pages) and old_pages[page_index]["text_hash"] == text_hash:
+                pages.append(old_pages[page_index])
+                continue
+            if page_index < len(old_pages):
+                stale_node_ids.extend(old_pages[page_index]["node_ids"])
+            pages.append({"text_hash": text_hash, "node_ids": []})
+            changed.append(doc)
+        # pages the new version of the file no longer has
+        for page in old_pages[len(pages):]:
+            stale_node_ids.extend(page["node_ids"])
+        return changed, stale_node_ids, {"sha256": sha256, "duplicate_of": None, "pages": pages}
+
+    def update(self, entries, nodes):
+        """
+        Records the entries returned by `diff` once their nodes are indexed, and writes the manifest.
+
+        Args:
+            entries (dict): Maps file paths to their new entries.
+            nodes (list): The inserted nodes, their ids are attached to the pages they come from.
+        """
+        for node in nodes:
+            entry = entries.get(node.metadata["file_path"])
+            if entry is not None:
+                entry["pages"][int(node.metadata["page_index"])]["node_ids"].append(node.node_id)
+        self.files.update(entries)
+        # a copy of a modified file still has the old content, it becomes the file to copy from
+        self._index_hashes()
+        self._write()
+
+    def upgrade(self, forget=()):
+        """Marks the index as migrated to MANIFEST_VERSION, forgetting the files in `forget` (e.g. removed ones)."""
+        for file_path in forget:
+            self.files.pop(file_path, None)
+        self._index_hashes()
+        self.version = MANIFEST_VERSION
+        self._write()
+
+    def retain(self, file_paths):
+        """Forgets every file not in `file_paths`, e.g. the files of a build shard that never completed."""
+        file_paths = set(file_paths)
+        self.files = {file_path: entry for file_path, entry in self.files.items() if file_path in file_paths}
+        self._index_hashes()
+        self._write()
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "files": self.files}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,152 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cached lookup up to a slow LLM generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """Monotonically increasing value, optionally split by labels."""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Gauge:
+    """Value that goes up and down, optionally split by labels."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """
+    Prometheus-style cumulative histogram, optionally split by labels.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text.
+        labelnames (tuple): Label names, every `observe` call must pass all of them.
+        buckets (tuple): Upper bounds of the buckets, `+Inf` is added automatically.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, [("le", le)]), cumulative))
+                samples.append((f"{self.name}_sum", _format_labels(self.labelnames, key), total))
+                samples.append((f"{self.name}_count", _format_labels(self.labelnames, key), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STEP_LATENCY = REGISTRY.register(Histogram(
+    "rag_step_seconds", "Latency of each stage of a chat turn.", labelnames=("step",)))
+TIME_TO_FIRST_TOKEN = REGISTRY.register(Histogram(
+    "rag_time_to_first_token_seconds", "Time from the start of a chat turn to the first streamed token."))
+TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    "rag_generation_tokens_per_second", "Streamed chunks per second after the first token.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)))
+PROMPT_TOKENS = REGISTRY.register(Histogram(
+    "rag_prompt_tokens", "Estimated prompt tokens (history and packed context) sent to the LLM per answer.",
+    buckets=(128, 256, 512, 1024, 1536, 2048, 3072, 4096, 8192)))
+CHAT_TURNS = REGISTRY.register(Counter(
+    "rag_chat_turns_total", "Number of chat turns answered."))
+INGEST_LATENCY = REGISTRY.register(Histogram(
+    "rag_ingest_seconds", "Latency of each stage of the upload path.", labelnames=("stage",)))
+INGESTED_PAGES = REGISTRY.register(Counter(
+    "rag_ingested_pages_total", "Number of pages added to the index."))
+LLM_IN_FLIGHT = REGISTRY.register(Gauge(
+    "rag_llm_in_flight", "LLM requests (condensations and streamed answers) currently running."))
+LLM_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "rag_llm_queue_depth", "LLM requests waiting for a slot."))
+LLM_QUEUE_WAIT = REGISTRY.register(Histogram(
+    "rag_llm_queue_wait_seconds", "Time LLM requests waited for a slot."))
+LLM_REJECTED = REGISTRY.register(Counter(
+    "rag_llm_rejected_total", "LLM requests turned away by admission control.", labelnames=("reason",)))
@@ -0,0 +1,142 @@
+import asyncio
+import queue
+import threading
+import time
+
+from llama_index.core.schema import MetadataMode
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, error):
+    if not future.done():
+        future.set_exception(error)
+
+
+class BatchWorker:
+    """
+    Runs a blocking model call on dedicated threads so it never stalls the event loop.
+
+    Requests submitted concurrently are grouped into one `batch_fn` call: a worker takes the
+    first queued request, then waits up to `max_wait` seconds for more until the batch reaches
+    `max_batch_weight`. The queue is bounded, so a burst of requests waits for room instead of
+    piling up unbounded work.
+
+    Args:
+        batch_fn (callable): Maps a list of requests to a list of results (same order).
+        num_threads (int): Number of worker threads, each runs one batch at a time.
+        max_queue_size (int): Maximum number of requests waiting for a worker.
+        max_batch_weight (int): Maximum total weight of a batch.
+        max_wait (float): Seconds a worker waits for more requests before running a partial batch.
+        weight_fn (callable): Weight of a single request, 1 by default.
+        name (str): Prefix of the worker thread names.
+    """
+    def __init__(self, batch_fn, num_threads=1, max_queue_size=64, max_batch_weight=32, max_wait=0.005,
+                 weight_fn=None, name="batch-worker"):
+        self.batch_fn = batch_fn
+        self.max_batch_weight = max_batch_weight
+        self.max_wait = max_wait
+        self.weight_fn = weight_fn or (lambda request: 1)
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._threads = [
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True) for i in range(num_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def queue_size(self):
+        return self._queue.qsize()
+
+    async def submit(self, request):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        item = (request, loop, future)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # wait for room off the event loop
+            await asyncio.to_thread(self._queue.put, item)
+        return await future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            weight = self.weight_fn(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while weight < self.max_batch_weight:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                weight += self.weight_fn(item[0])
+
+            try:
+                results = self.batch_fn([request for request, _, _ in batch])
+            except Exception as e:
+                for _, loop, future in batch:
+                    loop.call_soon_threadsafe(_set_exception, future, e)
+                continue
+            for (_, loop, future), result in zip(batch, results):
+                loop.call_soon_threadsafe(_set_result, future, result)
+
+
+def colbert_rerank_batch(reranker, requests):
+    """
+    Scores the (query, passage) pairs of several rerank requests in one ColBERT forward pass.
+
+    Same MaxSim scoring as `ColbertRerank._calculate_sim`, but queries and passages are
+    encoded as padded batches without autograd instead of one passage at a time.
+
+    Args:
+        reranker (ColbertRerank): Provides the model, tokenizer and `top_n`.
+        requests (list): (query_str, nodes) tuples.
+
+    Returns:
+        list: Reranked `NodeWithScore` lists, one per request.
+    """
+    # torch is only imported once a reranker runs, not when the app starts
+    import torch
+
+    tokenizer, model = reranker._tokenizer, reranker._model
+    queries = [query_str for query_str, _ in requests]
+    passages, query_of_passage = [], []
+    for query_idx, (_, nodes) in enumerate(requests):
+        for node in nodes:
+            passages.append(str(node.node.get_content(metadata_mode=MetadataMode.EMBED)))
+            query_of_passage.append(query_idx)
+    if not passages:
+        return [[] for _ in requests]
+
+    with torch.no_grad():
+        query_encoding = tokenizer(queries, return_tensors="pt", padding=True)
+        query_embedding = torch.nn.functional.normalize(model(**query_encoding).last_hidden_state, dim=-1)
+        passage_encoding = tokenizer(passages, return_tensors="pt", padding=True, truncation=True, max_length=512)
+        passage_embedding = torch.nn.functional.normalize(model(**passage_encoding).last_hidden_state, dim=-1)
+
+        pair_query_idx = torch.tensor(query_of_passage)
+        query_mask = query_encoding["attention_mask"][pair_query_idx].bool()
+        passage_mask = passage_encoding["attention_mask"].bool()
+        # [pairs, query_length, passage_length] cosine similarities, padded passage tokens never win the max
+        sim_matrix = torch.bmm(query_embedding[pair_query_idx], passage_embedding.transpose(1, 2))
+        sim_matrix = sim_matrix.masked_fill(~passage_mask.unsqueeze(1), float("-inf"))
+        max_sim_scores = sim_matrix.max(dim=2).values.masked_fill(~query_mask, 0.0)
+        scores = (max_sim_scores.sum(dim=1) / query_mask.sum(dim=1)).tolist()
+
+    results = []
+    offset = 0
+    for _, nodes in requests:
+        for node, score in zip(nodes, scores[offset:offset + len(nodes)]):
+            if reranker.keep_retrieval_score:
+                node.node.metadata["retrieval_score"] = node.score
+            node.score = float(score)
+        offset += len(nodes)
+        results.append(sorted(nodes, key=lambda x: -x.score if x.score else 0)[:reranker.top_n])
+    return results
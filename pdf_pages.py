@@ -0,0 +1,198 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+from llama_index.core import Document
+from llama_index.core.readers.file.base import default_file_metadata_func
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from cache import LRUCache
+
+# MuPDF is not thread-safe, the fitz calls of all threads of the process go through this lock
+FITZ_LOCK = threading.Lock()
+
+# file metadata kept out of the embedded and prompted text, as SimpleDirectoryReader does
+EXCLUDED_FILE_METADATA_KEYS = ["file_name", "file_type", "file_size", "creation_date", "last_modified_date",
+                               "last_accessed_date"]
+
+
+def iter_pdf_pages(file_path, lock=FITZ_LOCK):
+    """
+    Extracts the pages of a PDF one at a time, so the first pages can be embedded while the
+    following ones are still being extracted.
+
+    The documents carry the metadata SimpleDirectoryReader would give them, plus their `page_index`.
+
+    Args:
+        file_path (str): The PDF.
+        lock: Held around every fitz call.
+
+    Yields:
+        Document: One per page, empty pages included so page indices match the PDF.
+    """
+    metadata = default_file_metadata_func(file_path)
+    with lock:
+        document = fitz.open(file_path)
+        num_pages = len(document)
+    try:
+        for page_index in range(num_pages):
+            with lock:
+                page = document.load_page(page_index)
+                text = page.get_text()
+                page_label = page.get_label() or str(page_index + 1)
+            yield Document(
+                text=text,
+                metadata={**metadata, "page_label": page_label, "page_index": page_index},
+                excluded_embed_metadata_keys=list(EXCLUDED_FILE_METADATA_KEYS),
+                excluded_llm_metadata_keys=list(EXCLUDED_FILE_METADATA_KEYS),
+            )
+    finally:
+        with lock:
+            document.close()
+
+
+class PageExtractor:
+    """
+    Extracts single pages of the indexed PDFs so they can be served one by one.
+
+    Source PDFs stay open in a small LRU pool instead of being re-opened for every question, and
+    every extracted page is cached as a one-page PDF keyed by (file, page_index, mtime), so a page
+    retrieved again is copied from memory and a file replaced on disk is never served stale.
+    PyMuPDF is not thread-safe, all fitz calls go through `FITZ_LOCK`.
+
+    Args:
+        max_open_documents (int): Number of source PDFs kept open.
+        max_cached_pages (int): Number of extracted pages kept in memory.
+        num_threads (int): Threads extracting retrieved pages in the background.
+    """
+    def __init__(self, max_open_documents=16, max_cached_pages=2048, num_threads=1):
+        self.max_open_documents = max_open_documents
+        self.page_cache = LRUCache(max_size=max_cached_pages)
+        self._documents = OrderedDict()
+        # also guards self._documents
+        self._lock = FITZ_LOCK
+        self._executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="pdf-pages")
+
+    def _open_document(self, file_path, mtime):
+        # caller holds self._lock
+        entry = self._documents.get(file_path)
+        if entry is not None and entry[0] == mtime:
+            self._documents.move_to_end(file_path)
+            return entry[1]
+        if entry is not None:
+            entry[1].close()
+        document = fitz.open(file_path)
+        self._documents[file_path] = (mtime, document)
+        while len(self._documents) > self.max_open_documents:
+            _, (_, evicted) = self._documents.popitem(last=False)
+            evicted.close()
+        return document
+
+    def get_page(self, file_path, page_index):
+        """
+        Returns:
+            bytes: A one-page PDF holding page `page_index` of `file_path`, None if the page does not exist.
+        """
+        # the same file may be referred to by relative and absolute paths
+        file_path = os.path.realpath(file_path)
+        mtime = os.path.getmtime(file_path)
+        key = (file_path, page_index, mtime)
+        page_bytes = self.page_cache.get(key)
+        if page_bytes is not None:
+            return page_bytes
+        with self._lock:
+            document = self._open_document(file_path, mtime)
+            if not 0 <= page_index < len(document):
+                return None
+            single_page = fitz.open()
+            single_page.insert_pdf(document, from_page=page_index, to_page=page_index)
+            page_bytes = single_page.tobytes()
+            single_page.close()
+        self.page_cache.put(key, page_bytes)
+        return page_bytes
+
+    def prefetch(self, pages):
+        for file_path, page_index in pages:
+            try:
+                self.get_page(file_path, page_index)
+            except Exception as e:
+                print(f"Failed to extract page {page_index} of {file_path}: {e}")
+
+    def submit_prefetch(self, pages):
+        """Extracts (file_path, page_index) pages into the cache on the background threads."""
+        return self._executor.submit(self.prefetch, pages)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for _, document in self._documents.values():
+                document.close()
+            self._documents.clear()
+
+
+def unique_pages(nodes):
+    """
+    Returns:
+        list: (file_path, page_index, score) of the pages the nodes come from, in retrieval order,
+        every page once with the best score among its nodes.
+    """
+    pages = OrderedDict()
+    for node in nodes:
+        key = (node.metadata['file_path'], int(node.metadata['page_index']))
+        score = node.score or 0.0
+        pages[key] = max(pages.get(key, score), score)
+    return [(file_path, page_index, score) for (file_path, page_index), score in pages.items()]
+
+
+def _stitch_chunks(chunks):
+    """Text of the chunks of one page in page order, the overlap of neighbouring chunks kept once."""
+    chunks = sorted(chunks, key=lambda chunk: chunk.start_char_idx if chunk.start_char_idx is not None else -1)
+    parts, end = [], None
+    for chunk in chunks:
+        text, start = chunk.text, chunk.start_char_idx
+        if end is not None and start is not None and start < end:
+            # overlapping neighbour, continue where the previous chunk stopped
+            text = text[end - start:]
+            if parts and text:
+                parts[-1] += text
+        elif text:
+            parts.append(text)
+        if start is not None:
+            end = max(end or 0, start + len(chunk.text))
+    return "\n\n".join(parts)
+
+
+def merge_page_nodes(nodes):
+    """
+    Merges the hits of several chunks of one page into a single node.
+
+    Args:
+        nodes (list): `NodeWithScore` hits, best first.
+
+    Returns:
+        list: One `NodeWithScore` per page, in the order of the best chunk of every page, scored with
+        that chunk's score. A merged node keeps the id and metadata of the best chunk and the text of
+        all the hit chunks in page order.
+    """
+    pages = OrderedDict()
+    for node in nodes:
+        key = (node.node.metadata.get('file_path'), node.node.metadata.get('page_index'))
+        pages.setdefault(key, []).append(node)
+    merged = []
+    for hits in pages.values():
+        if len(hits) == 1:
+            merged.append(hits[0])
+            continue
+        best = hits[0].node
+        node = TextNode(
+            id_=best.node_id,
+            text=_stitch_chunks([hit.node for hit in hits]),
+            metadata=dict(best.metadata),
+            excluded_embed_metadata_keys=list(best.excluded_embed_metadata_keys),
+            excluded_llm_metadata_keys=list(best.excluded_llm_metadata_keys),
+            relationships=dict(best.relationships),
+        )
+        merged.append(NodeWithScore(node=node, score=hits[0].score))
+    return merged
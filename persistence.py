@@ -0,0 +1,115 @@
+import fcntl
+import json
+import os
+
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+
+
+class SegmentLog:
+    """
+    Append-only log of indexed nodes (with their embeddings), one JSON line per node.
+
+    Every call to `append` writes a new numbered segment file, so persisting an upload
+    costs I/O proportional to the upload instead of to the whole index. Segments are
+    folded back into the full storage context by `RAGAgent.compact_index`.
+
+    Args:
+        segment_dir (str): Directory holding the segment files.
+    """
+    PREFIX = "segment-"
+    SUFFIX = ".jsonl"
+
+    def __init__(self, segment_dir):
+        self.segment_dir = segment_dir
+        os.makedirs(self.segment_dir, exist_ok=True)
+
+    def segment_paths(self):
+        names = sorted(
+            name for name in os.listdir(self.segment_dir)
+            if name.startswith(self.PREFIX) and name.endswith(self.SUFFIX)
+        )
+        return [os.path.join(self.segment_dir, name) for name in names]
+
+    def __len__(self):
+        return len(self.segment_paths())
+
+    def append(self, nodes):
+        """
+        Writes the nodes to a new segment file.
+
+        Args:
+            nodes (list): Nodes to persist, including their `embedding`.
+
+        Returns:
+            tuple: Name of the written segment and the byte offset of every node in it (see `read_node`).
+        """
+        paths = self.segment_paths()
+        next_id = int(os.path.basename(paths[-1])[len(self.PREFIX):-len(self.SUFFIX)]) + 1 if paths else 0
+        segment_name = f"{self.PREFIX}{next_id:08d}{self.SUFFIX}"
+        segment_path = os.path.join(self.segment_dir, segment_name)
+        tmp_path = segment_path + ".tmp"
+        offsets = []
+        with open(tmp_path, "wb") as f:
+            for node in nodes:
+                offsets.append(f.tell())
+                f.write((json.dumps(doc_to_json(node)) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        # a segment only becomes visible once it is complete
+        os.replace(tmp_path, segment_path)
+        return segment_name, offsets
+
+    def read_node(self, segment_name, offset):
+        with open(os.path.join(self.segment_dir, segment_name), "rb") as f:
+            f.seek(offset)
+            return json_to_doc(json.loads(f.readline()))
+
+    def iter_nodes(self):
+        for segment_path in self.segment_paths():
+            with open(segment_path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        yield json_to_doc(json.loads(line))
+
+    def clear(self):
+        for segment_path in self.segment_paths():
+            os.remove(segment_path)
+
+
+class WriterLock:
+    """
+    Exclusive, non-blocking lock on a file, used to elect the one process allowed to write the index.
+
+    The lock is released by the OS when the holding process exits, so a crashed writer never blocks
+    its replacement.
+
+    Args:
+        lock_path (str): Path of the lock file.
+    """
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._file = None
+
+    def acquire(self):
+        """Returns True if this process now holds the lock."""
+        if self._file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        f = open(self.lock_path, "a+")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
@@ -0,0 +1,232 @@
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in",
+    "is", "it", "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "where", "which",
+    "who", "why", "with", "you",
+}
+
+
+def tokenize(text):
+    """Lower-cased terms; dotted/dashed tokens such as course codes ("cs-101") or "l2.norm" stay whole."""
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuses several rankings of ids with reciprocal-rank fusion.
+
+    Args:
+        rankings (list): Lists of ids, best first.
+        k (int): Damping constant, larger values flatten the contribution of the top ranks.
+
+    Returns:
+        list: (id, fused score) tuples, best first.
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            scores[item_id] += 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+class BM25Index:
+    """
+    Inverted index over node texts, scored with Okapi BM25.
+
+    Postings live in memory. Every change is appended to a JSON-lines log (one line per added node,
+    one per deletion) that is replayed on load and rewritten by `compact`. As with NumpyVectorStore,
+    a `read_only` instance in another process follows the writer with `refresh`.
+
+    Args:
+        path (str): Path of the log file.
+        k1 (float): Term frequency saturation.
+        b (float): Document length normalization.
+        read_only (bool): Never write the log, another process owns it.
+    """
+    def __init__(self, path, k1=1.2, b=0.75, read_only=False):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        with self._lock:
+            self._load()
+
+    def _reset(self):
+        # node_id -> (ref_doc_id, category, length, term frequencies)
+        self._docs = {}
+        # term -> {node_id: term frequency}
+        self._postings = defaultdict(dict)
+        self._total_length = 0
+        self._num_deleted = 0
+        self._offset = 0
+        self._inode = None
+
+    def _load(self):
+        self._reset()
+        if not os.path.exists(self.path):
+            return
+        self._inode = os.stat(self.path).st_ino
+        self._apply_new_lines()
+
+    def _apply_new_lines(self):
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        lines = data[:end].decode("utf-8").splitlines()
+        for line in lines:
+            entry = json.loads(line)
+            if "del" in entry:
+                for node_id in entry["del"]:
+                    self._remove(node_id)
+                    self._num_deleted += 1
+            else:
+                self._insert(entry["id"], entry["doc"], entry["cat"], entry["tf"])
+        return len(lines) > 0
+
+    def _insert(self, node_id, ref_doc_id, category, term_frequencies):
+        self._remove(node_id)
+        length = sum(term_frequencies.values())
+        self._docs[node_id] = (ref_doc_id, category, length, term_frequencies)
+        self._total_length += length
+        for term, frequency in term_frequencies.items():
+            self._postings[term][node_id] = frequency
+
+    def _remove(self, node_id):
+        doc = self._docs.pop(node_id, None)
+        if doc is None:
+            return
+        self._total_length -= doc[2]
+        for term in doc[3]:
+            postings = self._postings[term]
+            postings.pop(node_id, None)
+            if not postings:
+                del self._postings[term]
+
+    def _append(self, entries):
+        if self.read_only:
+            raise RuntimeError(f"BM25Index at {self.path} is read-only in this process")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+            self._offset = f.tell()
+        self._inode = os.stat(self.path).st_ino
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, nodes, text_fn):
+        """
+        Indexes the nodes (replacing nodes with the same id).
+
+        Args:
+            nodes (list): Nodes to index.
+            text_fn (callable): Maps a node to the text to index.
+        """
+        entries = [
+            {"id": node.node_id, "doc": node.ref_doc_id, "cat": node.metadata.get("category"),
+             "tf": dict(Counter(tokenize(text_fn(node))))}
+            for node in nodes
+        ]
+        if not entries:
+            return
+        with self._lock:
+            self._append(entries)
+            for entry in entries:
+                self._insert(entry["id"], entry["doc"], entry["cat"], entry["tf"])
+
+    def delete(self, node_ids):
+        with self._lock:
+            node_ids = [node_id for node_id in node_ids if node_id in self._docs]
+            if not node_ids:
+                return
+            self._append([{"del": node_ids}])
+            for node_id in node_ids:
+                self._remove(node_id)
+            self._num_deleted += len(node_ids)
+
+    def retain_ref_docs(self, ref_doc_ids):
+        """Deletes the nodes of every document not in `ref_doc_ids`."""
+        ref_doc_ids = set(ref_doc_ids)
+        self.delete([node_id for node_id, doc in list(self._docs.items()) if doc[0] not in ref_doc_ids])
+
+    def clear(self):
+        with self._lock:
+            if self.read_only:
+                raise RuntimeError(f"BM25Index at {self.path} is read-only in this process")
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._reset()
+
+    def should_compact(self, max_deleted_ratio=0.2):
+        return self._num_deleted > max_deleted_ratio * max(len(self._docs), 1)
+
+    def compact(self):
+        """Rewrites the log with the live nodes only."""
+        with self._lock:
+            if self.read_only:
+                raise RuntimeError(f"BM25Index at {self.path} is read-only in this process")
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                for node_id, (ref_doc_id, category, _, term_frequencies) in self._docs.items():
+                    f.write(json.dumps({"id": node_id, "doc": ref_doc_id, "cat": category, "tf": term_frequencies}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+                offset = f.tell()
+            os.replace(tmp_path, self.path)
+            self._offset = offset
+            self._inode = os.stat(self.path).st_ino
+            self._num_deleted = 0
+
+    def refresh(self):
+        """Applies what the writer process logged since the last load, returns True if anything changed."""
+        if not self.read_only:
+            return False
+        with self._lock:
+            if not os.path.exists(self.path):
+                changed = len(self._docs) > 0
+                self._reset()
+                return changed
+            if os.stat(self.path).st_ino != self._inode:
+                # compacted or cleared by the writer
+                self._load()
+                return True
+            return self._apply_new_lines()
+
+    def search(self, query_str, top_k=20, category=None):
+        """
+        Returns:
+            list: (node_id, BM25 score) of the `top_k` best matching nodes, best first.
+        """
+        terms = set(tokenize(query_str))
+        with self._lock:
+            num_docs = len(self._docs)
+            if num_docs == 0 or not terms:
+                return []
+            average_length = self._total_length / num_docs
+            scores = defaultdict(float)
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for node_id, frequency in postings.items():
+                    _, node_category, length, _ = self._docs[node_id]
+                    if category is not None and node_category != category:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[node_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
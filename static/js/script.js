@@ -60,13 +60,35 @@ function toggleMenu() {
 }
 
 function displayPDF(pdfFilePath) {
-    // Get the PDF viewer element
-    const pdfViewer = document.getElementById('pdf-viewer');
+    // Retrieved pages may have replaced the single viewer, bring it back
+    const documentContainer = document.getElementById('document-container');
+    let pdfViewer = document.getElementById('pdf-viewer');
+    if (!pdfViewer) {
+        documentContainer.innerHTML = '<iframe id="pdf-viewer" width="100%" height="100%"></iframe>';
+        pdfViewer = document.getElementById('pdf-viewer');
+    }
 
     // Set the src attribute to display the PDF
     pdfViewer.src = pdfFilePath;
 }
 
+// Show the pages retrieved for one chat turn, one viewer per page so the browser caches them across turns
+async function displayRetrievedPages(retrievalId) {
+    const response = await fetch("/retrieval/" + retrievalId);
+    if (!response.ok) throw new Error("Failed to fetch retrieved pages");
+    const manifest = await response.json();
+
+    const documentContainer = document.getElementById('document-container');
+    documentContainer.innerHTML = '';
+    manifest.pages.forEach(page => {
+        const pageViewer = document.createElement('iframe');
+        pageViewer.classList.add('page-viewer');
+        pageViewer.title = `${page.file} (page ${page.page_index + 1})`;
+        pageViewer.src = page.url;
+        documentContainer.appendChild(pageViewer);
+    });
+}
+
 // Fetch and display directory structure
 async function fetchDirectoryStructure() {
     const response = await fetch('/categories');
@@ -76,6 +98,7 @@ async function fetchDirectoryStructure() {
     let activeItem = null; // Track the currently active item
 
     directoryStructure.innerHTML = ''; // Clear existing content
+    updateChatCategories(Object.keys(data.directory_structure));
 
     Object.entries(data.directory_structure).forEach(([folder, files]) => {
         const folderItem = document.createElement('li');
@@ -143,6 +166,20 @@ async function fetchDirectoryStructure() {
     });
 }
 
+// Keep the category selector of the chat in sync with the folders
+function updateChatCategories(categories) {
+    const categorySelect = document.getElementById('chat-category');
+    const selected = categorySelect.value;
+    categorySelect.innerHTML = '<option value="">All documents</option>';
+    categories.forEach(category => {
+        const option = document.createElement('option');
+        option.value = category;
+        option.textContent = category;
+        categorySelect.appendChild(option);
+    });
+    categorySelect.value = categories.includes(selected) ? selected : '';
+}
+
 // Fetch categories
 let preloadedCategories = [];
 async function fetchCategories() {
@@ -226,7 +263,13 @@ async function uploadFiles() {
         });
 
         if (response.ok) {
-            alert("Files uploaded successfully!");
+            const data = await response.json();
+            const status = await waitForIngestion(data.job_id);
+            if (status.status !== "done") {
+                alert("Some files could not be indexed: " + status.error);
+            } else {
+                alert("Files uploaded successfully!");
+            }
             fileInput.value = "";
             document.getElementById("category").value = "";
             closeModal();
@@ -243,6 +286,32 @@ async function uploadFiles() {
     }
 }
 
+// Follow the ingestion job until all uploaded files are parsed and indexed, the server streams
+// one JSON line per change as pages are extracted, embedded and indexed
+async function waitForIngestion(jobId) {
+    const response = await fetch("/ingest_progress/" + jobId);
+    if (!response.ok) throw new Error("Failed to fetch ingestion status");
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder("utf-8");
+    let buffered = "";
+    let status = null;
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffered += decoder.decode(value, { stream: true });
+        const lines = buffered.split("\n");
+        buffered = lines.pop();
+        for (const line of lines) {
+            if (!line.trim()) continue;
+            status = JSON.parse(line);
+            console.log(`Indexed ${status.files_done}/${status.files_total} files ` +
+                `(${status.pages_parsed} pages parsed, ${status.pages_embedded} embedded, ${status.pages_indexed} indexed)`);
+        }
+    }
+    if (status === null) throw new Error("Ingestion status stream ended early");
+    return status;
+}
+
 function getUserId() {
     let userId = localStorage.getItem('userId');
     if (!userId) {
@@ -256,6 +325,7 @@ function getUserId() {
 async function sendMessage() {
     const inputField = document.getElementById("chat-input");
     const message = inputField.value.trim();
+    const category = document.getElementById("chat-category").value || null;
     user_id = getUserId();
     console.log(JSON.stringify({ message, user_id }));
     var answer = "";
@@ -270,11 +340,24 @@ async function sendMessage() {
                 headers: {
                     "Content-Type": "application/json"
                 },
-                body: JSON.stringify({ message, user_id })
+                body: JSON.stringify({ message, user_id, category })
             });
 
+            if (response.status === 503) {
+                // the server is still loading its models and index
+                addMessageToChat("The assistant is still starting up, please try again in a few seconds.", "bot");
+                return;
+            }
+            if (response.status === 429) {
+                // too many questions are waiting for the LLM
+                const retryAfter = response.headers.get("Retry-After") || "a few";
+                addMessageToChat(`The assistant is busy, please try again in ${retryAfter} seconds.`, "bot");
+                return;
+            }
             if (!response.ok) throw new Error("Network response was not ok");
-            
+
+            const retrievalId = response.headers.get("X-Retrieval-Id");
+
             // Create a message element for the bot's response
             const botMessageElem = addMessageToChat("", "bot");
 
@@ -300,11 +383,9 @@ async function sendMessage() {
                 const chatMessages = document.getElementById("chat-messages");
                 chatMessages.scrollTop = chatMessages.scrollHeight;
 
-                if (pdf_being_set == false) {
-                    // Display the retrieved PDF data
-                    const pdfFilePath = "/pdf_tmp/" + user_id + "_tmp_result.pdf";
-                    // Display the PDF file
-                    displayPDF(pdfFilePath);
+                if (pdf_being_set == false && retrievalId) {
+                    // Display the retrieved pages
+                    displayRetrievedPages(retrievalId).catch(error => console.error("Error displaying pages:", error));
                     pdf_being_set = true;
                 }
 
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules live at the repository root, next to main.py
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
@@ -0,0 +1,52 @@
+import time
+
+from cache import LRUCache, SQLiteCache
+
+
+def test_lru_cache_evicts_least_recently_used_and_counts_hits():
+    cache = LRUCache(max_size=2)
+    assert cache.stats() == {"size": 0, "max_size": 2, "hits": 0, "misses": 0, "hit_rate": None}
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "max_size": 2, "hits": 2, "misses": 1, "hit_rate": 0.6667}
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(ttl=0.01)
+    cache.put("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a", "gone") == "gone"
+    assert len(cache) == 0
+
+
+def test_sqlite_cache_is_shared_through_the_file(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    writer = SQLiteCache(db_path, "retrievals")
+    reader = SQLiteCache(db_path, "retrievals")
+    other_table = SQLiteCache(db_path, "other")
+    writer.put("id", [("file.pdf", 3)])
+    assert reader.get("id") == [["file.pdf", 3]]
+    assert other_table.get("id") is None
+    assert reader.get("missing", "default") == "default"
+    assert reader.stats() == {"size": 1, "max_size": 1024, "hits": 1, "misses": 1, "hit_rate": 0.5}
+    assert writer.stats()["hits"] == 0
+    reader.clear()
+    assert len(writer) == 0
+
+
+def test_sqlite_cache_evicts_expired_and_excess_entries(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.db"), "retrievals", max_size=2, evict_every=1)
+    for key in "abc":
+        cache.put(key, key)
+        time.sleep(0.001)
+    assert len(cache) == 2
+    assert cache.get("a") is None and cache.get("c") == "c"
+
+    expiring = SQLiteCache(str(tmp_path / "expiring.db"), "retrievals", ttl=0.01)
+    expiring.put("a", 1)
+    time.sleep(0.02)
+    assert expiring.get("a") is None
@@ -0,0 +1,66 @@
+from context_packing import pack_context, split_passages
+from history import estimate_tokens
+
+
+def sentences(topic, count):
+    return " ".join(f"Sentence {i} explains {topic} detail number {i}." for i in range(count))
+
+
+def test_split_keeps_short_paragraphs_whole():
+    text = "First paragraph\nwrapped over lines.\n\nSecond paragraph."
+    assert split_passages(text, max_tokens=64) == ["First paragraph wrapped over lines.", "Second paragraph."]
+
+
+def test_split_cuts_long_paragraphs_within_the_budget():
+    text = sentences("graphs", 40) + "\n\n" + " ".join(["word"] * 500)
+    passages = split_passages(text, max_tokens=32)
+    assert len(passages) > 2
+    assert all(len(passage) <= 32 * 4 for passage in passages)
+    # sentences are never cut when they fit, words never
+    assert all(passage.endswith(".") for passage in passages if "Sentence" in passage)
+    assert all(set(passage.split()) == {"word"} for passage in passages if "Sentence" not in passage)
+    assert " ".join(passages).split() == text.split()
+
+
+def test_repeated_passages_are_dropped():
+    footer = "University of Example, Department of Computer Science, all rights reserved"
+    pages = [("a.pdf page 1", f"Exam dates are in June.\n\n{footer}"),
+             ("a.pdf page 2", f"Exam rules forbid notes.\n\n{footer}")]
+    context, stats = pack_context("exam", pages, max_tokens=None)
+    assert context.count(footer) == 1
+    assert stats["context_duplicates"] == 1
+    assert stats["context_truncated"] == 0
+    assert context.index("a.pdf page 1") < context.index("a.pdf page 2")
+
+
+def test_budget_prefers_matching_passages_and_marks_gaps():
+    text = "\n\n".join([
+        "The course introduces algorithms.",
+        sentences("history", 6),
+        "The final exam takes place on June 12.",
+        sentences("history", 6).replace("history", "background"),
+        "Late submissions lose ten percent.",
+    ])
+    context, stats = pack_context("When is the final exam?", [("syllabus.pdf page 3", text)], max_tokens=40)
+    assert stats["context_tokens"] <= 40 + 1
+    assert stats["context_truncated"] > 0
+    assert "The final exam takes place on June 12." in context
+    assert "history" not in context
+    assert context.startswith("syllabus.pdf page 3\n")
+    assert "..." in context.split("\n")
+
+
+def test_budget_takes_turns_across_pages():
+    pages = [(f"p{i}.pdf", "\n\n".join(f"Exam topic {i}-{j} is covered." for j in range(5))) for i in range(3)]
+    context, stats = pack_context("exam topic", pages, max_tokens=60)
+    # every page gets its best passage before any page gets a second one
+    assert all(f"p{i}.pdf" in context for i in range(3))
+    assert estimate_tokens(context) <= 60 + len(pages)
+    assert stats["context_passages"] < 15
+
+
+def test_no_budget_keeps_everything_in_reading_order():
+    text = "Alpha one.\n\nBeta two.\n\nGamma three."
+    context, stats = pack_context("gamma", [("", text)], max_tokens=None)
+    assert context == "Alpha one.\nBeta two.\nGamma three."
+    assert stats["context_passages"] == 3
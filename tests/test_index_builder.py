@@ -0,0 +1,46 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import index_builder
+from index_builder import BuildState, iter_parsed_batches
+
+
+def test_files_that_fail_to_parse_are_left_out(tmp_path):
+    good = tmp_path / "notes.txt"
+    good.write_text("lecture notes")
+    broken = tmp_path / "broken.pdf"
+    broken.write_bytes(b"not a pdf")
+    batches = list(iter_parsed_batches([str(good), str(broken)], num_workers=2, batch_size=1))
+    assert [list(batch) for batch in batches] == [[str(good)]]
+
+    state = BuildState(str(tmp_path / "build_state.json"))
+    state.start()
+    for batch in batches:
+        state.mark_completed(batch)
+    # the broken file is parsed again by a resumed build
+    assert list(BuildState(state.path).completed) == [str(good)]
+
+
+class BrokenPool:
+    """Stands in for a pool whose worker died, every pending future fails."""
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("A process in the process pool was terminated abruptly"))
+        return future
+
+
+def test_a_crashed_worker_stops_the_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_builder, "ProcessPoolExecutor", BrokenPool)
+    with pytest.raises(BrokenProcessPool):
+        list(iter_parsed_batches([str(tmp_path / "a.txt"), str(tmp_path / "b.txt")], num_workers=2))
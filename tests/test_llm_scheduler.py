@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+from llm_scheduler import LLMBusyError, LLMScheduler
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def waiter(scheduler, user_id, order, **kwargs):
+    """Acquires a slot for `user_id` and records the order in which waiters got one."""
+    await scheduler.acquire(user_id, **kwargs)
+    order.append(user_id)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_admits_up_to_max_in_flight_without_queueing():
+    async def scenario():
+        scheduler = LLMScheduler(max_in_flight=2)
+        await scheduler.acquire("a")
+        await scheduler.acquire("b")
+        assert scheduler.stats() == {"in_flight": 2, "waiting": 0, "waiting_users": 0}
+        scheduler.release()
+        scheduler.release()
+        assert scheduler.stats() == {"in_flight": 0, "waiting": 0, "waiting_users": 0}
+    run(scenario())
+
+
+def test_rejects_when_queue_is_full():
+    async def scenario():
+        scheduler = LLMScheduler(max_in_flight=1, max_queue_size=2, max_queued_per_user=5)
+        await scheduler.acquire("a")
+        tasks = [asyncio.create_task(scheduler.acquire(user)) for user in ("b", "c")]
+        await settle()
+        assert not scheduler.admits("d")
+        with pytest.raises(LLMBusyError, match="already waiting"):
+            await scheduler.acquire("d")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert scheduler.stats()["waiting"] == 0
+    run(scenario())
+
+
+def test_rejects_a_user_over_its_queue_limit():
+    async def scenario():
+        scheduler = LLMScheduler(max_in_flight=1, max_queued_per_user=1, retry_after=7)
+        await scheduler.acquire("a")
+        task = asyncio.create_task(scheduler.acquire("b"))
+        await settle()
+        assert not scheduler.admits("b") and scheduler.admits("c")
+        with pytest.raises(LLMBusyError) as error:
+            await scheduler.acquire("b")
+        assert error.value.retry_after == 7
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    run(scenario())
+
+
+def test_times_out_and_leaves_the_queue():
+    async def scenario():
+        scheduler = LLMScheduler(max_in_flight=1, max_wait=0.05)
+        await scheduler.acquire("a")
+        with pytest.raises(LLMBusyError, match="within"):
+            await scheduler.acquire("b")
+        assert scheduler.stats() == {"in_flight": 1, "waiting": 0, "waiting_users": 0}
+        # the caller's own budget is shorter than the scheduler's wait
+        scheduler.max_wait = 30.0
+        start = asyncio.get_running_loop().time()
+        with pytest.raises(LLMBusyError):
+            await scheduler.acquire("b", max_wait=0.05)
+        assert asyncio.get_running_loop().time() - start < 1.0
+    run(scenario())
+
+
+def test_rejects_right_away_without_time_left():
+    async def scenario():
+        scheduler = LLMScheduler(max_in_flight=1)
+        await scheduler.acquire("a")
+        with pytest.raises(LLMBusyError, match="no time left"):
+            await scheduler.acquire("b", max_wait=0)
+        assert scheduler.stats()["waiting"] == 0
+        scheduler.release()
+        # a free slot is taken whatever the budget
+        await scheduler.acquire("b", max_wait=0)
+        assert scheduler.stats()["in_flight"] == 1
+    run(scenario())
+
+
+def test_release_hands_slots_round_robin_across_users():
+    async def scenario():
+        scheduler = LLMScheduler(max_in_flight=1, max_queued_per_user=3)
+        await scheduler.acquire("holder")
+        order = []
+        tasks = []
+        for user in ("a", "a", "a", "b", "c"):
+            tasks.append(asyncio.create_task(waiter(scheduler, user, order)))
+            await settle()
+        for _ in tasks:
+            scheduler.release()
+            await settle()
+            # the slot is handed over, never freed while someone waits
+            assert scheduler.stats()["in_flight"] == 1
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b", "c", "a", "a"]
+        scheduler.release()
+        assert scheduler.stats() == {"in_flight": 0, "waiting": 0, "waiting_users": 0}
+    run(scenario())
+
+
+def test_cancelled_waiter_does_not_keep_a_slot():
+    async def scenario():
+        scheduler = LLMScheduler(max_in_flight=1)
+        await scheduler.acquire("a")
+        cancelled = asyncio.create_task(scheduler.acquire("b"))
+        order = []
+        remaining = asyncio.create_task(waiter(scheduler, "c", order))
+        await settle()
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert scheduler.stats()["waiting"] == 1
+        scheduler.release()
+        await remaining
+        assert order == ["c"]
+        scheduler.release()
+        assert scheduler.stats()["in_flight"] == 0
+    run(scenario())
+
+
+def test_slot_releases_on_error():
+    async def scenario():
+        scheduler = LLMScheduler(max_in_flight=1)
+        with pytest.raises(RuntimeError):
+            async with scheduler.slot("a"):
+                assert scheduler.stats()["in_flight"] == 1
+                raise RuntimeError("generation failed")
+        assert scheduler.stats()["in_flight"] == 0
+    run(scenario())
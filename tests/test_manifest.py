@@ -0,0 +1,128 @@
+import json
+
+import pytest
+from llama_index.core import Document
+
+from manifest import MANIFEST_VERSION, DocumentManifest
+
+
+def write_file(path, pages):
+    path.write_text("\f".join(pages))
+    return str(path)
+
+
+def page_documents(file_path, pages):
+    return [Document(text=text, metadata={"file_path": file_path, "page_index": i}) for i, text in enumerate(pages)]
+
+
+def index(manifest, file_path, pages, pending=None):
+    """Diffs and records a file the way the agent does, one node per embedded page."""
+    changed, stale, entry = manifest.diff(file_path, page_documents(file_path, pages), pending=pending)
+    if entry is not None:
+        nodes = [Document(text=doc.text, id_=f"{file_path}#{doc.metadata['page_index']}-{len(doc.text)}",
+                          metadata=dict(doc.metadata)) for doc in changed]
+        manifest.update({file_path: entry}, nodes)
+    return changed, stale, entry
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    return DocumentManifest(str(tmp_path / "index" / "manifest.json"))
+
+
+def test_unchanged_file_is_skipped(manifest, tmp_path):
+    pages = ["first page", "second page"]
+    file_path = write_file(tmp_path / "a.pdf", pages)
+    changed, stale, entry = index(manifest, file_path, pages)
+    assert [doc.text for doc in changed] == pages and stale == [] and entry["duplicate_of"] is None
+
+    assert manifest.find_indexed_copy(file_path) == file_path
+    assert index(manifest, file_path, pages) == ([], [], None)
+
+
+def test_modified_file_reembeds_only_changed_pages(manifest, tmp_path):
+    file_path = write_file(tmp_path / "a.pdf", ["one", "two", "three"])
+    index(manifest, file_path, ["one", "two", "three"])
+    old_ids = [page["node_ids"] for page in manifest.files[file_path]["pages"]]
+
+    write_file(tmp_path / "a.pdf", ["one", "TWO"])
+    changed, stale, entry = index(manifest, file_path, ["one", "TWO"])
+    assert [doc.text for doc in changed] == ["TWO"]
+    # the replaced second page and the removed third one
+    assert sorted(stale) == sorted(old_ids[1] + old_ids[2])
+    assert manifest.files[file_path]["pages"][0]["node_ids"] == old_ids[0]
+    assert manifest.is_indexed_page(file_path, 1, "TWO")
+    assert not manifest.is_indexed_page(file_path, 2, "three")
+
+
+def test_copy_is_recorded_with_its_own_pages(manifest, tmp_path):
+    pages = ["shared page"]
+    original = write_file(tmp_path / "a.pdf", pages)
+    copy = write_file(tmp_path / "b.pdf", pages)
+    index(manifest, original, pages)
+
+    changed, stale, entry = manifest.diff(copy, page_documents(copy, pages))
+    assert changed == [] and stale == []
+    assert entry["duplicate_of"] == original
+    assert [page["node_ids"] for page in entry["pages"]] == [[]]
+    # the agent copies the original's nodes, here a node with the copy's path
+    manifest.update({copy: entry}, [Document(text="shared page", id_="copy-node",
+                                              metadata={"file_path": copy, "page_index": 0})])
+    assert manifest.files[copy]["pages"][0]["node_ids"] == ["copy-node"]
+    assert manifest.find_indexed_copy(copy) == copy
+
+
+def test_copy_outlives_a_modified_original(manifest, tmp_path):
+    pages = ["shared page"]
+    original = write_file(tmp_path / "a.pdf", pages)
+    copy = write_file(tmp_path / "b.pdf", pages)
+    index(manifest, original, pages)
+    _, _, entry = manifest.diff(copy, page_documents(copy, pages))
+    manifest.update({copy: entry}, [Document(text="shared page", id_="copy-node",
+                                              metadata={"file_path": copy, "page_index": 0})])
+
+    write_file(tmp_path / "a.pdf", ["new content"])
+    index(manifest, original, ["new content"])
+    # a third file with the old content is now copied from the copy, whose nodes are still indexed
+    third = write_file(tmp_path / "c.pdf", pages)
+    assert manifest.find_indexed_copy(third) == copy
+    assert manifest.files[copy]["pages"][0]["node_ids"] == ["copy-node"]
+
+
+def test_copy_within_one_batch(manifest, tmp_path):
+    pages = ["same"]
+    original = write_file(tmp_path / "a.pdf", pages)
+    copy = write_file(tmp_path / "b.pdf", pages)
+    pending = {}
+    _, _, pending[original] = manifest.diff(original, page_documents(original, pages))
+    _, _, entry = manifest.diff(copy, page_documents(copy, pages), pending=pending)
+    assert entry["duplicate_of"] == original
+
+
+def test_version_1_copies_are_not_taken_for_indexed(tmp_path):
+    pages = ["shared page"]
+    original = write_file(tmp_path / "a.pdf", pages)
+    copy = write_file(tmp_path / "b.pdf", pages)
+    manifest_path = tmp_path / "manifest.json"
+    fresh = DocumentManifest(str(manifest_path))
+    index(fresh, original, pages)
+    sha256 = fresh.files[original]["sha256"]
+    files = {original: fresh.files[original], copy: {"sha256": sha256, "duplicate_of": original, "pages": []}}
+    manifest_path.write_text(json.dumps({"files": files}))
+
+    manifest = DocumentManifest(str(manifest_path))
+    assert manifest.version == 1
+    # indexed again as a copy of the original, this time with nodes of its own
+    assert manifest.find_indexed_copy(copy) == original
+    manifest.upgrade()
+    assert DocumentManifest(str(manifest_path)).version == MANIFEST_VERSION
+
+
+def test_retain_forgets_other_files(manifest, tmp_path):
+    kept = write_file(tmp_path / "a.pdf", ["a"])
+    dropped = write_file(tmp_path / "b.pdf", ["b"])
+    index(manifest, kept, ["a"])
+    index(manifest, dropped, ["b"])
+    manifest.retain([kept])
+    assert list(manifest.files) == [kept]
+    assert manifest.find_indexed_copy(dropped) is None
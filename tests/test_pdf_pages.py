@@ -0,0 +1,34 @@
+import fitz
+import pytest
+
+from pdf_pages import PageExtractor, iter_pdf_pages
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    document = fitz.open()
+    for i in range(5):
+        document.new_page().insert_text((72, 72), f"page {i}")
+    path = str(tmp_path / "five_pages.pdf")
+    document.save(path)
+    document.close()
+    return path
+
+
+def test_iter_pdf_pages(pdf_path):
+    pages = list(iter_pdf_pages(pdf_path))
+    assert [doc.metadata["page_index"] for doc in pages] == [0, 1, 2, 3, 4]
+    assert "page 3" in pages[3].text
+
+
+def test_get_page_returns_one_page(pdf_path):
+    extractor = PageExtractor()
+    page = fitz.open(stream=extractor.get_page(pdf_path, 2), filetype="pdf")
+    assert len(page) == 1
+    assert "page 2" in page[0].get_text()
+    assert extractor.get_page(pdf_path, 2) is extractor.get_page(pdf_path, 2)
+
+
+@pytest.mark.parametrize("page_index", [5, -1, -5])
+def test_get_page_out_of_range(pdf_path, page_index):
+    assert PageExtractor().get_page(pdf_path, page_index) is None
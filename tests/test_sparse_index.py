@@ -0,0 +1,103 @@
+import pytest
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+
+from sparse_index import BM25Index, reciprocal_rank_fusion, tokenize
+
+
+def node(node_id, text, doc, category=None):
+    return TextNode(id_=node_id, text=text, metadata={"category": category},
+                    relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=doc)})
+
+
+def text(node):
+    return node.text
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "bm25.jsonl")
+
+
+def ids(results):
+    return [node_id for node_id, _ in results]
+
+
+def test_tokenize_keeps_codes_whole_and_drops_stopwords():
+    assert tokenize("What is the deadline of CS-101 and l2.norm?") == ["deadline", "cs-101", "l2.norm"]
+
+
+def test_search_ranks_rare_terms_first(path):
+    index = BM25Index(path)
+    index.add([
+        node("1", "exam schedule for the course", "a"),
+        node("2", "the exam covers cs-101 lectures", "a"),
+        node("3", "lecture notes on graphs", "b"),
+    ], text)
+    assert ids(index.search("cs-101 exam")) == ["2", "1"]
+    assert index.search("unknown words") == []
+    assert index.search("the of") == []
+
+
+def test_category_filter(path):
+    index = BM25Index(path)
+    index.add([node("1", "exam dates", "a", "A"), node("2", "exam rules", "b", "B")], text)
+    assert ids(index.search("exam", category="B")) == ["2"]
+    assert sorted(ids(index.search("exam"))) == ["1", "2"]
+
+
+def test_readding_a_node_replaces_it(path):
+    index = BM25Index(path)
+    index.add([node("1", "old text", "a")], text)
+    index.add([node("1", "new text", "a")], text)
+    assert len(index) == 1
+    assert index.search("old") == []
+    assert ids(index.search("new")) == ["1"]
+
+
+def test_delete_compact_and_reload(path):
+    index = BM25Index(path)
+    index.add([node(str(i), f"page {i} about topic{i % 2}", f"doc{i % 3}") for i in range(10)], text)
+    index.delete(["0", "1", "2"])
+    index.retain_ref_docs(["doc0", "doc1"])
+    assert sorted(ids(index.search("topic0 topic1", top_k=20))) == ["3", "4", "6", "7", "9"]
+    assert index.should_compact()
+    with open(path) as f:
+        lines_before = len(f.readlines())
+    index.compact()
+    with open(path) as f:
+        assert len(f.readlines()) == len(index) < lines_before
+    assert not index.should_compact()
+    reloaded = BM25Index(path)
+    assert len(reloaded) == len(index)
+    assert reloaded.search("topic0 topic1", top_k=20) == index.search("topic0 topic1", top_k=20)
+
+
+def test_reader_refreshes_after_appends_deletes_compaction_and_clear(path):
+    writer = BM25Index(path)
+    writer.add([node("1", "alpha", "a")], text)
+    reader = BM25Index(path, read_only=True)
+    assert ids(reader.search("alpha")) == ["1"]
+    assert not reader.refresh()
+
+    writer.add([node("2", "beta", "b")], text)
+    writer.delete(["1"])
+    assert reader.refresh()
+    assert reader.search("alpha") == [] and ids(reader.search("beta")) == ["2"]
+
+    writer.add([node("3", "gamma", "c")], text)
+    writer.compact()
+    assert reader.refresh()
+    assert sorted(ids(reader.search("beta gamma"))) == ["2", "3"]
+
+    writer.clear()
+    assert reader.refresh()
+    assert len(reader) == 0
+    with pytest.raises(RuntimeError):
+        reader.add([node("4", "delta", "d")], text)
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=60)
+    assert [item_id for item_id, _ in fused] == ["b", "a", "d", "c"]
+    assert fused[0][1] == pytest.approx(1 / 62 + 1 / 61)
+    assert reciprocal_rank_fusion([]) == []
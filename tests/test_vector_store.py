@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores import MetadataFilter, MetadataFilters
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from vector_store import NumpyVectorStore
+
+DIM = 8
+
+
+def make_nodes(ids, category=None, seed=0):
+    rng = np.random.default_rng(seed)
+    return [TextNode(id_=node_id, text=f"text of {node_id}", embedding=rng.standard_normal(DIM).tolist(),
+                     metadata={"category": category} if category else {})
+            for node_id in ids]
+
+
+def query(store, embedding, top_k=3, category=None):
+    filters = MetadataFilters(filters=[MetadataFilter(key="category", value=category)]) if category else None
+    return store.query(VectorStoreQuery(query_embedding=list(embedding), similarity_top_k=top_k, filters=filters))
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_query_matches_exact_cosine_ranking(tmp_path, dtype):
+    nodes = make_nodes([f"n{i}" for i in range(50)])
+    store = NumpyVectorStore(str(tmp_path / "store"), dtype=dtype)
+    store.add(nodes)
+    embeddings = np.array([node.embedding for node in nodes])
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    target = embeddings[7] + 0.01
+
+    result = query(store, target, top_k=5)
+    expected = [nodes[i].node_id for i in np.argsort(-(embeddings @ target))[:5]]
+    assert result.ids[0] == "n7"
+    if dtype == "float32":
+        assert result.ids == expected
+    assert [node.node_id for node in store.get_nodes(result.ids)] == result.ids
+
+
+def test_rows_survive_a_restart(tmp_path):
+    path = str(tmp_path / "store")
+    nodes = make_nodes(["a", "b", "c"])
+    store = NumpyVectorStore(path)
+    store.add(nodes)
+    store.delete_nodes(["b"])
+
+    reopened = NumpyVectorStore(path)
+    assert reopened.num_rows == 2
+    assert sorted(reopened.node_ids()) == ["a", "c"]
+    assert query(reopened, nodes[1].embedding, top_k=3).ids.count("b") == 0
+    np.testing.assert_allclose(reopened.get_embeddings(["a"])[0],
+                               np.array(nodes[0].embedding) / np.linalg.norm(nodes[0].embedding), rtol=1e-5)
+
+
+def test_readers_follow_appends_deletions_and_compactions(tmp_path):
+    path = str(tmp_path / "store")
+    writer = NumpyVectorStore(path)
+    writer.add(make_nodes(["a", "b"]))
+    reader = NumpyVectorStore(path, read_only=True)
+    assert reader.num_rows == 2
+
+    writer.add(make_nodes(["c"], seed=1))
+    writer.delete_nodes(["a"])
+    assert reader.refresh()
+    assert sorted(reader.node_ids()) == ["b", "c"]
+    assert not reader.refresh()
+
+    generation = writer.generation
+    writer.compact()
+    assert writer.generation != generation
+    assert reader.refresh()
+    assert reader.generation == writer.generation
+    assert sorted(reader.node_ids()) == ["b", "c"] and reader.num_deleted == 0
+
+    with pytest.raises(Exception):
+        reader.add(make_nodes(["d"]))
+
+
+def test_category_filter_only_scores_its_partition(tmp_path):
+    store = NumpyVectorStore(str(tmp_path / "store"))
+    store.add(make_nodes(["a1", "a2"], category="A"))
+    store.add(make_nodes(["b1"], category="B", seed=1))
+    assert store.categories == ["A", "B"]
+
+    embedding = make_nodes(["a1"])[0].embedding
+    assert query(store, embedding, category="B").ids == ["b1"]
+    assert set(query(store, embedding, category="A").ids) == {"a1", "a2"}
+    assert query(store, embedding, category="C").ids == []
+
+
+def test_readding_an_id_replaces_its_row(tmp_path):
+    store = NumpyVectorStore(str(tmp_path / "store"))
+    store.add(make_nodes(["a"], category="A"))
+    store.add(make_nodes(["a"], category="B", seed=1))
+    assert store.num_rows == 1
+    assert query(store, make_nodes(["a"], seed=1)[0].embedding, category="A").ids == []
+    assert query(store, make_nodes(["a"], seed=1)[0].embedding, category="B").ids == ["a"]
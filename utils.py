@@ -1,69 +1,60 @@
-import fitz
+import re
 
-def read_and_concat_pdf(retrieved_pdf_data, target_size=(595, 842)):
+def convert_message_list_to_str(messages):
+    return "\n".join([f"{message.role}: {message.content}" for message in messages])
+
+
+# Words that usually point back to an earlier turn of the conversation
+FOLLOW_UP_MARKERS = {
+    "it", "its", "this", "these", "those", "they", "them", "their", "he", "she", "him", "her", "his",
+    "above", "previous", "previously", "earlier", "former", "latter", "same", "again", "more", "else",
+    "also", "another", "other", "one", "ones", "there", "then",
+}
+
+
+def is_self_contained(query_str, min_words=4):
     """
-    Concatenates specific pages from multiple PDFs into a single PDF with a uniform page size.
-    
+    Cheap check whether a question can be answered without the chat history.
+
     Args:
-        retrieved_pdf_data (dict): A dictionary where keys are PDF file paths, and values are lists of page numbers to extract.
-        target_size (tuple): A tuple specifying the target page width and height in points. Defaults to A4 size (595x842 points).
-        
+        query_str (str): The user question.
+        min_words (int): Shorter questions ("why?", "and the proof?") are treated as follow-ups.
+
     Returns:
-        fitz.Document: A new PDF document with concatenated pages.
+        bool: True if the question neither is too short nor contains a word referring back to earlier turns.
     """
-    # Create a new PDF for output
-    new_document = fitz.open()
-    
-    # increase continuity of pages_to_extract
-        # new_pages_to_extract = set()
-        # margin = 1
-        # for i, page_num in enumerate(pages_to_extract): 
-        #     for offset in range(-margin, margin+1):
-        #         if page_num + offset < 0:
-        #             continue
-        #         new_pages_to_extract.add(page_num + offset)    
-        # 
-
-    target_size = ()
+    words = re.findall(r"[a-z']+", query_str.lower())
+    if len(words) < min_words:
+        return False
+    return not any(word in FOLLOW_UP_MARKERS for word in words)
 
-    for input_pdf_path, pages_to_extract in retrieved_pdf_data.items():
-        # pages_to_extract = sorted(pages_to_extract)
-        
-        # Open the input PDF
-        document = fitz.open(input_pdf_path)
-        
-        # Loop through the specified pages and extract them
-        for page_num in pages_to_extract:
-            if page_num < len(document):
-                # Extract the page
-                page = document.load_page(page_num)
 
-                if not target_size:
-                    target_size = (page.rect.width, page.rect.height)
-
-                # # Resize to target size if needed
-                # scale_x = target_size[0] / src_rect.width
-                # scale_y = target_size[1] / src_rect.height
-                # scale = min(scale_x, scale_y)  # Maintain aspect ratio
-                
-                # Create a new page in the target document with the specified target size
-                new_page = new_document.new_page(width=target_size[0], height=target_size[1])
-                
-                # Place the page onto the new page centered, preserving scale
-                # matrix = fitz.Matrix(scale, scale)
-                # offset_x = (target_rect.width - src_rect.width * scale) / 2
-                # offset_y = (target_rect.height - src_rect.height * scale) / 2
-                # matrix = matrix.pretranslate(offset_x, offset_y)
-                
-                # Render the source page onto the new page
-                new_page.show_pdf_page(new_page.rect, document, page_num)
-            else:
-                print(f"Page {page_num} does not exist in the document.")
-
-        document.close()
+def parse_byte_range(range_header, size):
+    """
+    Parses a single-range HTTP Range header ("bytes=start-end", "bytes=start-" or "bytes=-suffix").
 
-    return new_document
+    Args:
+        range_header (str): Value of the Range header, None if the request had none.
+        size (int): Length of the full content in bytes.
 
+    Returns:
+        tuple: Inclusive (start, end) byte offsets, None when the whole content should be sent
+        (no header, multiple ranges or a unit other than bytes).
 
-def convert_message_list_to_str(messages):
-    return "\n".join([f"{message.role}: {message.content}" for message in messages])
+    Raises:
+        ValueError: If the range cannot be satisfied.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_str, _, end_str = range_header[len("bytes="):].strip().partition("-")
+    if not start_str:
+        # suffix range: the last `end_str` bytes
+        length = int(end_str)
+        if length <= 0:
+            raise ValueError(f"Unsatisfiable range: {range_header}")
+        return max(size - length, 0), size - 1
+    start = int(start_str)
+    end = min(int(end_str), size - 1) if end_str else size - 1
+    if start >= size or start > end:
+        raise ValueError(f"Unsatisfiable range: {range_header}")
+    return start, end
@@ -0,0 +1,692 @@
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+from pydantic import PrivateAttr
+
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+from ann_index import IVFIndex
+from persistence import SegmentLog
+
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    Vector store keeping all embeddings in one contiguous, memory-mapped array.
+
+    Embeddings are L2-normalized and stored row by row in `embeddings.bin` (float32, float16,
+    or int8 with one float32 scale per row), so a query is a single blocked matrix-vector
+    product followed by `np.argpartition`. Node payloads are appended to a `SegmentLog` and
+    only read back (through a small LRU cache) for the rows that make it into a result.
+
+    Every write is append-only. Deleted rows are tombstoned and physically removed by
+    `compact`, which writes a new generation directory and atomically switches `CURRENT` to it.
+    Several processes can map the same store: one writer, and `read_only` readers that pick up
+    its appends, deletions and compactions with `refresh`.
+
+    Rows are partitioned by the `category` metadata of their node. A query filtered on
+    `category` only scores the rows of the requested partitions.
+
+    With `ann="ivf"` the store trains an `IVFIndex` once it holds `ann_min_rows` rows, and a query
+    then only scores the rows of its `ivf_probes` closest lists. The list of every row is appended
+    to `ivf_lists.bin` with the row; the clustering is kept by `compact` until the store doubled.
+
+    Args:
+        persist_dir (str): Directory of the store.
+        dtype (str): Storage type of new stores, one of "float32", "float16" or "int8".
+        block_size (int): Number of rows scored per matrix-vector product.
+        node_cache_size (int): Number of node payloads kept in memory.
+        read_only (bool): Never write to the directory, another process owns the store.
+        ann (str): None for exact search, "ivf" for the approximate IVF index.
+        ivf_lists (int): Number of IVF lists, the square root of the number of rows by default.
+        ivf_probes (int): Lists scored per query, more is slower and closer to the exact result.
+        ann_min_rows (int): Rows below which (per store or per queried partition) the search stays exact.
+    """
+    stores_text: bool = True
+    persist_dir: str
+    dtype: str = "float32"
+    block_size: int = 65536
+    node_cache_size: int = 1024
+    read_only: bool = False
+    ann: Optional[str] = None
+    ivf_lists: Optional[int] = None
+    ivf_probes: int = 16
+    ann_min_rows: int = 20000
+
+    _write_lock: Any = PrivateAttr()
+    _cache_lock: Any = PrivateAttr()
+    _generation: str = PrivateAttr()
+    _segment_log: Any = PrivateAttr()
+    _dim: Optional[int] = PrivateAttr(default=None)
+    _ids: List[str] = PrivateAttr()
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr()
+    _categories: List[Optional[str]] = PrivateAttr()
+    # category -> sorted row numbers, every array is replaced rather than modified
+    _partitions: dict = PrivateAttr()
+    _locations: List[tuple] = PrivateAttr()
+    _row_of: dict = PrivateAttr()
+    # bytes of rows.jsonl and deleted.txt already applied, `refresh` continues from there
+    _rows_offset: int = PrivateAttr(default=0)
+    _deleted_offset: int = PrivateAttr(default=0)
+    # (embeddings, scales, alive mask, number of rows), replaced as a whole so readers never need a lock
+    _state: tuple = PrivateAttr()
+    _node_cache: Any = PrivateAttr()
+    _ivf: Any = PrivateAttr(default=None)
+
+    def __init__(self, persist_dir: str, dtype: str = "float32", **kwargs: Any):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype '{dtype}', expected one of {list(DTYPES)}")
+        if kwargs.get("ann") not in (None, "ivf"):
+            raise ValueError(f"Unsupported ann '{kwargs['ann']}', expected None or 'ivf'")
+        super().__init__(persist_dir=persist_dir, dtype=dtype, **kwargs)
+        self._write_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._node_cache = OrderedDict()
+        self._load()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NumpyVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def num_rows(self) -> int:
+        """Number of live (not deleted) rows."""
+        _, _, alive, _ = self._state
+        return int(alive.sum())
+
+    @property
+    def num_deleted(self) -> int:
+        _, _, alive, n = self._state
+        return n - int(alive.sum())
+
+    @property
+    def generation(self) -> str:
+        return self._generation
+
+    def _gen_dir(self, generation=None):
+        return os.path.join(self.persist_dir, generation or self._generation)
+
+    def _path(self, name, generation=None):
+        return os.path.join(self._gen_dir(generation), name)
+
+    def _load(self):
+        os.makedirs(self.persist_dir, exist_ok=True)
+        current_path = os.path.join(self.persist_dir, "CURRENT")
+        if os.path.exists(current_path):
+            with open(current_path, "r") as f:
+                self._generation = f.read().strip()
+        else:
+            self._generation = "gen-00000000"
+            if not self.read_only:
+                self._write_current(self._generation)
+        self._segment_log = SegmentLog(os.path.join(self._gen_dir(), "nodes"))
+        self._node_cache = OrderedDict()
+
+        self._dim = None
+        self._read_meta()
+
+        self._ids, self._ref_doc_ids, self._locations, self._row_of = [], [], [], {}
+        self._categories, self._partitions = [], {}
+        # tombstones are read before rows: a tombstone is only written for a row that is already committed
+        deleted_lines, self._deleted_offset = self._read_lines(self._path("deleted.txt"), 0)
+        row_lines, self._rows_offset = self._read_lines(self._path("rows.jsonl"), 0)
+        for line in row_lines:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # torn write of the last row, it was never acknowledged
+                break
+            self._append_row_in_memory(row["id"], row["doc"], (row["seg"], row["off"]), row.get("cat"))
+
+        n = len(self._ids)
+        if self._dim is not None:
+            if not self.read_only:
+                # drop embeddings written by an add() that crashed before its rows were committed
+                self._truncate(self._path("embeddings.bin"), n * self._dim * np.dtype(DTYPES[self.dtype]).itemsize)
+                if self.dtype == "int8":
+                    self._truncate(self._path("scales.bin"), n * 4)
+            n = min(n, self._file_rows())
+            del self._ids[n:], self._ref_doc_ids[n:], self._locations[n:], self._categories[n:]
+        self._extend_partitions(0)
+
+        alive = np.ones(n, dtype=bool)
+        for line in deleted_lines:
+            if line.strip() and int(line) < n:
+                alive[int(line)] = False
+        self._row_of = {node_id: row for row, node_id in enumerate(self._ids) if alive[row]}
+        self._state = self._map(n, alive)
+        self._load_ivf(n)
+        if not self.read_only:
+            self._maybe_train_ivf()
+
+    def _load_ivf(self, n):
+        self._ivf = None
+        if self.ann != "ivf" or not os.path.exists(self._path("ivf.npz")):
+            return
+        with np.load(self._path("ivf.npz")) as data:
+            centroids, trained_rows = data["centroids"], int(data["trained_rows"])
+        path = self._path("ivf_lists.bin")
+        assignments = np.fromfile(path, dtype=np.int32) if os.path.exists(path) else np.empty(0, dtype=np.int32)
+        ivf = IVFIndex(centroids, assignments[:n], trained_rows=trained_rows)
+        if not self.read_only:
+            # lists written by an add() that crashed before its rows were committed
+            self._truncate(path, n * 4)
+        if ivf.num_rows < n:
+            if self.read_only:
+                # rows added while the store ran without ann, the writer assigns them; exact search meanwhile
+                return
+            self._assign_rows(ivf, ivf.num_rows, n)
+        self._ivf = ivf
+
+    def _refresh_ivf(self, n):
+        if self._ivf is None:
+            self._load_ivf(n)
+        elif self._ivf.num_rows < n:
+            start = self._ivf.num_rows
+            assignments = np.fromfile(self._path("ivf_lists.bin"), dtype=np.int32, count=n - start, offset=start * 4)
+            if len(assignments) < n - start:
+                self._ivf = None
+                return
+            self._ivf.extend(assignments, start)
+
+    def _decode(self, embeddings, scales, rows):
+        """Float32 embeddings of `rows` (an index array or a slice)."""
+        block = np.asarray(embeddings[rows], dtype=np.float32)
+        if scales is not None:
+            block *= np.asarray(scales[rows])[:, None]
+        return block
+
+    def _assign_rows(self, ivf, start, end, block_size=65536):
+        """Assigns stored rows `start:end` to their IVF lists and appends them to ivf_lists.bin."""
+        embeddings, scales, _, _ = self._state
+        for block_start in range(start, end, block_size):
+            rows = slice(block_start, min(block_start + block_size, end))
+            assignments = ivf.assign(self._decode(embeddings, scales, rows))
+            self._append_file(self._path("ivf_lists.bin"), assignments)
+            ivf.extend(assignments, block_start)
+
+    def _save_ivf(self, ivf, generation=None):
+        path = self._path("ivf.npz", generation)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, centroids=ivf.centroids, trained_rows=ivf.trained_rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _maybe_train_ivf(self):
+        """Trains the IVF index once there are enough rows. Caller holds the write lock or is loading the store."""
+        if self.ann != "ivf" or self._ivf is not None or self.num_rows < self.ann_min_rows:
+            return
+        embeddings, scales, alive, n = self._state
+        live_rows = np.flatnonzero(alive)
+        num_lists = self.ivf_lists or int(np.sqrt(len(live_rows)))
+        sample_size = min(len(live_rows), 64 * num_lists)
+        sample_rows = np.sort(np.random.default_rng(0).choice(live_rows, sample_size, replace=False))
+        print(f"Training IVF index with {num_lists} lists on {sample_size} of {len(live_rows)} rows...")
+        ivf = IVFIndex.train(self._decode(embeddings, scales, sample_rows), num_lists)
+        ivf.trained_rows = len(live_rows)
+        if os.path.exists(self._path("ivf_lists.bin")):
+            os.remove(self._path("ivf_lists.bin"))
+        self._assign_rows(ivf, 0, n)
+        # written last, readers only use the lists once ivf.npz exists
+        self._save_ivf(ivf)
+        self._ivf = ivf
+
+    def _read_meta(self):
+        if not os.path.exists(self._path("meta.json")):
+            return
+        with open(self._path("meta.json"), "r") as f:
+            meta = json.load(f)
+        self._dim = meta["dim"]
+        if meta["dtype"] != self.dtype:
+            print(f"Vector store was written as {meta['dtype']}, ignoring dtype={self.dtype} (run compact to convert).")
+            self.dtype = meta["dtype"]
+
+    @staticmethod
+    def _read_lines(path, offset):
+        """Complete lines of `path` after byte `offset`, and the offset after the last complete line."""
+        if not os.path.exists(path):
+            return [], offset
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        return data[:end].decode("utf-8").splitlines(), offset + end
+
+    def refresh(self) -> bool:
+        """
+        Picks up what the writer process appended, deleted or compacted since the last load.
+
+        Returns:
+            bool: True if the content of the store changed.
+        """
+        if not self.read_only:
+            # the writer's in-memory state is always current
+            return False
+        with self._write_lock:
+            current_path = os.path.join(self.persist_dir, "CURRENT")
+            if os.path.exists(current_path):
+                with open(current_path, "r") as f:
+                    if f.read().strip() != self._generation:
+                        self._load()
+                        return True
+            deleted_lines, deleted_offset = self._read_lines(self._path("deleted.txt"), self._deleted_offset)
+            row_lines, rows_offset = self._read_lines(self._path("rows.jsonl"), self._rows_offset)
+            if not deleted_lines and not row_lines:
+                # the writer may have trained the IVF index without adding rows since
+                self._refresh_ivf(self._state[3])
+                return False
+            if self._dim is None:
+                self._read_meta()
+            rows = [json.loads(line) for line in row_lines]
+            _, _, alive, n = self._state
+            if self._dim is not None and n + len(rows) > self._file_rows():
+                # rows are committed after their embeddings, this only happens if the files were replaced
+                return False
+            self._deleted_offset, self._rows_offset = deleted_offset, rows_offset
+            for i, row in enumerate(rows):
+                self._append_row_in_memory(row["id"], row["doc"], (row["seg"], row["off"]), row.get("cat"))
+                self._row_of[row["id"]] = n + i
+            self._extend_partitions(n)
+            alive = np.concatenate([alive, np.ones(len(rows), dtype=bool)])
+            for line in deleted_lines:
+                row = int(line)
+                if row < len(alive) and alive[row]:
+                    alive[row] = False
+                    if self._row_of.get(self._ids[row]) == row:
+                        del self._row_of[self._ids[row]]
+            self._state = self._map(n + len(rows), alive)
+            self._refresh_ivf(n + len(rows))
+            return True
+
+    def _append_row_in_memory(self, node_id, ref_doc_id, location, category=None):
+        self._ids.append(node_id)
+        self._ref_doc_ids.append(ref_doc_id)
+        self._locations.append(location)
+        self._categories.append(category)
+
+    def _extend_partitions(self, start):
+        """Adds rows `start:` to the partitions of their categories."""
+        new_rows = {}
+        for row in range(start, len(self._categories)):
+            new_rows.setdefault(self._categories[row], []).append(row)
+        for category, rows in new_rows.items():
+            previous = self._partitions.get(category)
+            rows = np.asarray(rows, dtype=np.int64)
+            self._partitions[category] = rows if previous is None else np.concatenate([previous, rows])
+
+    @property
+    def categories(self) -> List[str]:
+        return sorted((category for category in self._partitions if category is not None))
+
+    def _truncate(self, path, size):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _file_rows(self):
+        path = self._path("embeddings.bin")
+        if self._dim is None or not os.path.exists(path):
+            return 0
+        return os.path.getsize(path) // (self._dim * np.dtype(DTYPES[self.dtype]).itemsize)
+
+    def _map(self, n, alive):
+        if n == 0 or self._dim is None:
+            return None, None, alive, n
+        embeddings = np.memmap(self._path("embeddings.bin"), dtype=DTYPES[self.dtype], mode="r", shape=(n, self._dim))
+        scales = None
+        if self.dtype == "int8":
+            scales = np.memmap(self._path("scales.bin"), dtype=np.float32, mode="r", shape=(n,))
+        return embeddings, scales, alive, n
+
+    def _write_current(self, generation):
+        current_path = os.path.join(self.persist_dir, "CURRENT")
+        with open(current_path + ".tmp", "w") as f:
+            f.write(generation)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(current_path + ".tmp", current_path)
+
+    def _encode(self, embeddings, dtype):
+        """Converts normalized float32 rows to the storage dtype, returns (rows, scales)."""
+        if dtype == "int8":
+            scales = np.abs(embeddings).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            rows = np.round(embeddings / scales[:, None]).astype(np.int8)
+            return rows, scales.astype(np.float32)
+        return embeddings.astype(DTYPES[dtype]), None
+
+    @staticmethod
+    def _append_file(path, array):
+        with open(path, "ab") as f:
+            f.write(np.ascontiguousarray(array).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _normalize(embeddings):
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"NumpyVectorStore at {self.persist_dir} is read-only in this process")
+
+    def add(self, nodes: Sequence[BaseNode], **add_kwargs: Any) -> List[str]:
+        self._check_writable()
+        if not nodes:
+            return []
+        embeddings = self._normalize(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+
+        with self._write_lock:
+            if self._dim is None:
+                self._dim = embeddings.shape[1]
+                with open(self._path("meta.json"), "w") as f:
+                    json.dump({"dim": self._dim, "dtype": self.dtype}, f)
+            elif embeddings.shape[1] != self._dim:
+                raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match the store ({self._dim})")
+
+            # the payload is read back lazily, the embedding already lives in embeddings.bin
+            payloads = []
+            for node in nodes:
+                payload = node.model_copy()
+                payload.embedding = None
+                payloads.append(payload)
+            segment_name, offsets = self._segment_log.append(payloads)
+
+            rows, scales = self._encode(embeddings, self.dtype)
+            self._append_file(self._path("embeddings.bin"), rows)
+            if scales is not None:
+                self._append_file(self._path("scales.bin"), scales)
+            ivf = self._ivf
+            if ivf is not None:
+                assignments = ivf.assign(embeddings)
+                self._append_file(self._path("ivf_lists.bin"), assignments)
+            # rows.jsonl is written last, it is what makes the new rows visible after a restart
+            with open(self._path("rows.jsonl"), "a") as f:
+                for node, offset in zip(nodes, offsets):
+                    f.write(json.dumps({"id": node.node_id, "doc": node.ref_doc_id, "seg": segment_name, "off": offset,
+                                        "cat": node.metadata.get("category")}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            _, _, alive, n = self._state
+            replaced = [self._row_of[node.node_id] for node in nodes if node.node_id in self._row_of]
+            for node, offset in zip(nodes, offsets):
+                self._append_row_in_memory(node.node_id, node.ref_doc_id, (segment_name, offset), node.metadata.get("category"))
+            new_alive = np.concatenate([alive, np.ones(len(nodes), dtype=bool)])
+            # re-adding an existing node id replaces the old row
+            self._tombstone(replaced, new_alive)
+            for i, node in enumerate(nodes):
+                self._row_of[node.node_id] = n + i
+            self._extend_partitions(n)
+            self._state = self._map(n + len(nodes), new_alive)
+            if ivf is not None:
+                ivf.extend(assignments, n)
+            self._maybe_train_ivf()
+
+        return [node.node_id for node in nodes]
+
+    def _tombstone(self, rows, alive):
+        if not rows:
+            return
+        with open(self._path("deleted.txt"), "a") as f:
+            f.write("".join(f"{row}\n" for row in rows))
+            f.flush()
+            os.fsync(f.fileno())
+        alive[rows] = False
+
+    def _delete_rows(self, rows):
+        self._check_writable()
+        with self._write_lock:
+            embeddings, scales, alive, n = self._state
+            rows = [row for row in rows if alive[row]]
+            if not rows:
+                return
+            alive = alive.copy()
+            self._tombstone(rows, alive)
+            for row in rows:
+                self._row_of.pop(self._ids[row], None)
+            self._state = (embeddings, scales, alive, n)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self._delete_rows([row for row, doc_id in enumerate(self._ref_doc_ids) if doc_id == ref_doc_id])
+
+    def ref_doc_ids(self) -> set:
+        """Ids of the documents that still have live rows."""
+        _, _, alive, n = self._state
+        return {self._ref_doc_ids[row] for row in np.flatnonzero(alive[:n])}
+
+    def delete_ref_docs(self, ref_doc_ids) -> None:
+        ref_doc_ids = set(ref_doc_ids)
+        if ref_doc_ids:
+            self._delete_rows([row for row, doc_id in enumerate(self._ref_doc_ids) if doc_id in ref_doc_ids])
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        if filters is not None:
+            raise NotImplementedError("NumpyVectorStore does not support metadata filters")
+        self._delete_rows([self._row_of[node_id] for node_id in node_ids or [] if node_id in self._row_of])
+
+    def clear(self) -> None:
+        self._check_writable()
+        with self._write_lock:
+            self._switch_generation(self._next_generation())
+
+    def get_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+    ) -> List[BaseNode]:
+        if filters is not None:
+            raise NotImplementedError("NumpyVectorStore does not support metadata filters")
+        if node_ids is None:
+            rows = list(self._row_of.values())
+        else:
+            rows = [self._row_of[node_id] for node_id in node_ids if node_id in self._row_of]
+        return [self._get_node(row) for row in rows]
+
+    def node_ids(self) -> List[str]:
+        """Ids of the live nodes."""
+        return list(self._row_of)
+
+    def get_embeddings(self, node_ids: List[str]) -> np.ndarray:
+        """Stored embeddings of live nodes, normalized and decoded to float32, one row per id in order."""
+        embeddings, scales, _, _ = self._state
+        rows = np.array([self._row_of[node_id] for node_id in node_ids], dtype=np.int64)
+        return self._decode(embeddings, scales, rows)
+
+    def _get_node(self, row):
+        location = self._locations[row]
+        with self._cache_lock:
+            node = self._node_cache.get(location)
+            if node is not None:
+                self._node_cache.move_to_end(location)
+                return node
+        node = self._segment_log.read_node(*location)
+        with self._cache_lock:
+            self._node_cache[location] = node
+            if len(self._node_cache) > self.node_cache_size:
+                self._node_cache.popitem(last=False)
+        return node
+
+    def _candidate_mask(self, query: VectorStoreQuery, alive):
+        mask = alive
+        if query.node_ids is not None:
+            allowed = np.zeros_like(alive)
+            allowed[[self._row_of[node_id] for node_id in query.node_ids if node_id in self._row_of]] = True
+            mask = mask & allowed
+        if query.doc_ids is not None:
+            doc_ids = set(query.doc_ids)
+            allowed = np.fromiter((doc_id in doc_ids for doc_id in self._ref_doc_ids[:len(alive)]), dtype=bool, count=len(alive))
+            mask = mask & allowed
+        return mask
+
+    @staticmethod
+    def _filter_categories(filters: Optional[MetadataFilters]):
+        """Categories a query is restricted to, None if it is not."""
+        if filters is None:
+            return None
+        if len(filters.filters) != 1 or not isinstance(filters.filters[0], MetadataFilter):
+            raise NotImplementedError("NumpyVectorStore only supports a single filter on 'category'")
+        metadata_filter = filters.filters[0]
+        if metadata_filter.key != "category" or metadata_filter.operator not in (FilterOperator.EQ, FilterOperator.IN):
+            raise NotImplementedError("NumpyVectorStore only supports a single filter on 'category'")
+        if metadata_filter.operator == FilterOperator.IN:
+            return list(metadata_filter.value)
+        return [metadata_filter.value]
+
+    def score(self, query_embedding, embeddings, scales, rows=None):
+        """Cosine similarity of the (normalized) query against every stored row, or only against `rows`."""
+        n = embeddings.shape[0] if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, self.block_size):
+            if rows is None:
+                block = embeddings[start:start + self.block_size]
+            else:
+                block = embeddings[rows[start:start + self.block_size]]
+            if block.dtype != np.float32:
+                block = block.astype(np.float32)
+            scores[start:start + len(block)] = block @ query_embedding
+        if scales is not None:
+            scores *= scales if rows is None else scales[rows]
+        return scores
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        categories = self._filter_categories(query.filters)
+        embeddings, scales, alive, n = self._state
+        if n == 0 or query.query_embedding is None:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        query_embedding = self._normalize(np.asarray(query.query_embedding, dtype=np.float32))
+        mask = self._candidate_mask(query, alive)
+        rows = None
+        if categories is not None:
+            # only the requested partitions are read and scored
+            partitions = [self._partitions[category] for category in categories if category in self._partitions]
+            rows = np.sort(np.concatenate(partitions)) if partitions else np.empty(0, dtype=np.int64)
+            rows = rows[rows < n]
+        ivf = self._ivf
+        if ivf is not None and (n if rows is None else len(rows)) >= self.ann_min_rows:
+            # ... and of those only the rows in the IVF lists closest to the query
+            candidates = ivf.candidates(query_embedding, self.ivf_probes)
+            rows = candidates[candidates < n] if rows is None else np.intersect1d(rows, candidates, assume_unique=True)
+        if rows is None:
+            scores = self.score(query_embedding, embeddings, scales)
+            scores[~mask] = -np.inf
+        else:
+            rows = rows[mask[rows]]
+            scores = self.score(query_embedding, embeddings, scales, rows)
+
+        k = min(query.similarity_top_k, int(mask.sum()) if rows is None else len(rows))
+        if k <= 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        similarities = scores[top].tolist()
+        if rows is not None:
+            top = rows[top]
+
+        nodes = [self._get_node(row) for row in top]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=similarities,
+            ids=[self._ids[row] for row in top],
+        )
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        # every add/delete is already durable, nothing to flush
+        return None
+
+    def should_compact(self, max_segments: int, max_deleted_ratio: float = 0.2) -> bool:
+        _, _, alive, n = self._state
+        return len(self._segment_log) >= max_segments or (n > 0 and (n - alive.sum()) / n > max_deleted_ratio)
+
+    def _next_generation(self):
+        return f"gen-{int(self._generation.split('-')[1]) + 1:08d}"
+
+    def _switch_generation(self, generation):
+        previous = self._generation
+        os.makedirs(self._gen_dir(generation), exist_ok=True)
+        self._write_current(generation)
+        self._load()
+        # keep the previous generation around for processes that still map it, drop anything older
+        for name in os.listdir(self.persist_dir):
+            if name.startswith("gen-") and name not in (previous, generation):
+                shutil.rmtree(os.path.join(self.persist_dir, name), ignore_errors=True)
+
+    def compact(self, dtype: Optional[str] = None, chunk_size: int = 8192) -> None:
+        """
+        Rewrites the live rows into a new generation, merging node segments and dropping tombstones.
+
+        Args:
+            dtype (str): Optionally convert the stored embeddings to another dtype.
+            chunk_size (int): Number of rows copied at a time.
+        """
+        self._check_writable()
+        dtype = dtype or self.dtype
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype '{dtype}', expected one of {list(DTYPES)}")
+        with self._write_lock:
+            embeddings, scales, alive, n = self._state
+            generation = self._next_generation()
+            gen_dir = self._gen_dir(generation)
+            shutil.rmtree(gen_dir, ignore_errors=True)
+            os.makedirs(gen_dir)
+            segment_log = SegmentLog(os.path.join(gen_dir, "nodes"))
+            live_rows = np.flatnonzero(alive)
+
+            with open(self._path("rows.jsonl", generation), "w") as rows_file:
+                for start in range(0, len(live_rows), chunk_size):
+                    rows = live_rows[start:start + chunk_size]
+                    segment_name, offsets = segment_log.append([self._segment_log.read_node(*self._locations[row]) for row in rows])
+                    block = np.asarray(embeddings[rows])
+                    if dtype == self.dtype:
+                        self._append_file(self._path("embeddings.bin", generation), block)
+                        if scales is not None:
+                            self._append_file(self._path("scales.bin", generation), np.asarray(scales[rows]))
+                    else:
+                        decoded = block.astype(np.float32)
+                        if scales is not None:
+                            decoded *= np.asarray(scales[rows])[:, None]
+                        encoded, new_scales = self._encode(self._normalize(decoded), dtype)
+                        self._append_file(self._path("embeddings.bin", generation), encoded)
+                        if new_scales is not None:
+                            self._append_file(self._path("scales.bin", generation), new_scales)
+                    for row, offset in zip(rows, offsets):
+                        rows_file.write(json.dumps({"id": self._ids[row], "doc": self._ref_doc_ids[row], "seg": segment_name,
+                                                    "off": offset, "cat": self._categories[row]}) + "\n")
+                rows_file.flush()
+                os.fsync(rows_file.fileno())
+
+            if self._dim is not None:
+                with open(self._path("meta.json", generation), "w") as f:
+                    json.dump({"dim": self._dim, "dtype": dtype}, f)
+            if self._ivf is not None and len(live_rows) <= 2 * self._ivf.trained_rows:
+                # the rows keep their lists; once the store doubled, loading the new generation retrains
+                self._append_file(self._path("ivf_lists.bin", generation), self._ivf.assignments[live_rows])
+                self._save_ivf(self._ivf, generation)
+            self.dtype = dtype
+            self._switch_generation(generation)